@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+from sse_parser import SSEParser, delta_content
+from backend_pool import BackendPool
+from http_client import client_headers
+from history import message_tokens
+from metrics import get_metrics
+from concurrency_limiter import AdaptiveLimiter, limited_async
+
+
+class ChatRequestError(Exception):
+    """服务器返回了非 200 状态码"""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body[:200]!r}")
+        self.status = status
+        self.body = body
+
+
+class AsyncChatClient:
+    """基于 asyncio 的流式聊天客户端，一个事件循环里可以同时跑很多个对话
+
+    只依赖标准库，直接在转发端口上说 HTTP/1.1，连接读完后放回空闲列表复用。
+    """
+
+    def __init__(
+        self,
+        base_url,
+        max_connections=32,
+        connect_timeout=5.0,
+        read_timeout=300.0,
+        api_key="ollama",
+        headers=None,
+    ):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.api_key = api_key
+        self.headers = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+        self.max_connections = max_connections
+        self._semaphore = None
+        self._idle = []  # 空闲的 keep-alive 连接 (reader, writer)
+        # 可选的自适应并发限制，超出并发数的请求排队等待；traffic 为 interactive 或 batch
+        self.limiter = None
+        self.traffic = "interactive"
+        self.overload_retries = 2
+        # 由 attach_tunnel() 设置，隧道重连期间请求排队等待，最多等 reconnect_timeout 秒
+        self.tunnel = None
+        self.reconnect_timeout = 120.0
+        self._generation = None  # 空闲连接所属的隧道连接序号
+
+    @classmethod
+    def from_config(cls, config, local_port):
+        """根据 config.txt 中的 http_* 配置项创建客户端"""
+        client = cls(
+            config.get("api_base") or f"http://localhost:{local_port}/v1",
+            max_connections=int(config.get("async_max_connections", 32)),
+            connect_timeout=float(config.get("http_connect_timeout", 5.0)),
+            read_timeout=float(config.get("http_read_timeout", 300.0)),
+            headers=client_headers(config),
+        )
+        configure_limiter(client, config)
+        client.reconnect_timeout = float(config.get("tunnel_reconnect_timeout", 120))
+        return client
+
+    def attach_tunnel(self, tunnel):
+        """发送请求前经过 tunnel.LazyTunnel 的连接状态检查，和 ChatHttpClient.tunnel 相同"""
+        self.tunnel = tunnel
+
+    def _limit(self):
+        # 信号量要在事件循环里创建，所以第一次用到时才建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._semaphore
+
+    async def _connect(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout
+        )
+
+    async def _readline(self, reader):
+        return await asyncio.wait_for(reader.readline(), self.read_timeout)
+
+    async def _request(self, method, path, payload=None):
+        """发送请求并读取状态行和响应头，返回 (reader, writer, status, headers)"""
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        head = (
+            f"{method} {self.prefix}/{path.lstrip('/')} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Authorization: Bearer {self.api_key}\r\n"
+            f"{self.headers}"
+            "Content-Type: application/json\r\n"
+            "Accept: text/event-stream\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode("latin-1") + body
+        if self.tunnel is None:
+            return await self._send(head)
+        generation = await self._wait_tunnel()
+        try:
+            return await self._send(head)
+        except ConnectionError:
+            # 和 ChatHttpClient.request 一样：让隧道立即检查，等重连完成后重发一次；
+            # 隧道没有重连过说明是服务器的问题，直接抛出
+            await asyncio.to_thread(self.tunnel.report_failure)
+            if await self._wait_tunnel() == generation:
+                raise
+            return await self._send(head)
+
+    async def _wait_tunnel(self):
+        """在线程中等待隧道连接，不阻塞事件循环；重连过时旧隧道上的空闲连接已经不能用了"""
+        generation = await asyncio.to_thread(self.tunnel.wait_connected, self.reconnect_timeout)
+        if generation != self._generation:
+            await self.close()
+            self._generation = generation
+        return generation
+
+    async def _send(self, head):
+        reader, writer = await self._connect()
+        try:
+            writer.write(head)
+            await writer.drain()
+
+            status_line = await self._readline(reader)
+            if not status_line:
+                raise ConnectionError("服务器关闭了连接")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await self._readline(reader)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, status, headers
+
+    async def _iter_body(self, reader, headers):
+        """按 chunked / Content-Length / 读到关闭 三种方式逐块产出响应体"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._readline(reader)
+                if not size_line:
+                    # 连接在 chunked 响应体中途断开，不能当作最后一块
+                    raise ConnectionError("响应体不完整")
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # 跳过 trailer，直到空行
+                    while (await self._readline(reader)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                chunk = await asyncio.wait_for(
+                    reader.readexactly(size + 2), self.read_timeout
+                )
+                yield chunk[:-2]
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(
+                    reader.read(min(remaining, 65536)), self.read_timeout
+                )
+                if not chunk:
+                    raise ConnectionError("响应体不完整")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), self.read_timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _release(self, reader, writer, headers):
+        if headers.get("connection", "").lower() == "close" or (
+            "content-length" not in headers
+            and headers.get("transfer-encoding", "").lower() != "chunked"
+        ):
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+
+    async def request_json(self, method, path, payload=None):
+        """普通（非流式）请求，返回解析后的 JSON"""
+        async with self._limit():
+            reader, writer, status, headers = await self._request(method, path, payload)
+            try:
+                body = b"".join([c async for c in self._iter_body(reader, headers)])
+            except BaseException:
+                writer.close()
+                raise
+            self._release(reader, writer, headers)
+        if status != 200:
+            raise ChatRequestError(status, body)
+        return json.loads(body)
+
+    async def list_models(self):
+        return await self.request_json("GET", "models")
+
+    async def stream_chat(self, messages, model, **params):
+        """流式聊天补全，以异步生成器的形式逐个产出 delta 文本；配置了 limiter 时先排队拿到名额"""
+        if self.limiter is None:
+            deltas = self._stream_chat(messages, model, **params)
+        else:
+            deltas = limited_async(
+                self.limiter,
+                self.traffic,
+                lambda: self._stream_chat(messages, model, **params),
+                self.overload_retries,
+            )
+        async for content in deltas:
+            yield content
+
+    async def _stream_chat(self, messages, model, **params):
+        payload = {"messages": messages, "model": model, "stream": True}
+        payload.update(params)
+        async with self._limit():
+            timer = get_metrics().track(sum(message_tokens(m) for m in messages))
+            reader, writer, status, headers = await self._request(
+                "POST", "chat/completions", payload
+            )
+            finished = False
+            try:
+                if status != 200:
+                    body = b"".join([c async for c in self._iter_body(reader, headers)])
+                    finished = True
+                    raise ChatRequestError(status, body)
+
+                parser = SSEParser()
+                async for chunk in self._iter_body(reader, headers):
+                    for obj in parser.feed(chunk):
+                        content = delta_content(obj)
+                        if content:
+                            timer.token()
+                            yield content
+                for obj in parser.close():
+                    content = delta_content(obj)
+                    if content:
+                        timer.token()
+                        yield content
+                if not parser.done:
+                    # 没有收到 [DONE]，回复被截断了
+                    raise ConnectionError("流式回复没有正常结束")
+                timer.finish(parser.usage)
+                finished = True
+            except Exception:
+                timer.fail()
+                raise
+            finally:
+                # 只有完整读完的连接才放回连接池，中途取消的直接关闭
+                if finished:
+                    self._release(reader, writer, headers)
+                else:
+                    writer.close()
+
+    async def chat(self, messages, model, on_delta=None, **params):
+        """跑完一次流式对话并返回完整回复，on_delta 可用于实时显示"""
+        parts = []
+        async for content in self.stream_chat(messages, model, **params):
+            parts.append(content)
+            if on_delta is not None:
+                on_delta(content)
+        return "".join(parts)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class RoutedChatClient:
+    """多个后端节点时使用：每个节点一个 AsyncChatClient，每次对话由 BackendPool 选择节点"""
+
+    def __init__(self, pool, **kwargs):
+        self.pool = pool
+        self.clients = {b.name: AsyncChatClient(b.base_url, **kwargs) for b in pool.backends}
+        # 所有节点共用一个限流器，各节点的客户端自己不再限流
+        self.limiter = None
+        self.traffic = "interactive"
+        self.overload_retries = 2
+
+    @classmethod
+    def from_config(cls, config, local_port):
+        """配置了多个 backends 时返回 RoutedChatClient，否则返回普通的 AsyncChatClient"""
+        pool = None if config.get("api_base") else BackendPool.from_config(config, local_port)
+        if pool is None:
+            return AsyncChatClient.from_config(config, local_port)
+        client = cls(
+            pool,
+            max_connections=int(config.get("async_max_connections", 32)),
+            connect_timeout=float(config.get("http_connect_timeout", 5.0)),
+            read_timeout=float(config.get("http_read_timeout", 300.0)),
+        )
+        configure_limiter(client, config)
+        for node in client.clients.values():
+            node.reconnect_timeout = float(config.get("tunnel_reconnect_timeout", 120))
+        return client
+
+    def attach_tunnel(self, tunnel):
+        for client in self.clients.values():
+            client.attach_tunnel(tunnel)
+
+    async def stream_chat(self, messages, model, **params):
+        if self.limiter is None:
+            deltas = self._stream_chat(messages, model, **params)
+        else:
+            deltas = limited_async(
+                self.limiter,
+                self.traffic,
+                lambda: self._stream_chat(messages, model, **params),
+                self.overload_retries,
+            )
+        async for content in deltas:
+            yield content
+
+    async def _stream_chat(self, messages, model, **params):
+        with self.pool.lease() as lease:
+            client = self.clients[lease.backend.name]
+            async for content in client.stream_chat(messages, model, **params):
+                lease.first_byte()
+                yield content
+
+    async def chat(self, messages, model, on_delta=None, **params):
+        parts = []
+        async for content in self.stream_chat(messages, model, **params):
+            parts.append(content)
+            if on_delta is not None:
+                on_delta(content)
+        return "".join(parts)
+
+    async def list_models(self):
+        with self.pool.lease() as lease:
+            return await self.clients[lease.backend.name].list_models()
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+
+def configure_limiter(client, config):
+    """按 limiter_* 和 traffic_class 配置项给客户端加上自适应并发限制"""
+    client.limiter = AdaptiveLimiter.from_config(config)
+    client.traffic = config.get("traffic_class", "interactive")
+    client.overload_retries = int(config.get("limiter_overload_retries", 2))
+
+
+async def run_conversations(client, questions, model):
+    """在同一个事件循环里并发地跑多个单轮对话，返回和 questions 顺序一致的回复列表"""
+
+    async def one(question):
+        messages = [{"role": "user", "content": question}]
+        return await client.chat(messages, model)
+
+    return await asyncio.gather(*(one(q) for q in questions))
+
+
+async def _demo(args):
+    client = AsyncChatClient(args.base_url, max_connections=args.concurrency)
+    questions = [args.question] * args.sessions
+    start = time.perf_counter()
+    try:
+        answers = await run_conversations(client, questions, args.model)
+    finally:
+        await client.close()
+    elapsed = time.perf_counter() - start
+    for i, answer in enumerate(answers):
+        print(f"{'='*10} 对话 {i + 1} {'='*10}\n{answer}\n")
+    print(f"{len(answers)} 个对话共耗时 {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在一个事件循环里并发跑多个对话")
+    parser.add_argument("--base-url", default="http://localhost:8888/v1")
+    parser.add_argument("--model", default="deepseek-r1:70b")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--question", default="Say this is a test")
+    asyncio.run(_demo(parser.parse_args()))
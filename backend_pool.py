@@ -0,0 +1,175 @@
+import threading
+import time
+
+ROUTING_POLICIES = ("least_outstanding", "latency")
+
+
+def backend_addresses(config):
+    """读取 backends 配置（host:port,host:port,...），没有配置时使用 remote_host/remote_port"""
+    default_port = int(config.get("remote_port", 11434))
+    backends = config.get("backends", "").strip()
+    if not backends:
+        return [(config.get("remote_host"), default_port)]
+    addresses = []
+    for item in backends.split(","):
+        host, _, port = item.strip().partition(":")
+        addresses.append((host, int(port) if port else default_port))
+    return addresses
+
+
+def is_backend_failure(error):
+    """连接错误、超时和 5xx 算作节点故障，4xx 是请求本身的问题，不影响节点的健康状态"""
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is None or status >= 500
+
+
+class Backend:
+    """一个后端节点，通过 SSH 隧道转发到本地的 base_url"""
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url
+        self.outstanding = 0  # 正在进行的请求数
+        self.latency = None  # 首字节时间的指数移动平均（秒）
+        self.failures = 0  # 连续失败次数
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def available(self, now):
+        return now >= self.ejected_until
+
+
+class Lease:
+    """一次请求占用的节点，请求结束时由 BackendPool 归还"""
+
+    def __init__(self, pool, backend):
+        self.pool = pool
+        self.backend = backend
+        self.start = time.perf_counter()
+        self.latency = None
+        self.failed = False
+
+    def fail(self):
+        """请求没有抛出异常但节点返回了错误（比如 5xx）时调用"""
+        self.failed = True
+
+    def first_byte(self):
+        """收到响应的第一个字节时调用，记录这个节点的延迟；重复调用只记录第一次"""
+        if self.latency is None:
+            self.latency = time.perf_counter() - self.start
+            self.pool.record_latency(self.backend, self.latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # GeneratorExit 之类（调用方提前停止读取）不算节点故障
+        failed = self.failed or (isinstance(exc, Exception) and is_backend_failure(exc))
+        self.pool.release(self.backend, failed)
+        return False
+
+
+class BackendPool:
+    """多个后端节点组成的池，按正在进行的请求数或最近的延迟选择节点
+
+    连续失败 max_failures 次的节点会被摘除 eject_seconds 秒，之后放回来重新尝试；
+    再次失败会立刻重新摘除。所有节点都被摘除时选择最早恢复的那个，而不是直接报错。
+    """
+
+    def __init__(
+        self,
+        backends,
+        policy="least_outstanding",
+        max_failures=3,
+        eject_seconds=30.0,
+        alpha=0.3,
+    ):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"未知的路由策略: {policy}，可选 {', '.join(ROUTING_POLICIES)}")
+        self.backends = list(backends)
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, local_port):
+        """根据 backends 和 backend_* 配置项创建，只有一个节点时返回 None
+
+        第 i 个节点通过隧道转发到 local_port + i。
+        """
+        addresses = backend_addresses(config)
+        if len(addresses) < 2:
+            return None
+        backends = [
+            Backend(f"{host}:{port}", f"http://localhost:{local_port + i}/v1")
+            for i, (host, port) in enumerate(addresses)
+        ]
+        return cls(
+            backends,
+            policy=config.get("backend_routing", "least_outstanding"),
+            max_failures=int(config.get("backend_max_failures", 3)),
+            eject_seconds=float(config.get("backend_eject_seconds", 30)),
+        )
+
+    def _key(self, backend):
+        # 还没有延迟数据的节点按 0 处理，让新节点（或刚恢复的节点）先被试一下
+        latency = backend.latency or 0.0
+        if self.policy == "latency":
+            return (latency, backend.outstanding)
+        return (backend.outstanding, latency)
+
+    def lease(self):
+        """选择一个节点并占用，配合 with 使用，退出时自动归还"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b.available(now)]
+            if candidates:
+                backend = min(candidates, key=self._key)
+            else:
+                backend = min(self.backends, key=lambda b: b.ejected_until)
+            backend.outstanding += 1
+            backend.requests += 1
+        return Lease(self, backend)
+
+    def record_latency(self, backend, seconds):
+        with self._lock:
+            if backend.latency is None:
+                backend.latency = seconds
+            else:
+                backend.latency += self.alpha * (seconds - backend.latency)
+
+    def release(self, backend, failed=False):
+        with self._lock:
+            backend.outstanding -= 1
+            if not failed:
+                backend.failures = 0
+                return
+            backend.errors += 1
+            backend.failures += 1
+            if backend.failures >= self.max_failures:
+                now = time.monotonic()
+                if backend.available(now):
+                    backend.ejections += 1
+                backend.ejected_until = now + self.eject_seconds
+
+    def stats(self):
+        """返回每个节点的请求数、错误数、延迟和是否被摘除"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                b.name: {
+                    "outstanding": b.outstanding,
+                    "requests": b.requests,
+                    "errors": b.errors,
+                    "ejections": b.ejections,
+                    "latency_ms": round(b.latency * 1000, 1) if b.latency else None,
+                    "ejected": not b.available(now),
+                }
+                for b in self.backends
+            }
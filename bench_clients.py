@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http_client import ChatHttpClient
+from mock_server import MockServer, MockOptions
+
+MESSAGES = [{"role": "user", "content": "Say this is a test"}]
+MODEL = "deepseek-r1:70b"
+
+
+def run_raw(http, requests_count):
+    """只读取流式 delta，不做任何显示，作为其他前端的基线"""
+    deltas = 0
+    for _ in range(requests_count):
+        for _ in http.stream_chat(MESSAGES, MODEL):
+            deltas += 1
+    return deltas
+
+
+def run_async(http, requests_count):
+    from async_client import AsyncChatClient
+
+    async def run():
+        client = AsyncChatClient(http.base_url)
+        deltas = 0
+        try:
+            for _ in range(requests_count):
+                async for _ in client.stream_chat(MESSAGES, MODEL):
+                    deltas += 1
+        finally:
+            await client.close()
+        return deltas
+
+    return asyncio.run(run())
+
+
+def run_terminal(http, requests_count):
+    import main
+
+    main.model = MODEL
+    deltas = 0
+    with open(os.devnull, "w", encoding="utf-8") as null, contextlib.redirect_stdout(null):
+        for _ in range(requests_count):
+            reply = main.stream_chat_completion(http, MESSAGES)
+            deltas += reply is not None
+    return deltas
+
+
+def run_markdown(http, requests_count):
+    import main_md
+    from transcript_writer import TranscriptWriter
+
+    main_md.model = MODEL
+    workdir = tempfile.mkdtemp(prefix="deepseek_bench_")
+    path = os.path.join(workdir, "chat.md")
+    with open(os.devnull, "w", encoding="utf-8") as null, contextlib.redirect_stdout(null):
+        with TranscriptWriter(path, "w") as writer:
+            for _ in range(requests_count):
+                main_md.stream_chat_completion(http, MESSAGES, "Say this is a test", writer)
+    os.remove(path)
+    os.rmdir(workdir)
+    return requests_count
+
+
+def run_gui(http, requests_count):
+    """在 offscreen 的 Qt 中走 GUI 的完整路径：工作线程读流、定时器合并刷新、Markdown 渲染"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    import main_GUI
+    from tunnel import LazyTunnel
+
+    app = QApplication.instance() or QApplication([])
+    window = main_GUI.DeepSeekChat(LazyTunnel({}))
+    tab = window.current_tab()
+
+    def worker():
+        try:
+            tab.stream_chat_completion(http, MESSAGES)
+        finally:
+            tab.streaming = False
+
+    for _ in range(requests_count):
+        tab.text_widget.begin_reply()
+        tab.streaming = True
+        tab.render_timer.start()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        # flush_render 显示完所有内容后会停止定时器
+        while tab.render_timer.isActive():
+            app.processEvents()
+            time.sleep(0.001)
+        thread.join()
+    window.close()
+    return requests_count
+
+
+FRONTENDS = {
+    "raw": run_raw,
+    "async": run_async,
+    "terminal": run_terminal,
+    "markdown": run_markdown,
+    "gui": run_gui,
+}
+
+
+def measure(name, http, requests_count, tokens, repeat=3):
+    """运行 repeat 次，取最快的一次，减少机器负载带来的波动"""
+    elapsed = cpu = None
+    for _ in range(repeat):
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        FRONTENDS[name](http, requests_count)
+        run_elapsed = time.perf_counter() - start
+        if elapsed is None or run_elapsed < elapsed:
+            elapsed = run_elapsed
+            cpu = time.process_time() - cpu_start
+    total_tokens = requests_count * tokens
+    return {
+        "elapsed": elapsed,
+        "cpu": cpu,
+        "tokens_per_sec": total_tokens / elapsed,
+        "us_per_token": elapsed / total_tokens * 1e6,
+        "cpu_us_per_token": cpu / total_tokens * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="用本地模拟服务器测量各个前端流式路径的吞吐量和客户端开销"
+    )
+    parser.add_argument(
+        "--frontends",
+        default=",".join(FRONTENDS),
+        help=f"逗号分隔，可选 {', '.join(FRONTENDS)}",
+    )
+    parser.add_argument("--requests", type=int, default=20, help="每个前端发送的请求数")
+    parser.add_argument("--tokens", type=int, default=500, help="每个回复的 token 数")
+    parser.add_argument("--rate", type=float, default=0, help="模拟服务器每秒生成的 token 数，0 为不限速")
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="每项测量取 repeat 次中最快的一次")
+    parser.add_argument("--json", help="把结果保存为 JSON，便于之后对比")
+    parser.add_argument("--compare", help="和之前保存的 JSON 结果对比")
+    parser.add_argument(
+        "--threshold", type=float, default=0.5, help="每 token 耗时比基线慢多少比例算作退化"
+    )
+    args = parser.parse_args()
+
+    options = MockOptions(
+        rate=args.rate, chunk_tokens=args.chunk_tokens, tokens=args.tokens, think_tokens=0
+    )
+    server = MockServer(options=options).start()
+    http = ChatHttpClient(server.base_url)
+    # 每个回复实际包含的 token 数（正文中每 40 个 token 插入一个空行）
+    tokens = args.tokens + args.tokens // 40
+
+    results = {}
+    try:
+        run_raw(http, 2)  # 预热连接池
+        for name in args.frontends.split(","):
+            results[name] = measure(name, http, args.requests, tokens, args.repeat)
+    finally:
+        http.close()
+        server.stop()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    regressions = []
+    raw = results.get("raw")
+    print(f"\n{'='*10} 客户端吞吐量（{args.requests} 个请求 x {tokens} token）{'='*10}")
+    for name, result in results.items():
+        line = (
+            f"{name:<10} {result['tokens_per_sec']:10.0f} token/s  "
+            f"{result['us_per_token']:8.1f}us/token  CPU {result['cpu_us_per_token']:8.1f}us/token"
+        )
+        if raw is not None and name != "raw":
+            overhead = result["us_per_token"] - raw["us_per_token"]
+            line += f"  比 raw 多 {overhead:8.1f}us/token"
+        if name in baseline:
+            change = result["us_per_token"] / baseline[name]["us_per_token"] - 1
+            line += f"  基线 {change:+.0%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  <-- 退化"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+    if regressions:
+        print(f"\n客户端吞吐量退化: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
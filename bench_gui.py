@@ -0,0 +1,182 @@
+import argparse
+import os
+import threading
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QObject, QTimer, QEventLoop, pyqtSignal
+import main_GUI
+from markdown_view import markdown_to_html
+from tunnel import LazyTunnel
+
+
+def synthesize_deltas(count):
+    """生成类似 deepseek-r1 回复的 delta：每个 2~4 个字符，先是一段推理，然后是带标题、
+    段落和代码块的 Markdown 回答"""
+    words = ["思考", "模型", "token", "的", "推理", "，", "然后", "我们", "需要", "。"]
+    deltas = ["<think>", "\n"]
+    for i in range(count // 4):
+        deltas.append(words[i % len(words)] + ("\n" if i % 23 == 22 else ""))
+    deltas += ["</think>", "\n\n", "## 回答", "\n\n"]
+    for i in range(count - count // 4):
+        delta = words[i % len(words)]
+        if i % 97 == 96:
+            delta += "\n\n```python\nprint('x')\n```\n\n"
+        elif i % 31 == 30:
+            delta += "\n\n"
+        deltas.append(delta)
+    return deltas
+
+
+class LegacyEmitter(QObject):
+    """旧的显示方式：每个 delta 发一次信号，槽函数里 append 并 ensureCursorVisible"""
+
+    update_signal = pyqtSignal(str)
+
+
+class LagProbe:
+    """每 interval 毫秒触发一次的定时器，记录实际间隔比预期晚了多少，用来衡量界面是否卡顿"""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.last = None
+        self.timer = QTimer()
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        self.last = time.perf_counter()
+        self.timer.start()
+
+    def tick(self):
+        now = time.perf_counter()
+        self.max_lag = max(self.max_lag, now - self.last - self.interval / 1000)
+        self.last = now
+
+    def stop(self):
+        self.timer.stop()
+
+
+def produce(deltas, sink, rate):
+    """在工作线程中按 rate（每秒 delta 数，0 为不限速）把 delta 交给 sink"""
+    start = time.perf_counter()
+    for i, delta in enumerate(deltas):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sink(delta)
+
+
+def run_until(done, timeout=120):
+    """运行事件循环直到 done() 返回 True"""
+    loop = QEventLoop()
+    checker = QTimer()
+    checker.setInterval(2)
+    checker.timeout.connect(lambda: done() and loop.quit())
+    checker.start()
+    QTimer.singleShot(int(timeout * 1000), loop.quit)
+    loop.exec_()
+    checker.stop()
+
+
+def bench(mode, deltas, rate):
+    window = main_GUI.DeepSeekChat(LazyTunnel({}))
+    window.show()
+    chat = window.current_tab()
+    expected = "".join(deltas)
+    probe = LagProbe()
+
+    if mode == "full":
+        # 对照组：每次刷新都把整个回复重新转换成 HTML
+        parts = []
+        buffer = main_GUI.RenderBuffer()
+        done_flag = []
+
+        def rerender():
+            text = buffer.drain()
+            if text:
+                parts.append(text)
+                chat.text_widget.setHtml(markdown_to_html("".join(parts)))
+            if len("".join(parts)) == len(expected):
+                done_flag.append(True)
+
+        timer = QTimer()
+        timer.setInterval(chat.render_timer.interval())
+        timer.timeout.connect(rerender)
+        timer.start()
+        sink = buffer.push
+        done = lambda: bool(done_flag)
+    elif mode == "legacy":
+        received = []
+        emitter = LegacyEmitter()
+
+        def slot(content):
+            received.append(content)
+            chat.text_widget.setCurrentCharFormat(chat.default_char_format)
+            chat.text_widget.append(content)
+            chat.text_widget.ensureCursorVisible()
+
+        emitter.update_signal.connect(slot)
+        sink = emitter.update_signal.emit
+        done = lambda: len(received) == len(deltas)
+    else:
+        chat.streaming = True
+        reply = chat.text_widget.begin_reply()
+        chat.render_timer.start()
+        sink = chat.render_buffer.push
+        done = lambda: sum(map(len, reply.source)) == len(expected)
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    probe.start()
+    producer = threading.Thread(target=produce, args=(deltas, sink, rate))
+    producer.start()
+    run_until(done)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    producer.join()
+    probe.stop()
+    chat.streaming = False
+    window.close()
+
+    if mode == "coalesced":
+        # 渲染的原文必须和收到的 delta 完全一致，一个字符都不能少
+        assert reply.text == expected, "渲染结果和 delta 不一致"
+    return {
+        "deltas_per_sec": len(deltas) / elapsed,
+        "elapsed": elapsed,
+        "cpu": cpu,
+        "max_ui_lag_ms": probe.max_lag * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在 offscreen Qt 中测量 GUI 每秒能显示多少个 delta")
+    parser.add_argument("--deltas", type=int, default=20000)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="每秒产生多少个 delta，0 为不限速"
+    )
+    parser.add_argument(
+        "--mode", choices=["coalesced", "legacy", "full", "all"], default="all"
+    )
+    args = parser.parse_args()
+
+    app = QApplication([])
+    deltas = synthesize_deltas(args.deltas)
+    modes = ["legacy", "full", "coalesced"] if args.mode == "all" else [args.mode]
+    for mode in modes:
+        result = bench(mode, deltas, args.rate)
+        print(
+            f"{mode:<10} {result['deltas_per_sec']:10.0f} delta/s  "
+            f"耗时 {result['elapsed']:6.2f}s  CPU {result['cpu']:6.2f}s  "
+            f"界面最大卡顿 {result['max_ui_lag_ms']:7.1f}ms"
+        )
+    app.quit()
+
+
+if __name__ == "__main__":
+    main()
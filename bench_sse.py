@@ -0,0 +1,160 @@
+import argparse
+import json
+import random
+import sys
+import time
+import sse_parser
+from sse_parser import SSEParser, delta_content
+
+
+def synthesize_stream(tokens=20000, seed=0):
+    """生成一段和 deepseek-r1 回复格式相同的 SSE 字节流"""
+    rng = random.Random(seed)
+    words = ["思考", "模型", "the", " answer", " is", "\n", "，", "。", " token", "数据"]
+    events = []
+    for i in range(tokens):
+        content = "<think>" if i == 0 else rng.choice(words)
+        if i == tokens // 2:
+            content = "</think>"
+        chunk = {
+            "id": "chatcmpl-123",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "deepseek-r1:70b",
+            "system_fingerprint": "fp_ollama",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": content},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        events.append(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+    events.append(b"data: [DONE]\n\n")
+    return b"".join(events)
+
+
+def split_reads(data, min_size=1, max_size=1500, seed=0):
+    """把字节流随机切成多次网络读取，模拟事件被拆散在多个 TCP 包中"""
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(min_size, max_size)
+        chunks.append(data[pos : pos + size])
+        pos += size
+    return chunks
+
+
+def iter_content_512(chunks):
+    """Response.iter_lines() 默认以 chunk_size=512 读取，每个网络块会被再切成不超过 512 字节的小块"""
+    for chunk in chunks:
+        for pos in range(0, len(chunk), 512):
+            yield chunk[pos : pos + 512]
+
+
+def legacy_iter_lines(chunks):
+    """和 requests 的 Response.iter_lines 相同的按行切分逻辑"""
+    pending = None
+    for chunk in iter_content_512(chunks):
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def legacy_loop(chunks):
+    """原来 main.py 中的解析循环"""
+    parts = []
+    for line in legacy_iter_lines(chunks):
+        if line:
+            decoded_line = line.decode("utf-8")
+            if decoded_line.startswith("data: "):
+                decoded_line = decoded_line[6:]
+                if decoded_line == "[DONE]":
+                    break
+                try:
+                    data = json.loads(decoded_line)
+                    content = data["choices"][0]["delta"].get("content", "")
+                    if content:
+                        parts.append(content)
+                except json.JSONDecodeError:
+                    continue
+    return "".join(parts)
+
+
+def parser_loop(chunks, loads=None):
+    """使用 SSEParser 的解析循环，loads 可指定 JSON 解析函数"""
+    original = sse_parser.loads
+    if loads is not None:
+        sse_parser.loads = loads
+    try:
+        parts = []
+        parser = SSEParser()
+        for chunk in chunks:
+            for obj in parser.feed(chunk):
+                content = delta_content(obj)
+                if content:
+                    parts.append(content)
+        return "".join(parts)
+    finally:
+        sse_parser.loads = original
+
+
+def bench(name, func, chunks, repeat, events):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(chunks)
+        best = min(best, time.perf_counter() - start)
+    print(
+        f"{name:<22} {best * 1000:9.2f}ms  {best / events * 1e6:7.3f}us/事件  "
+        f"{events / best:12,.0f} 事件/s"
+    )
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 解析速度基准测试")
+    parser.add_argument("streams", nargs="*", help="录制好的原始 SSE 字节流文件，不给时自动生成")
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-read", type=int, default=1500, help="单次网络读取的最大字节数")
+    args = parser.parse_args()
+
+    if args.streams:
+        recordings = [(path, open(path, "rb").read()) for path in args.streams]
+    else:
+        recordings = [(f"synthetic-{args.tokens}", synthesize_stream(args.tokens))]
+
+    for name, data in recordings:
+        chunks = split_reads(data, max_size=args.max_read)
+        events = data.count(b"data: ")
+        print(f"\n{'='*10} {name}: {len(data):,} 字节, {events:,} 个事件, {len(chunks):,} 次读取 {'='*10}")
+        legacy, expected = bench("原来的逐行解析", legacy_loop, chunks, args.repeat, events)
+        stdlib, got = bench(
+            "SSEParser + json",
+            lambda c: parser_loop(c, lambda b: json.loads(b.decode("utf-8"))),
+            chunks,
+            args.repeat,
+            events,
+        )
+        assert got == expected, "SSEParser 的输出和原来的解析结果不一致"
+        if "orjson" in sys.modules:
+            fast, got = bench("SSEParser + orjson", parser_loop, chunks, args.repeat, events)
+            assert got == expected
+            print(f"加速比: json {legacy / stdlib:.2f}x, orjson {legacy / fast:.2f}x")
+        else:
+            print(f"加速比: {legacy / stdlib:.2f}x（安装 orjson 可以更快）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 指向一个连不上的 SSH 地址，隧道会在后台失败，不影响启动时间的测量
+DUMMY_CONFIG = """hostname=127.0.0.1
+port=1
+username=nobody
+password=nobody
+local_port=18765
+remote_host=127.0.0.1
+remote_port=11434
+model=deepseek-r1:70b
+"""
+
+PROMPT_MARKER = "请输入您的问题"
+
+GUI_SNIPPET = """
+import main_GUI
+from PyQt5.QtWidgets import QApplication
+main_GUI.load_settings()
+tunnel = main_GUI.LazyTunnel(main_GUI.config).start()
+app = QApplication([])
+chat = main_GUI.DeepSeekChat(tunnel)
+chat.show()
+app.processEvents()
+print("WINDOW_SHOWN", flush=True)
+"""
+
+
+def python_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return env
+
+
+def time_until_marker(cmd, marker, cwd):
+    """启动子进程，返回从启动到标准输出中出现 marker 的时间（秒）"""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        env=python_env(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        buffer = b""
+        while marker.encode("utf-8") not in buffer:
+            data = proc.stdout.read1(4096)
+            if not data:
+                raise RuntimeError(f"{' '.join(cmd)} 在输出 {marker!r} 之前退出了")
+            buffer += data
+        return time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def import_time(module, cwd):
+    """在全新的解释器中导入模块，返回导入耗时（秒）"""
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        env=python_env(),
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def best_of(repeat, func, *args):
+    return min(func(*args) for _ in range(repeat))
+
+
+def run(repeat, config_path):
+    workdir = tempfile.mkdtemp(prefix="deepseek_startup_")
+    try:
+        if config_path:
+            shutil.copy(config_path, os.path.join(workdir, "config.txt"))
+        else:
+            with open(os.path.join(workdir, "config.txt"), "w") as file:
+                file.write(DUMMY_CONFIG)
+        os.makedirs(os.path.join(workdir, "answers"), exist_ok=True)
+
+        results = {}
+        for module in ("main", "main_md", "main_GUI"):
+            results[f"import {module}"] = best_of(repeat, import_time, module, workdir)
+        for script in ("main.py", "main_md.py"):
+            cmd = [sys.executable, os.path.join(REPO_DIR, script)]
+            results[f"first prompt {script}"] = best_of(
+                repeat, time_until_marker, cmd, PROMPT_MARKER, workdir
+            )
+        cmd = [sys.executable, "-c", GUI_SNIPPET]
+        results["window shown main_GUI.py"] = best_of(
+            repeat, time_until_marker, cmd, "WINDOW_SHOWN", workdir
+        )
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量各个入口的导入时间和显示第一个输入提示的时间")
+    parser.add_argument("--repeat", type=int, default=5, help="每项测量取 repeat 次中的最小值")
+    parser.add_argument("--config", help="使用真实的 config.txt，默认使用连不上的占位配置")
+    parser.add_argument("--json", help="把结果保存为 JSON，便于之后对比")
+    parser.add_argument("--compare", help="和之前保存的 JSON 结果对比")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="比基线慢多少比例算作退化"
+    )
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.config)
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    regressions = []
+    print(f"\n{'='*10} 启动时间（{args.repeat} 次中的最小值）{'='*10}")
+    for name, seconds in results.items():
+        line = f"{name:<28} {seconds * 1000:8.1f}ms"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f"  基线 {baseline[name] * 1000:8.1f}ms  {change:+.0%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  <-- 退化"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+    if regressions:
+        print(f"\n启动时间退化: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
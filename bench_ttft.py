@@ -0,0 +1,73 @@
+import argparse
+import statistics
+from tunnel import create_forwarder
+from http_client import ChatHttpClient, measure_ttft
+
+
+# 读取配置文件并解析
+def read_config(file_path):
+    config = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+    return config
+
+
+def summarize(name, samples):
+    """打印一组首 token 时间的统计结果（毫秒）"""
+    ms = sorted(s * 1000 for s in samples)
+    print(
+        f"{name:<12} n={len(ms)}  mean={statistics.mean(ms):8.1f}ms  "
+        f"median={statistics.median(ms):8.1f}ms  min={ms[0]:8.1f}ms  max={ms[-1]:8.1f}ms"
+    )
+
+
+def run(http, model, rounds):
+    messages = [{"role": "user", "content": "Say this is a test"}]
+    # 先预热一次，让连接池里有一条已建立的连接
+    measure_ttft(http, messages, model, max_tokens=1)
+
+    fresh = [
+        measure_ttft(http, messages, model, fresh=True, max_tokens=1)
+        for _ in range(rounds)
+    ]
+    pooled = [measure_ttft(http, messages, model, max_tokens=1) for _ in range(rounds)]
+
+    summarize("fresh", fresh)
+    summarize("keep-alive", pooled)
+    saved = statistics.mean(fresh) - statistics.mean(pooled)
+    print(f"连接池平均节省首 token 时间: {saved * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比新建连接和 keep-alive 连接池的首 token 时间")
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument(
+        "--no-tunnel", action="store_true", help="不建立 SSH 隧道，直接访问 local_port"
+    )
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    local_port = int(config.get("local_port", 8888))
+    model = config.get("model")
+    http = ChatHttpClient.from_config(config, local_port)
+
+    if args.no_tunnel:
+        run(http, model, args.rounds)
+        return
+
+    server = create_forwarder(config)
+    try:
+        server.start()
+        run(http, model, args.rounds)
+    finally:
+        http.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
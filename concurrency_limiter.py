@@ -0,0 +1,286 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from metrics import get_metrics
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+TRAFFIC_CLASSES = (INTERACTIVE, BATCH)
+
+# 服务器明确表示过载的状态码，遇到时降低并发数，并在排队之后重试
+OVERLOAD_STATUS = (429, 503)
+# 过载重试前等待的秒数，每次翻倍
+RETRY_DELAY = 0.5
+
+
+def error_status(error):
+    """requests 的 HTTPError 和 async_client 的 ChatRequestError 中的状态码，连接错误等返回 None"""
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_overload(error):
+    """连接错误、超时、429 和 5xx 说明服务器扛不住了；其他 4xx 是请求本身的问题"""
+    status = error_status(error)
+    return status is None or status == 429 or status >= 500
+
+
+class Ticket:
+    """一个排队中的请求；异步的请求带着 future，拿到名额时在它的事件循环中唤醒"""
+
+    def __init__(self, kind, loop=None):
+        self.kind = kind
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.enqueued = time.monotonic()
+
+
+class Permit:
+    """拿到的一个并发名额，配合 with 使用；退出时把这次请求的首 token 时间或错误反馈给限流器"""
+
+    def __init__(self, limiter, kind, saturated):
+        self.limiter = limiter
+        self.kind = kind
+        self.saturated = saturated  # 拿到名额时并发数是否已经用满，只有用满时成功才加大并发数
+        self.start = time.perf_counter()
+        self.ttft = None
+        self.failed = False
+
+    def first_token(self):
+        """收到第一个 token 时调用，重复调用只记录第一次"""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+
+    def fail(self):
+        """服务器用状态码（429、5xx）而不是异常表示过载时调用，退出时按过载处理"""
+        self.failed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # GeneratorExit、CancelledError 之类（调用方提前停止读取）不算过载
+        overload = self.failed or (isinstance(exc, Exception) and is_overload(exc))
+        self.limiter.release(self, overload)
+        return False
+
+
+class AdaptiveLimiter:
+    """自适应的并发限制（AIMD），找到吞吐量最高、延迟还可以接受的并发数
+
+    以最近 window 次请求中最小的首 token 时间作为没有排队时的基准延迟：
+    并发数用满时请求成功、首 token 时间不超过基准的 tolerance 倍，并发数加 1/limit
+    （大约每一轮加一）；首 token 时间超过这个范围，或者出现连接错误、超时、429、5xx 时，
+    并发数乘以 backoff，同一段时间内只降一次。
+
+    超出并发数的请求排队等待而不是失败，交互请求排在批量请求前面。批量请求最多用 limit 个名额，
+    交互请求另外有 reserved 个保留名额，批量任务占满了也不会让交互请求一直等。
+    """
+
+    def __init__(
+        self,
+        initial=2,
+        min_limit=1,
+        max_limit=16,
+        reserved=1,
+        tolerance=2.0,
+        backoff=0.7,
+        window=50,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.reserved = reserved
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.samples = deque(maxlen=window)
+        self.active = {kind: 0 for kind in TRAFFIC_CLASSES}
+        self._waiting = {kind: deque() for kind in TRAFFIC_CLASSES}
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.queued_total = 0  # 需要排队的请求数
+        self.overloads = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """limiter_enabled 为 true 时根据 limiter_* 配置项创建，否则返回 None"""
+        if config.get("limiter_enabled", "false").lower() != "true":
+            return None
+        return cls(
+            initial=int(config.get("limiter_initial", 2)),
+            min_limit=int(config.get("limiter_min", 1)),
+            max_limit=int(config.get("limiter_max", 16)),
+            reserved=int(config.get("limiter_reserved_interactive", 1)),
+            tolerance=float(config.get("limiter_latency_tolerance", 2.0)),
+            backoff=float(config.get("limiter_backoff", 0.7)),
+        )
+
+    def _allowed(self, kind):
+        # 调用方需持有 self._cond
+        total = self.active[INTERACTIVE] + self.active[BATCH]
+        if total < int(self.limit):
+            return True
+        return kind == INTERACTIVE and self.active[INTERACTIVE] < self.reserved
+
+    def _grant(self, ticket):
+        # 调用方需持有 self._cond
+        ticket.granted = True
+        self.active[ticket.kind] += 1
+        if ticket.future is not None:
+            ticket.loop.call_soon_threadsafe(_wake, ticket.future)
+
+    def _saturated(self):
+        return self.active[INTERACTIVE] + self.active[BATCH] >= int(self.limit)
+
+    def _dispatch(self):
+        """在锁内调用：有空闲名额时先分给排队的交互请求，再分给批量请求"""
+        granted = False
+        for kind in TRAFFIC_CLASSES:
+            waiting = self._waiting[kind]
+            while waiting and self._allowed(kind):
+                self._grant(waiting.popleft())
+                granted = True
+        if granted:
+            self._cond.notify_all()
+        self._publish()
+
+    def _enqueue(self, kind, loop=None):
+        # 调用方需持有 self._cond；有空闲名额并且没有人排队时直接拿到
+        if kind not in TRAFFIC_CLASSES:
+            raise ValueError(f"未知的请求类型: {kind}，可选 {', '.join(TRAFFIC_CLASSES)}")
+        ticket = Ticket(kind, loop)
+        # 有交互请求在排队时说明保留名额也用完了，批量请求同样拿不到，只需看同类的队列
+        if not self._waiting[kind] and self._allowed(kind):
+            ticket.granted = True
+            self.active[kind] += 1
+        else:
+            self._waiting[kind].append(ticket)
+            self.queued_total += 1
+        self._publish()
+        return ticket
+
+    def acquire(self, kind=INTERACTIVE, timeout=None):
+        """等到有空闲名额时返回 Permit，timeout 秒内没有拿到时抛出 TimeoutError"""
+        with self._cond:
+            ticket = self._enqueue(kind)
+            if not self._cond.wait_for(lambda: ticket.granted, timeout):
+                self._waiting[kind].remove(ticket)
+                self._publish()
+                raise TimeoutError("等待并发名额超时")
+            return Permit(self, kind, self._saturated())
+
+    async def acquire_async(self, kind=INTERACTIVE):
+        """acquire() 的异步版本，排队时不阻塞事件循环"""
+        with self._cond:
+            ticket = self._enqueue(kind, asyncio.get_running_loop())
+            if ticket.granted:
+                return Permit(self, kind, self._saturated())
+        try:
+            await ticket.future
+        except BaseException:
+            # 排队时被取消：还没拿到名额就从队列中移除，已经拿到了就还回去
+            with self._cond:
+                if ticket.granted:
+                    self.active[kind] -= 1
+                    self._dispatch()
+                else:
+                    self._waiting[kind].remove(ticket)
+                    self._publish()
+            raise
+        with self._cond:
+            return Permit(self, kind, self._saturated())
+
+    def release(self, permit, overload=False):
+        now = time.monotonic()
+        with self._cond:
+            self.active[permit.kind] -= 1
+            if overload:
+                self.overloads += 1
+                self._decrease(now, 1.0)
+            elif permit.ttft is not None:
+                self.samples.append(permit.ttft)
+                baseline = min(self.samples)
+                if permit.ttft > baseline * self.tolerance and len(self.samples) > 1:
+                    self._decrease(now, permit.ttft)
+                elif permit.saturated and self.limit < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                    self.increases += 1
+            self._dispatch()
+
+    def _decrease(self, now, interval):
+        # 调用方需持有 self._cond；一批同时变慢的请求只算一次，interval 内不重复降低
+        if now - self._last_decrease < interval:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.decreases += 1
+
+    def _publish(self):
+        metrics = get_metrics()
+        metrics.set_gauge("limiter_limit", round(self.limit, 2))
+        metrics.set_gauge("limiter_active", self.active[INTERACTIVE] + self.active[BATCH])
+        metrics.set_gauge(
+            "limiter_queued", len(self._waiting[INTERACTIVE]) + len(self._waiting[BATCH])
+        )
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "active": dict(self.active),
+                "queued": {kind: len(queue) for kind, queue in self._waiting.items()},
+                "baseline_ttft": round(min(self.samples), 3) if self.samples else None,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "overloads": self.overloads,
+                "queued_total": self.queued_total,
+            }
+
+
+def limited(limiter, kind, produce, retries=2):
+    """排队拿到名额后逐个产出 produce() 的结果，第一个结果到达的时间作为首 token 时间反馈给限流器
+
+    服务器返回 429 / 503 并且还没有产出任何结果时，限流器降低并发数，等待一会儿重新排队再试，
+    最多 retries 次；调用方看到的是等待而不是失败。
+    """
+    for attempt in range(retries + 1):
+        started = False
+        try:
+            with limiter.acquire(kind) as permit:
+                for item in produce():
+                    started = True
+                    permit.first_token()
+                    yield item
+            return
+        except Exception as e:
+            if started or attempt == retries or error_status(e) not in OVERLOAD_STATUS:
+                raise
+        time.sleep(RETRY_DELAY * 2**attempt)
+
+
+async def limited_async(limiter, kind, produce, retries=2):
+    """limited() 的异步版本，produce() 返回异步迭代器"""
+    for attempt in range(retries + 1):
+        started = False
+        try:
+            with await limiter.acquire_async(kind) as permit:
+                async for item in produce():
+                    started = True
+                    permit.first_token()
+                    yield item
+            return
+        except Exception as e:
+            if started or attempt == retries or error_status(e) not in OVERLOAD_STATUS:
+                raise
+        await asyncio.sleep(RETRY_DELAY * 2**attempt)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,452 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from concurrency_limiter import (
+    AdaptiveLimiter,
+    BATCH,
+    INTERACTIVE,
+    OVERLOAD_STATUS,
+    RETRY_DELAY,
+    TRAFFIC_CLASSES,
+)
+from http_client import get_shared_client, close_shared_client, iter_raw_chunks
+from metrics import Histogram, LATENCY_BUCKETS, get_metrics
+from single_flight import SingleFlight
+from tunnel import LazyTunnel
+
+# 需要排队调度的接口，其余接口（比如 /v1/models）直接转发
+SCHEDULED_PATHS = ("chat/completions", "completions", "embeddings")
+
+
+# 读取配置文件并解析
+def read_config(file_path):
+    config = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+    return config
+
+
+def request_key(path, body):
+    """相同接口、相同请求体（键的顺序不同也算相同）的请求得到同一个键；请求体不是 JSON 时返回 None"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{path}\n{raw}".encode("utf-8")).hexdigest()
+
+
+class Ticket:
+    """一个排队中的请求"""
+
+    def __init__(self, client, priority):
+        self.client = client
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class FairScheduler:
+    """控制发往后端的并发数，排队的请求按优先级和客户端公平调度
+
+    优先级高的请求先获得名额；同一优先级内按客户端轮流分配，每个客户端每轮只分到一个名额，
+    一个人一次提交很多请求也不会把其他人挤在后面。同一个客户端的请求按到达顺序处理。
+    """
+
+    def __init__(self, max_concurrency=2):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self._cond = threading.Condition()
+        # priority -> (客户端的轮转顺序, 客户端 -> 排队中的 Ticket)
+        self._queues = {}
+        self.served = {}
+        self.timeouts = 0
+        self.wait_seconds = Histogram(
+            "gateway_wait_seconds", "Time a request waited in the gateway queue", LATENCY_BUCKETS
+        )
+
+    def acquire(self, client, priority=0, timeout=None):
+        """排队等待一个并发名额，timeout 秒内没有轮到时返回 False"""
+        ticket = Ticket(client, priority)
+        with self._cond:
+            order, tickets = self._queues.setdefault(priority, (deque(), {}))
+            if client not in tickets:
+                tickets[client] = deque()
+                order.append(client)
+            tickets[client].append(ticket)
+            self._dispatch()
+            if not self._cond.wait_for(lambda: ticket.granted, timeout):
+                self._remove(ticket)
+                self.timeouts += 1
+                self._publish()
+                return False
+            self.wait_seconds.observe(time.monotonic() - ticket.enqueued)
+        return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, client, priority=0, timeout=None):
+        """配合 with 使用：排队拿到名额后执行，结束时归还；超时抛出 TimeoutError"""
+        if not self.acquire(client, priority, timeout):
+            raise TimeoutError("网关排队超时")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _dispatch(self):
+        """在锁内调用：有空闲名额时按优先级和轮转顺序分配给排队的请求"""
+        granted = False
+        while self.active < self.max_concurrency and self._queues:
+            priority = max(self._queues)
+            order, tickets = self._queues[priority]
+            client = order.popleft()
+            ticket = tickets[client].popleft()
+            if tickets[client]:
+                order.append(client)
+            else:
+                del tickets[client]
+            if not order:
+                del self._queues[priority]
+            ticket.granted = True
+            self.active += 1
+            self.served[client] = self.served.get(client, 0) + 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+        self._publish()
+
+    def _remove(self, ticket):
+        order, tickets = self._queues[ticket.priority]
+        queue = tickets[ticket.client]
+        queue.remove(ticket)
+        if not queue:
+            del tickets[ticket.client]
+            order.remove(ticket.client)
+        if not order:
+            del self._queues[ticket.priority]
+
+    def queued(self):
+        """每个客户端排队中的请求数"""
+        counts = {}
+        for _, tickets in self._queues.values():
+            for client, queue in tickets.items():
+                counts[client] = counts.get(client, 0) + len(queue)
+        return counts
+
+    def _publish(self):
+        metrics = get_metrics()
+        metrics.set_gauge("gateway_active", self.active)
+        metrics.set_gauge("gateway_queued", sum(self.queued().values()))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self.active,
+                "max_concurrency": self.max_concurrency,
+                "queued": self.queued(),
+                "served": dict(self.served),
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds.summary(),
+            }
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 流式回复的每个 SSE 事件都要马上转发出去
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, error_type):
+        self.send_json(status, {"error": {"message": message, "type": error_type}})
+
+    def upstream_path(self):
+        """/v1/chat/completions -> chat/completions"""
+        path = self.path.split("?", 1)[0].strip("/")
+        if path.startswith("v1/"):
+            path = path[3:]
+        return path
+
+    def client_id(self):
+        """X-Client-Id 优先，其次是 API key，最后用来源 IP 区分客户端"""
+        client = self.headers.get("X-Client-Id")
+        if client:
+            return client
+        auth = self.headers.get("Authorization", "")
+        if auth.startswith("Bearer ") and auth[7:] not in ("", "ollama"):
+            return auth[7:]
+        return self.client_address[0]
+
+    def priority(self):
+        try:
+            return int(self.headers.get("X-Priority", 0))
+        except ValueError:
+            return 0
+
+    def traffic_class(self):
+        """X-Traffic-Class 为 interactive 或 batch；没有时按优先级推断，负的优先级算作批量请求"""
+        traffic = self.headers.get("X-Traffic-Class", "").strip().lower()
+        if traffic in TRAFFIC_CLASSES:
+            return traffic
+        return BATCH if self.priority() < 0 else INTERACTIVE
+
+    def do_GET(self):
+        path = self.upstream_path()
+        if path == "gateway/stats":
+            self.send_json(200, self.server.stats())
+        else:
+            self.forward(self.server.upstream("GET", path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.upstream_path()
+        if path not in SCHEDULED_PATHS:
+            self.forward(self.server.upstream("POST", path, body))
+            return
+        client, priority, traffic = self.client_id(), self.priority(), self.traffic_class()
+
+        def produce():
+            return self.server.scheduled(client, priority, "POST", path, body, traffic)
+
+        key = request_key(path, body)
+        single_flight = self.server.single_flight
+        if single_flight is None or key is None:
+            self.forward(produce())
+        else:
+            # 相同的请求共用一次生成，只有第一个请求排队占用后端名额
+            self.forward(single_flight.stream(key, produce))
+
+    def forward(self, parts):
+        """把 GatewayServer.upstream 产出的响应写回客户端，流式回复按到达顺序逐块转发"""
+        try:
+            status, content_type, streaming = next(parts)
+            content = None if streaming else b"".join(parts)
+        except TimeoutError as e:
+            self.send_error_json(503, str(e), "gateway_queue_timeout")
+            return
+        except requests.exceptions.RequestException as e:
+            self.send_error_json(502, f"后端请求失败: {e}", "gateway_upstream_error")
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if content is not None:
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for chunk in parts:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开，关闭后端的流，名额随之归还
+            self.close_connection = True
+        except requests.exceptions.RequestException:
+            # 后端中途断开：不发送结尾的空块，让客户端看到同样的中断
+            self.close_connection = True
+        finally:
+            parts.close()
+
+
+class GatewayServer(ThreadingHTTPServer):
+    """本地的 OpenAI 兼容网关：所有客户端共用一条 SSH 隧道，请求经 FairScheduler 排队后转发
+
+    配置了 limiter（AdaptiveLimiter）时，请求先按 interactive / batch 在 limiter 中排队，
+    所有客户端共用同一个并发数和交互请求的保留名额。
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(
+        self,
+        http,
+        scheduler,
+        host="localhost",
+        port=8000,
+        queue_timeout=300.0,
+        single_flight=None,
+        limiter=None,
+        overload_retries=2,
+    ):
+        super().__init__((host, port), GatewayHandler)
+        self.http = http
+        self.scheduler = scheduler
+        self.queue_timeout = queue_timeout
+        self.single_flight = single_flight
+        self.limiter = limiter
+        self.overload_retries = overload_retries
+        self.tunnel = None
+
+    def upstream(self, method, path, body=None):
+        """向后端发送请求：先产出 (状态码, Content-Type, 是否流式)，再产出响应体
+
+        流式回复逐块产出原始字节，读完之前一直占用节点池中的节点。
+        """
+        http = self.http
+        lease_context = http.pool.lease() if http.pool is not None else contextlib.nullcontext()
+        with lease_context as lease:
+            response = http.request(
+                method,
+                path,
+                lease=lease,
+                data=body,
+                headers={"Content-Type": "application/json"} if body is not None else None,
+                stream=True,
+            )
+            with response:
+                if lease is not None and response.status_code >= 500:
+                    lease.fail()
+                content_type = response.headers.get("Content-Type", "application/json")
+                streaming = "text/event-stream" in content_type
+                yield response.status_code, content_type, streaming
+                if not streaming:
+                    yield response.content
+                    return
+                for chunk in iter_raw_chunks(response):
+                    if lease is not None:
+                        lease.first_byte()
+                    yield chunk
+
+    def scheduled(self, client, priority, method, path, body=None, traffic=INTERACTIVE):
+        """排队拿到后端名额后再发送请求，响应读完后归还名额"""
+        if self.limiter is None:
+            with self.scheduler.slot(client, priority, self.queue_timeout):
+                yield from self.upstream(method, path, body)
+            return
+        yield from self.limited(client, priority, method, path, body, traffic)
+
+    def limited(self, client, priority, method, path, body, traffic):
+        """先在 limiter 中排队，再经过 FairScheduler；和 concurrency_limiter.limited() 一样，
+        流式回复的首块数据时间反馈给 limiter，后端返回 429 / 503 时降低并发数并重新排队"""
+        deadline = time.monotonic() + self.queue_timeout
+        for attempt in range(self.overload_retries + 1):
+            timeout = max(0.0, deadline - time.monotonic())
+            with self.limiter.acquire(traffic, timeout) as permit:
+                with self.scheduler.slot(client, priority, max(0.0, deadline - time.monotonic())):
+                    parts = self.upstream(method, path, body)
+                    try:
+                        status, content_type, streaming = next(parts)
+                        if status == 429 or status >= 500:
+                            permit.fail()
+                        retry = status in OVERLOAD_STATUS and attempt < self.overload_retries
+                        if not retry:
+                            yield status, content_type, streaming
+                            for chunk in parts:
+                                if streaming:
+                                    permit.first_token()
+                                yield chunk
+                            return
+                    finally:
+                        parts.close()
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.port}/v1"
+
+    def stats(self):
+        stats = {"scheduler": self.scheduler.stats()}
+        if self.limiter is not None:
+            stats["limiter"] = self.limiter.stats()
+        if self.single_flight is not None:
+            stats["single_flight"] = self.single_flight.stats()
+        if self.tunnel is not None:
+            stats["tunnel"] = self.tunnel.stats()
+        if self.http.pool is not None:
+            stats["backends"] = self.http.pool.stats()
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="本地的 OpenAI 兼容网关，所有人共用一条 SSH 隧道，按客户端公平排队"
+    )
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument("--host", help="监听地址，默认 gateway_host 或 localhost")
+    parser.add_argument("--port", type=int, help="监听端口，默认 gateway_port 或 8000")
+    parser.add_argument("--max-concurrency", type=int, help="同时发往后端的请求数")
+    parser.add_argument(
+        "--no-tunnel", action="store_true", help="不建立 SSH 隧道，直接访问 local_port"
+    )
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    # 网关自己总是直接连接隧道（或 local_port），api_base 是给客户端用的
+    config.pop("api_base", None)
+    local_port = int(config.get("local_port", 8888))
+    max_concurrency = args.max_concurrency or int(config.get("gateway_max_concurrency", 2))
+    # 网关的 limiter 对所有客户端生效；客户端自己的 limiter 只管各自进程内的请求
+    limiter = AdaptiveLimiter.from_config(config)
+    if limiter is not None:
+        # 后端并发数由 limiter 决定，FairScheduler 的上限要能容纳 limiter 的最大并发数和保留名额
+        max_concurrency = max(max_concurrency, limiter.max_limit + limiter.reserved)
+    # 每个并发请求都要能复用一个 keep-alive 连接
+    config["http_pool_size"] = str(max(int(config.get("http_pool_size", 4)), max_concurrency))
+
+    http = get_shared_client(config, local_port)
+    server = GatewayServer(
+        http,
+        FairScheduler(max_concurrency),
+        host=args.host or config.get("gateway_host", "localhost"),
+        port=args.port or int(config.get("gateway_port", 8000)),
+        queue_timeout=float(config.get("gateway_queue_timeout", 300)),
+        single_flight=(
+            SingleFlight() if config.get("single_flight", "true").lower() == "true" else None
+        ),
+        limiter=limiter,
+        overload_retries=int(config.get("limiter_overload_retries", 2)),
+    )
+    if not args.no_tunnel:
+        server.tunnel = LazyTunnel.from_config(config).start()
+        server.tunnel.wait()
+        print("SSH connection established!")
+    print(f"Gateway listening on {server.base_url}，后端并发上限 {max_concurrency}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats(), indent=4, ensure_ascii=False))
+        close_shared_client()
+        if server.tunnel is not None:
+            server.tunnel.stop()
+            print("SSH connection closed.")
+
+
+if __name__ == "__main__":
+    main()
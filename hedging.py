@@ -0,0 +1,307 @@
+import queue
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from backend_pool import is_backend_failure
+from metrics import get_metrics
+from sse_parser import SSEParser
+
+# 当前线程正在发送的请求用到的连接交给谁，见 watch_connections()
+_watch = threading.local()
+
+
+def _notify(connection):
+    callback = getattr(_watch, "callback", None)
+    if callback is not None:
+        callback(connection)
+
+
+class WatchedHTTPConnection(HTTPConnection):
+    """发送请求前和建立连接后把自己交给当前线程登记的回调，还没收到响应头时也能断开"""
+
+    def connect(self):
+        super().connect()
+        _notify(self)
+
+    def request(self, *args, **kwargs):
+        _notify(self)
+        return super().request(*args, **kwargs)
+
+
+class WatchedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        super().connect()
+        _notify(self)
+
+    def request(self, *args, **kwargs):
+        _notify(self)
+        return super().request(*args, **kwargs)
+
+
+class WatchedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = WatchedHTTPConnection
+
+
+class WatchedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = WatchedHTTPSConnection
+
+
+def install_connection_watch(session):
+    """让 session 的连接池使用上面的连接类；要在发送第一个请求之前调用"""
+    for prefix in ("http://", "https://"):
+        session.get_adapter(prefix).poolmanager.pool_classes_by_scheme = {
+            "http": WatchedHTTPConnectionPool,
+            "https": WatchedHTTPSConnectionPool,
+        }
+
+
+@contextmanager
+def watch_connections(callback):
+    """在 with 块中，当前线程发送请求用到的每个连接都会传给 callback(connection)"""
+    _watch.callback = callback
+    try:
+        yield
+    finally:
+        _watch.callback = None
+
+
+def shutdown_socket(sock):
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def abort_response(response):
+    """直接关闭响应底层的 socket：阻塞在读取上的线程立即返回，服务器也会看到连接断开、停止生成"""
+    connection = getattr(response.raw, "connection", None)
+    shutdown_socket(getattr(connection, "sock", None))
+
+
+class Attempt:
+    """一次流式请求，在后台线程中读取并解析，事件连同自己一起放进共享的队列"""
+
+    def __init__(self, client, messages, model, params, parser, events, start, hedge=False):
+        self.client = client
+        self.messages = messages
+        self.model = model
+        self.params = params
+        self.parser = parser
+        self.events = events
+        self.hedge = hedge
+        self.start = start  # 原始请求的开始时间，对冲请求也从这里算起
+        self.first_event = None  # 收到第一个事件的时间（相对 start，秒）
+        self.response = None
+        self.connection = None  # 还没收到响应头时正在使用的连接
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        from http_client import iter_raw_chunks
+
+        client = self.client
+        try:
+            lease_context = client.pool.lease() if client.pool is not None else nullcontext()
+            with lease_context as lease, watch_connections(self._attach):
+                try:
+                    self._read(client, lease, iter_raw_chunks)
+                except Exception:
+                    # 被取消的请求在这里中断，不算节点故障
+                    if not self.cancelled.is_set():
+                        raise
+                finally:
+                    self._detach()
+            self.events.put((self, "done", None))
+        except Exception as e:
+            self.events.put((self, "error", e))
+
+    def _attach(self, connection):
+        """连接一打开（或者复用的连接开始发送请求）就记下来，已经取消时立即断开"""
+        with self._lock:
+            self.connection = connection
+            if self.cancelled.is_set():
+                shutdown_socket(connection.sock)
+
+    def _detach(self):
+        # 连接归还给连接池之后可能被别的请求使用，不能再由 cancel() 断开
+        with self._lock:
+            self.connection = None
+
+    def _read(self, client, lease, iter_raw_chunks):
+        with client.chat_completions(
+            self.messages, self.model, lease=lease, **self.params
+        ) as response:
+            # 收到响应头以后由 abort_response 断开
+            self._detach()
+            self.response = response
+            if self.cancelled.is_set():
+                return
+            response.raise_for_status()
+            for chunk in iter_raw_chunks(response):
+                if self.cancelled.is_set():
+                    return
+                if lease is not None:
+                    lease.first_byte()
+                for event in self.parser.feed(chunk):
+                    if self.first_event is None:
+                        self.first_event = time.perf_counter() - self.start
+                    self.events.put((self, "event", event))
+            for event in self.parser.close():
+                self.events.put((self, "event", event))
+
+    def cancel(self):
+        """停止读取并断开连接，还在等待响应头的请求同样立即断开"""
+        with self._lock:
+            self.cancelled.set()
+            if self.connection is not None:
+                shutdown_socket(self.connection.sock)
+        if self.response is not None:
+            abort_response(self.response)
+
+
+class Hedger:
+    """对冲请求：首个 token 迟迟不来时向另一个节点（或另一条连接）发送同样的请求
+
+    等待时间是最近 window 次请求首个事件到达时间的 percentile 分位数（限制在
+    min_delay 和 max_delay 之间），样本不足 min_samples 个时使用 initial_delay。
+    两个请求中先产出事件的获胜，另一个立即断开连接，服务器随之停止生成；
+    还在等待响应头（比如在 Ollama 中排队）的请求也会立即断开，不会之后再占用 GPU。
+    需要先对客户端的 session 调用 install_connection_watch()。
+    """
+
+    def __init__(
+        self,
+        percentile=0.9,
+        window=100,
+        min_samples=10,
+        initial_delay=5.0,
+        min_delay=0.5,
+        max_delay=30.0,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ttfts = deque(maxlen=window)
+        self.requests = 0
+        self.fired = 0  # 发出对冲请求的次数
+        self.won = 0  # 对冲请求先产出 token 的次数
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """hedge_enabled 为 true 时根据 hedge_* 配置项创建，否则返回 None"""
+        if config.get("hedge_enabled", "false").lower() != "true":
+            return None
+        return cls(
+            percentile=float(config.get("hedge_percentile", 0.9)),
+            window=int(config.get("hedge_window", 100)),
+            min_samples=int(config.get("hedge_min_samples", 10)),
+            initial_delay=float(config.get("hedge_initial_delay", 5.0)),
+            min_delay=float(config.get("hedge_min_delay", 0.5)),
+            max_delay=float(config.get("hedge_max_delay", 30.0)),
+        )
+
+    def delay(self):
+        """发出对冲请求之前等待的秒数"""
+        with self._lock:
+            if len(self.ttfts) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(self.ttfts)
+        value = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def stream(self, client, messages, model, parser, **params):
+        """和 ChatHttpClient.stream_events 一样逐个产出事件，必要时发出对冲请求"""
+        events = queue.Queue()
+        start = time.perf_counter()
+        attempts = [Attempt(client, messages, model, params, parser, events, start)]
+        hedged = False
+        winner = None
+        finished = False
+        deadline = time.monotonic() + self.delay()
+        with self._lock:
+            self.requests += 1
+
+        def fire():
+            # 同样的请求再发一次，节点池会选择负载更低的节点；没有节点池时是另一条连接
+            # 首个事件的时间从原始请求算起，包含发出对冲请求前等待的时间，否则分位数会越来越低
+            attempts.append(
+                Attempt(client, messages, model, params, SSEParser(), events, start, hedge=True)
+            )
+            with self._lock:
+                self.fired += 1
+            get_metrics().inc("hedge_fired")
+
+        try:
+            while True:
+                timeout = None
+                if not hedged:
+                    timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    attempt, kind, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    # 首个事件在等待时间内没有到达
+                    hedged = True
+                    fire()
+                    continue
+                if winner is None and kind == "error":
+                    attempts.remove(attempt)
+                    if not hedged and is_backend_failure(item):
+                        # 还没发出对冲请求时连接失败或者 5xx，立即改发到另一个节点
+                        hedged = True
+                        fire()
+                        continue
+                    if attempts:
+                        continue
+                    raise item
+                if winner is None:
+                    winner = attempt
+                    hedged = True
+                    self._decide(winner, attempts)
+                if attempt is not winner:
+                    continue
+                if kind == "error":
+                    raise item
+                if kind == "done":
+                    finished = True
+                    parser.usage = winner.parser.usage
+                    return
+                yield item
+        finally:
+            # 输掉的请求，以及调用方提前停止读取时的所有请求，都要断开连接
+            for attempt in attempts:
+                if not (finished and attempt is winner):
+                    attempt.cancel()
+
+    def _decide(self, winner, attempts):
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+        with self._lock:
+            if winner.first_event is not None:
+                self.ttfts.append(winner.first_event)
+            if winner.hedge:
+                self.won += 1
+        if winner.hedge:
+            get_metrics().inc("hedge_won")
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "fired": self.fired,
+                "won": self.won,
+                "fire_ratio": round(self.fired / self.requests, 3) if self.requests else 0.0,
+                "win_ratio": round(self.won / self.fired, 3) if self.fired else 0.0,
+                "delay": round(delay, 3),
+            }
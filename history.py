@@ -0,0 +1,175 @@
+import re
+from think_parser import strip_think
+
+# 中日韩字符大约一个字一个 token，其他文字大约 4 个字符一个 token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+POLICIES = ("sliding_window", "pinned_system", "summarize")
+
+
+def estimate_tokens(text):
+    """粗略估计一段文本的 token 数，不依赖具体模型的分词器"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message):
+    # 每条消息额外算 4 个 token 的角色和格式开销
+    return estimate_tokens(message["content"]) + 4
+
+
+class ConversationHistory:
+    """按 token 预算管理多轮对话的消息列表
+
+    policy 可选：
+      sliding_window  超出预算时从最早的消息开始丢弃（包括 system 提示词）
+      pinned_system   system 提示词始终保留，只丢弃最早的对话轮次
+      summarize       同 pinned_system，但丢弃的轮次会被 summarizer 压缩成一条摘要
+
+    超出预算时一次性裁剪到 low_watermark * max_tokens 以下，之后的几轮只在末尾追加，
+    发给服务器的消息前缀保持不变，服务器端的 prompt 前缀缓存可以继续命中。
+
+    keep_reasoning=False 时，助手回复中的 <think> 推理部分不放进历史消息。
+    """
+
+    def __init__(
+        self,
+        max_tokens=8192,
+        policy="pinned_system",
+        system_prompt=None,
+        summarizer=None,
+        low_watermark=0.6,
+        keep_reasoning=False,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的裁剪策略: {policy}，可选: {', '.join(POLICIES)}")
+        if policy == "summarize" and summarizer is None:
+            raise ValueError("summarize 策略需要提供 summarizer")
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.summarizer = summarizer
+        self.low_watermark = low_watermark
+        self.keep_reasoning = keep_reasoning
+
+        self.system = []  # system 提示词
+        if system_prompt:
+            self.system.append({"role": "system", "content": system_prompt})
+        self.turns = []  # 完整的对话记录（user / assistant）
+        self.start = 0  # 当前窗口在 turns 中的起始位置
+        self.summary = None  # 被裁掉的轮次的摘要
+        self._tokens = []  # 与 turns 一一对应的 token 数
+        self._window_tokens = 0
+
+    @classmethod
+    def from_config(cls, config, summarizer=None):
+        """根据 config.txt 中的 history_* 配置项创建"""
+        return cls(
+            max_tokens=int(config.get("history_max_tokens", 8192)),
+            policy=config.get("history_policy", "pinned_system"),
+            system_prompt=config.get("system_prompt"),
+            summarizer=summarizer,
+            low_watermark=float(config.get("history_low_watermark", 0.6)),
+            keep_reasoning=config.get("history_keep_reasoning", "false").lower() == "true",
+        )
+
+    def add_user(self, content):
+        self._append({"role": "user", "content": content})
+
+    def add_assistant(self, content):
+        # 推理过程往往比回答长得多，之后每轮都重新发送会让 prompt 和 prefill 时间成倍增加，
+        # 默认只保留正式回答（会话存储中仍然记录完整的回复）
+        if not self.keep_reasoning:
+            content = strip_think(content)
+        self._append({"role": "assistant", "content": content})
+
+    def rollback(self):
+        """请求失败时撤销末尾还没有回复的用户消息"""
+        if len(self.turns) > self.start and self.turns[-1]["role"] == "user":
+            self.turns.pop()
+            self._window_tokens -= self._tokens.pop()
+
+    def restore(self, messages, summary=None):
+        """恢复保存的会话：messages 是之前的历史窗口中的消息，summary 是被裁掉的轮次的摘要"""
+        self.turns = []
+        self._tokens = []
+        self._window_tokens = 0
+        self.start = 0
+        self.summary = summary
+        for message in messages:
+            if message["role"] == "assistant":
+                self.add_assistant(message["content"])
+            else:
+                self._append(message)
+
+    def _append(self, message):
+        self.turns.append(message)
+        tokens = message_tokens(message)
+        self._tokens.append(tokens)
+        self._window_tokens += tokens
+
+    def _fixed(self):
+        """窗口之前固定不变的部分：system 提示词和摘要"""
+        fixed = [] if self.policy == "sliding_window" and self.start else list(self.system)
+        if self.summary:
+            fixed.append(
+                {"role": "system", "content": f"以下是之前对话的摘要：\n{self.summary}"}
+            )
+        return fixed
+
+    def prompt_tokens(self):
+        return sum(message_tokens(m) for m in self._fixed()) + self._window_tokens
+
+    def messages(self):
+        """返回本轮要发送的消息列表，必要时先按策略裁剪"""
+        if self.prompt_tokens() > self.max_tokens:
+            self._compact()
+        return self._fixed() + self.turns[self.start :]
+
+    def _compact(self):
+        fixed_tokens = sum(message_tokens(m) for m in self.system)
+        if self.summary:
+            # 给摘要预留预算，具体长度等摘要生成后才知道
+            fixed_tokens += estimate_tokens(self.summary) + 4
+        target = self.low_watermark * self.max_tokens - fixed_tokens
+
+        new_start = self.start
+        remaining = self._window_tokens
+        last = len(self.turns) - 1
+        # 至少保留最后一条消息，且窗口总是从 user 消息开始
+        while new_start < last and (
+            remaining > target or self.turns[new_start]["role"] != "user"
+        ):
+            remaining -= self._tokens[new_start]
+            new_start += 1
+        if new_start == self.start:
+            return
+
+        if self.policy == "summarize":
+            # 先生成摘要再移动窗口，摘要失败时退化为直接截断，保留上一次的摘要
+            dropped = self.turns[self.start : new_start]
+            try:
+                self.summary = self.summarizer(self.summary, dropped)
+            except Exception as e:
+                print(f"生成对话摘要失败，直接丢弃较早的消息: {e}")
+        self.start = new_start
+        self._window_tokens = remaining
+
+
+def make_model_summarizer(http, model, max_chars=2000):
+    """用模型本身来生成摘要，返回可以传给 ConversationHistory 的 summarizer"""
+
+    def summarize(previous, dropped):
+        lines = []
+        if previous:
+            lines.append(f"之前的摘要：{previous}")
+        for message in dropped:
+            role = "用户" if message["role"] == "user" else "助手"
+            lines.append(f"{role}：{message['content'][:max_chars]}")
+        prompt = (
+            "请用简洁的中文总结下面这段对话中的关键信息，"
+            "保留后续对话可能用到的事实和结论，不要超过 200 字。\n\n" + "\n".join(lines)
+        )
+        reply = "".join(http.stream_chat([{"role": "user", "content": prompt}], model))
+        return strip_think(reply)
+
+    return summarize
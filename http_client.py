@@ -0,0 +1,330 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sse_parser import SSEParser, delta_content
+from response_cache import ResponseCache, cached_stream, cache_key
+from single_flight import SingleFlight
+from backend_pool import BackendPool
+from hedging import Hedger, install_connection_watch
+from concurrency_limiter import AdaptiveLimiter, limited
+from history import message_tokens
+from metrics import get_metrics
+
+
+class ChatHttpClient:
+    """共享的 keep-alive HTTP 客户端，所有请求复用同一个连接池，避免每次都经过 SSH 隧道重新握手"""
+
+    def __init__(
+        self,
+        base_url,
+        pool_size=4,
+        connect_timeout=5.0,
+        read_timeout=300.0,
+        max_retries=2,
+        api_key="ollama",
+        hosts=1,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+
+        # 只对连接错误和 GET 的 502/503/504 重试，POST 的读错误不重试，避免重复生成
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=hosts, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+        # 可选的回复缓存，命中时按 cache_replay_delay 的间隔回放
+        self.cache = None
+        self.cache_replay_delay = 0.0
+
+        # 由 tunnel.LazyTunnel 设置，隧道重连期间请求排队等待，最多等 reconnect_timeout 秒
+        self.tunnel = None
+        self.reconnect_timeout = 120.0
+
+        # 配置了多个后端节点时，每个请求由 pool 选择节点，base_url 不再使用
+        self.pool = None
+
+        # 相同的请求同时进行时共用一次生成（比如几个标签页同时问同一个问题）
+        self.single_flight = None
+
+        # 可选的对冲请求：首个 token 迟迟不来时向另一个节点再发一次，先产出的获胜
+        self.hedge = None
+
+        # 可选的自适应并发限制，超出并发数的请求排队等待；traffic 为 interactive 或 batch
+        self.limiter = None
+        self.traffic = "interactive"
+        self.overload_retries = 2
+
+    @classmethod
+    def from_config(cls, config, local_port):
+        """根据 config.txt 中的 http_* 配置项创建客户端
+
+        配置了 api_base（比如本地网关 gateway.py 的地址）时直接访问它，不经过 SSH 隧道。
+        """
+        api_base = config.get("api_base")
+        pool = None if api_base else BackendPool.from_config(config, local_port)
+        client = cls(
+            api_base or f"http://localhost:{local_port}/v1",
+            pool_size=int(config.get("http_pool_size", 4)),
+            connect_timeout=float(config.get("http_connect_timeout", 5.0)),
+            read_timeout=float(config.get("http_read_timeout", 300.0)),
+            max_retries=int(config.get("http_max_retries", 2)),
+            # 每个后端节点是一个单独的本地端口，各自需要一个连接池
+            hosts=len(pool.backends) if pool is not None else 1,
+        )
+        client.pool = pool
+        client.session.headers.update(client_headers(config))
+        if config.get("single_flight", "true").lower() == "true":
+            client.single_flight = SingleFlight()
+        client.cache = ResponseCache.from_config(config)
+        client.hedge = Hedger.from_config(config)
+        if client.hedge is not None:
+            # 对冲请求输掉时，还没收到响应头的连接也要能立即断开
+            install_connection_watch(client.session)
+        client.limiter = AdaptiveLimiter.from_config(config)
+        client.traffic = config.get("traffic_class", "interactive")
+        client.overload_retries = int(config.get("limiter_overload_retries", 2))
+        client.cache_replay_delay = float(config.get("cache_replay_delay", 0.005))
+        client.reconnect_timeout = float(config.get("tunnel_reconnect_timeout", 120))
+        return client
+
+    def url(self, path, base_url=None):
+        return f"{base_url or self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, json=None, stream=False, **kwargs):
+        return self.request("POST", path, json=json, stream=stream, **kwargs)
+
+    def request(self, method, path, lease=None, **kwargs):
+        """发送请求；配置了后端节点池时，没有传入 lease 就临时占用一个节点直到收到响应"""
+        if self.pool is not None and lease is None:
+            with self.pool.lease() as lease:
+                response = self.request(method, path, lease=lease, **kwargs)
+                lease.first_byte()
+                if response.status_code >= 500:
+                    lease.fail()
+                return response
+        url = self.url(path, lease.backend.base_url if lease is not None else None)
+        kwargs.setdefault("timeout", self.timeout)
+        if self.tunnel is None:
+            return self.session.request(method, url, **kwargs)
+        generation = self._wait_tunnel()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            # 连接错误可能是隧道断了：让隧道立即检查，等重连完成后重发一次；
+            # 隧道没有重连过说明是服务器的问题，直接抛出
+            self.tunnel.report_failure()
+            if self._wait_tunnel() == generation:
+                raise
+            return self.session.request(method, url, **kwargs)
+
+    def _wait_tunnel(self):
+        """等待隧道重连；等不到时抛出 requests 的 ConnectionError，调用方只让这一次请求失败"""
+        try:
+            return self.tunnel.wait_connected(self.reconnect_timeout)
+        except Exception as e:
+            raise requests.exceptions.ConnectionError(f"SSH 隧道不可用: {e}") from e
+
+    def list_models(self):
+        """访问 /v1/models，返回 Response 对象"""
+        return self.get("models")
+
+    def chat_completions(self, messages, model, stream=True, lease=None, **params):
+        """发送聊天补全请求，stream=True 时返回可迭代的流式 Response"""
+        payload = {"messages": messages, "model": model, "stream": stream}
+        payload.update(params)
+        return self.request(
+            "POST", "chat/completions", lease=lease, json=payload, stream=stream
+        )
+
+    def embeddings(self, inputs, model, batch_size=32, concurrency=4):
+        """计算一组文本的向量，按 batch_size 分批、最多 concurrency 个请求同时进行，按输入顺序返回
+
+        HTTP 错误时抛出 requests 异常。
+        """
+        batches = [inputs[i : i + batch_size] for i in range(0, len(inputs), batch_size)]
+
+        def embed(batch):
+            response = self.post("embeddings", json={"model": model, "input": batch})
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            return [item["embedding"] for item in data]
+
+        if len(batches) <= 1 or concurrency <= 1:
+            results = [embed(batch) for batch in batches]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(min(concurrency, len(batches))) as executor:
+                results = list(executor.map(embed, batches))
+        return [vector for batch in results for vector in batch]
+
+    def stream_events(self, messages, model, parser=None, **params):
+        """流式聊天补全，逐个产出解析好的 JSON 事件，HTTP 错误时抛出 requests 异常
+
+        配置了 limiter 时先排队拿到并发名额；服务器返回 429 / 503 并且还没有产出任何事件时，
+        限流器降低并发数，这个请求重新排队后再试，调用方看到的是等待而不是失败。
+        """
+        parser = parser or SSEParser()
+        if self.limiter is None:
+            yield from self._route_events(messages, model, parser, **params)
+            return
+        yield from limited(
+            self.limiter,
+            self.traffic,
+            lambda: self._route_events(messages, model, parser, **params),
+            self.overload_retries,
+        )
+
+    def _route_events(self, messages, model, parser, **params):
+        if self.hedge is not None:
+            yield from self.hedge.stream(self, messages, model, parser, **params)
+            return
+        if self.pool is None:
+            yield from self._stream_events(messages, model, parser, None, **params)
+            return
+        # 整个流读完之前一直占用这个节点，这样 outstanding 才能反映节点的真实负载；
+        # 还没收到任何数据就连接失败时换一个节点再试一次
+        for attempt in range(2):
+            with self.pool.lease() as lease:
+                try:
+                    yield from self._stream_events(messages, model, parser, lease, **params)
+                    return
+                except requests.exceptions.ConnectionError:
+                    if attempt or lease.latency is not None:
+                        raise
+                    lease.fail()
+
+    def _stream_events(self, messages, model, parser, lease, **params):
+        with self.chat_completions(messages, model, lease=lease, **params) as response:
+            response.raise_for_status()
+            for chunk in iter_raw_chunks(response):
+                if lease is not None:
+                    lease.first_byte()
+                yield from parser.feed(chunk)
+            yield from parser.close()
+
+    def stream_chat(self, messages, model, **params):
+        """流式聊天补全，逐个产出非空的 delta 文本；配置了缓存时先查缓存"""
+        if self.single_flight is not None:
+            deltas = self.single_flight.stream(
+                cache_key(model, messages, params),
+                lambda: self._iter_deltas(messages, model, **params),
+            )
+        else:
+            deltas = self._iter_deltas(messages, model, **params)
+        if self.cache is not None:
+            deltas = cached_stream(
+                self.cache, deltas, model, messages, params, self.cache_replay_delay
+            )
+        yield from deltas
+
+    def _iter_deltas(self, messages, model, **params):
+        parser = SSEParser()
+        timer = get_metrics().track(sum(message_tokens(m) for m in messages))
+        try:
+            for obj in self.stream_events(messages, model, parser=parser, **params):
+                content = delta_content(obj)
+                if content:
+                    timer.token()
+                    yield content
+        except Exception:
+            timer.fail()
+            raise
+        # 最后一个事件带有 usage 时使用服务器统计的 token 数，否则按收到的 delta 计数
+        timer.finish(parser.usage)
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+
+def client_headers(config):
+    """通过网关访问时附带的客户端标识、优先级和请求类型，网关按它们公平调度和限流"""
+    if not config.get("api_base"):
+        return {}
+    import getpass
+
+    return {
+        "X-Client-Id": config.get("client_id") or getpass.getuser(),
+        "X-Priority": config.get("priority", "0"),
+        "X-Traffic-Class": config.get("traffic_class", "interactive"),
+    }
+
+
+def iter_raw_chunks(response, chunk_size=65536):
+    """按到达顺序产出响应体的原始字节，不按行切分也不逐行解码"""
+    raw = response.raw
+    if raw.chunked or not hasattr(raw, "read1"):
+        # chunked 编码时 chunk_size=None 会按服务器发送的块逐个产出
+        yield from response.iter_content(chunk_size=None)
+        return
+    # 没有 chunked 编码时用 read1，有多少数据读多少，不会等到读满或连接关闭
+    while True:
+        data = raw.read1(chunk_size, decode_content=True)
+        if not data:
+            return
+        yield data
+
+
+_shared_client = None
+
+
+def get_shared_client(config=None, local_port=8888):
+    """获取进程内共享的客户端，第一次调用时根据配置创建"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = ChatHttpClient.from_config(config or {}, local_port)
+    return _shared_client
+
+
+def close_shared_client():
+    global _shared_client
+    if _shared_client is not None:
+        _shared_client.close()
+        _shared_client = None
+
+
+def measure_ttft(client, messages, model, fresh=False, **params):
+    """测量首个 token 的到达时间（秒）。fresh=True 时每次新建连接，用于和连接池对比"""
+    payload = {"messages": messages, "model": model, "stream": True}
+    payload.update(params)
+    start = time.perf_counter()
+    if fresh:
+        response = requests.post(
+            client.url("chat/completions"),
+            json=payload,
+            headers={"Connection": "close"},
+            stream=True,
+            timeout=client.timeout,
+        )
+    else:
+        response = client.post("chat/completions", json=payload, stream=True)
+    ttft = None
+    with response:
+        response.raise_for_status()
+        # 读完整个流，连接才能放回连接池给下一次请求复用
+        for line in response.iter_lines():
+            if ttft is None and line.startswith(b"data: "):
+                ttft = time.perf_counter() - start
+    return ttft if ttft is not None else time.perf_counter() - start
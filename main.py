@@ -1,7 +1,10 @@
+import argparse
 import json
-import requests
-from sshtunnel import SSHTunnelForwarder
-from openai import OpenAI
+from history import ConversationHistory, make_model_summarizer
+from tunnel import LazyTunnel
+from session_store import SessionStore, TurnTimer
+from think_parser import ThinkParser
+import metrics
 
 
 # 读取配置文件并解析
@@ -17,18 +20,33 @@ def read_config(file_path):
     return config
 
 
-# 使用配置文件
-config = read_config("config.txt")
+# 配置信息在 main() 中通过 load_settings() 读取，导入模块时不读文件
+config = {}
+hostname = None
+port = 22
+username = None
+password = None
+local_port = 8888
+remote_host = None
+remote_port = 11434
+model = None
 
-# 获取配置信息
-hostname = config.get("hostname")
-port = int(config.get("port", 22))  # 默认端口为22
-username = config.get("username")
-password = config.get("password")
-local_port = int(config.get("local_port", 8888))
-remote_host = config.get("remote_host")
-remote_port = int(config.get("remote_port", 11434))
-model = config.get("model")
+
+def load_settings(file_path="config.txt"):
+    """读取配置文件并设置模块中的配置信息"""
+    global config, hostname, port, username, password
+    global local_port, remote_host, remote_port, model
+    config = read_config(file_path)
+
+    # 获取配置信息
+    hostname = config.get("hostname")
+    port = int(config.get("port", 22))  # 默认端口为22
+    username = config.get("username")
+    password = config.get("password")
+    local_port = int(config.get("local_port", 8888))
+    remote_host = config.get("remote_host")
+    remote_port = int(config.get("remote_port", 11434))
+    model = config.get("model")
 
 
 def custom_converter(o):
@@ -56,122 +74,171 @@ def get_user_input():
     return user_input if user_input != "" else None
 
 
-def stream_chat_completion(client, messages):
-    """流式获取聊天补全的回复"""
+# 终端颜色：推理过程显示为灰色
+GRAY = "\033[90m"
+RESET = "\033[0m"
+
+
+def stream_chat_completion(http, messages, timer=None):
+    """流式获取聊天补全的回复，返回完整的回复文本，请求失败时返回 None"""
+    from requests.exceptions import RequestException
+
+    def show(text):
+        print(text, end="", flush=True)
+
+    def on_state(in_think):
+        # 推理过程用灰色显示，和正式回答区分开
+        show(GRAY if in_think else RESET)
+
+    parts = []
+    parser = ThinkParser(on_think=show, on_answer=show, on_state=on_state)
+    deltas = http.stream_chat(messages, model)
+    if timer is not None:
+        deltas = timer.wrap(deltas)
     try:
-        response = requests.post(
-            f"http://localhost:{local_port}/v1/chat/completions",
-            json={
-                "messages": messages,
-                "model": model,
-                "stream": True,
-            },
-            stream=True,
-        )
-        response.raise_for_status()  # 检查 HTTP 状态码是否为 200
-    except requests.exceptions.RequestException as e:
-        print(f"API 请求失败: {e}")
-        return
-
-    # for line in response.iter_lines():
-    #     if line:
-    #         decoded_line = line.decode("utf-8")
-    #         print(f"Raw Line: {decoded_line}")  # 打印原始行
-    #         if decoded_line.startswith("data: "):
-    #             decoded_line = decoded_line[6:]
-    #             if decoded_line == "[DONE]":
-    #                 print("Stream completed.")  # 打印流完成标志
-    #                 break
-    #             try:
-    #                 data = json.loads(decoded_line)
-    #                 print(f"Parsed Data: {data}")  # 打印解析后的数据
-    #                 content = data["choices"][0]["delta"].get("content", "")
-    #                 print(content, end="", flush=True)
-    #             except json.JSONDecodeError:
-    #                 print("JSON Decode Error")  # 打印 JSON 解析错误
-    #                 continue
-
-    ## 只打印聊天回复，不打印调试信息
-    for line in response.iter_lines():
-        if line:
-            decoded_line = line.decode("utf-8")
-            if decoded_line.startswith("data: "):
-                decoded_line = decoded_line[6:]
-                if decoded_line == "[DONE]":
-                    break
-                try:
-                    data = json.loads(decoded_line)
-                    content = data["choices"][0]["delta"].get("content", "")
-                    if content:  # 只有在内容存在时才输出
-                        print(content, end="", flush=True)
-                except json.JSONDecodeError:
-                    continue
-    print("\n")  # 打印换行符以确保格式正确
+        # 只打印聊天回复，SSE 的解析由 sse_parser 完成
+        for content in deltas:
+            parser.feed(content)
+            parts.append(content)
+        parser.close()
+    except RequestException as e:
+        print(f"{RESET}API 请求失败: {e}")
+        return None
+    print(f"{RESET}\n")  # 打印换行符以确保格式正确
+    return "".join(parts)
+
+
+def wait_for_tunnel(tunnel):
+    """等待后台的SSH隧道建立完成，打印端口转发的检查结果，成功时返回共享的 HTTP 客户端"""
+    print(f"Checking port forwarding by accessing localhost:{local_port}/v1/models")
+    try:
+        tunnel.wait()
+    except Exception as e:
+        print(f"Error accessing DeepSeek API via port forwarding: {e}")
+        return None
+    print("SSH connection established!")
+    print("Port forwarding is working, and DeepSeek API is accessible.")
+    # 模型列表在 model_catalog_ttl_hours 内从本地的模型目录读取，python test_deepseek_information.py 刷新
+    pretty_print("Supported Models (cached)" if tunnel.models_cached else "Supported Models", tunnel.models)
+
+    # 所有请求共享同一个 keep-alive 连接池
+    from http_client import get_shared_client
+
+    return get_shared_client(config, local_port)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="在终端中和 DeepSeek 对话")
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="latest",
+        help="继续之前保存的会话，不指定 id 时继续最近的会话（python session_store.py list 查看）",
+    )
+    return parser.parse_args()
 
 
 def main():
-    # 设置SSH隧道转发
-    server = SSHTunnelForwarder(
-        (hostname, port),
-        ssh_username=username,
-        ssh_password=password,
-        remote_bind_address=(remote_host, remote_port),
-        local_bind_address=("localhost", local_port),
-    )
+    args = parse_args()
+    load_settings()
+    # 每轮问答都记录到会话存储中，之后可以继续或导出为 Markdown
+    store = SessionStore.from_config(config)
+    session = None
+
+    # 在后台线程中建立SSH隧道，不用等连接建立就可以先输入问题
+    tunnel = LazyTunnel.from_config(config).start()
+    # 配置了 metrics_port 时提供 /metrics 端点
+    metrics.start_from_config(config)
+    print("Connecting to SSH server in the background...")
+    http = None
+    retriever = None
 
     try:
-        # 连接到SSH服务器并启动隧道
-        server.start()
-        print("SSH connection established!")
-
-        # 检查端口转发是否正常工作
-        try:
-            print(
-                f"Checking port forwarding by accessing localhost:{local_port}/v1/models"
-            )
-            response = requests.get(f"http://localhost:{local_port}/v1/models")
-            if response.status_code == 200:
-                print("Port forwarding is working, and DeepSeek API is accessible.")
-                pretty_print("Supported Models", response.json())
-            else:
-                print(
-                    f"Failed to access DeepSeek API via port forwarding, Status code: {response.status_code}"
-                )
-                return  # 如果无法访问，提前退出程序
-        except Exception as e:
-            print(f"Error accessing DeepSeek API via port forwarding: {e}")
-            return  # 如果发生连接错误，提前退出程序
-
-        # 连接到OpenAI客户端实例
-        client = OpenAI(
-            base_url=f"http://localhost:{local_port}/v1/",  # 使用本地端口作为代理
-            api_key="ollama",  # 必传参数
-        )
-
-        messages = []
-
         while True:
             # 获取用户输入的问题
             user_input = get_user_input()
             if user_input is None:
                 break
 
-            # 添加用户输入到消息列表中
-            messages.append({"role": "user", "content": user_input})
+            if http is None:
+                # 第一次提问时才等待隧道建立完成
+                http = wait_for_tunnel(tunnel)
+                if http is None:
+                    return  # 如果无法访问，提前退出程序
+
+                # 按 token 预算管理多轮对话的历史消息
+                summarizer = None
+                if config.get("history_policy") == "summarize":
+                    summarizer = make_model_summarizer(http, model)
+                history = ConversationHistory.from_config(config, summarizer)
+                # 配置了 embedding_model 时从本地向量索引中检索相关内容，只在用到时导入 NumPy
+                if config.get("embedding_model"):
+                    from vector_index import Retriever
+
+                    retriever = Retriever.from_config(config, http)
+                if store is not None:
+                    session = store.open(args.resume, model)
+                    if session.messages:
+                        session.restore(history)
+                        print(f"继续会话 {session.id}: {session.title}（加载了 {len(session.messages)} 条消息）")
+
+            # 添加用户输入到历史消息中
+            history.add_user(user_input)
 
             # 发送聊天补全请求
             print(f"Thinking...\n{'='*10} DeepSeek 回复 {'='*10}\n")
-            stream_chat_completion(client, messages)
+            messages = history.messages()
+            prompt = messages
+            if retriever is not None:
+                # 检索到的内容只放进这轮请求，不写入历史，之后的轮次不用再为它付 prefill 的开销
+                try:
+                    prompt = retriever.augment(messages, user_input)
+                except Exception as e:
+                    print(f"检索失败，不附加本地资料: {e}")
+            timer = TurnTimer()
+            assistant_reply = stream_chat_completion(http, prompt, timer)
             print(f"{'='*30}\n")
 
-            # 添加DeepSeek的回复到消息列表中（已经在stream_chat_completion中处理）
-            # messages.append({"role": "assistant", "content": assistant_reply})
+            # 添加DeepSeek的回复到历史消息中，请求失败时撤销这次提问
+            if assistant_reply:
+                history.add_assistant(assistant_reply)
+                if session is not None:
+                    session.add_exchange(user_input, assistant_reply, prompt, timer, model)
+                    session.checkpoint(history)
+            else:
+                history.rollback()
+
+        # 打印回复缓存的命中统计
+        if http is not None and http.cache is not None:
+            pretty_print("Response Cache", http.cache.stats())
+        # 打印隧道的在线时间和重连次数
+        if http is not None:
+            pretty_print("SSH Tunnel", tunnel.stats())
+        # 配置了多个后端节点时打印各节点的负载和健康状态
+        if http is not None and http.pool is not None:
+            pretty_print("Backends", http.pool.stats())
+        # 开启了对冲请求时打印发出和获胜的次数
+        if http is not None and http.hedge is not None:
+            pretty_print("Hedged Requests", http.hedge.stats())
+        # 开启了自适应并发限制时打印当前的并发数和排队情况
+        if http is not None and http.limiter is not None:
+            pretty_print("Concurrency Limiter", http.limiter.stats())
+        # 打印请求的延迟和吞吐量统计，并按配置写出 JSON / Prometheus 文件
+        if http is not None:
+            pretty_print("Request Metrics", metrics.write_files(config))
 
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
-        # 关闭SSH连接
-        server.stop()
+        # 关闭连接池和SSH连接
+        from http_client import close_shared_client
+
+        close_shared_client()
+        if store is not None:
+            store.close()
+        if retriever is not None:
+            retriever.close()
+        tunnel.stop()
         print("SSH connection closed.")
 
 
@@ -1,7 +1,9 @@
 import json
-import requests
-from sshtunnel import SSHTunnelForwarder
-from openai import OpenAI
+from history import ConversationHistory, make_model_summarizer
+from tunnel import LazyTunnel
+from markdown_view import MarkdownView
+from session_store import SessionStore, TurnTimer
+import metrics
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -10,11 +12,12 @@ from PyQt5.QtWidgets import (
     QHBoxLayout,
     QLineEdit,
     QPushButton,
-    QTextEdit,
+    QTabWidget,
 )
 from PyQt5.QtGui import QFont, QColor, QTextCharFormat
-from PyQt5.QtCore import Qt, pyqtSignal, QThread
+from PyQt5.QtCore import pyqtSignal, QTimer, QThreadPool, QRunnable
 import threading
+from collections import deque
 
 
 # 读取配置文件并解析
@@ -29,17 +32,33 @@ def read_config(file_path):
     return config
 
 
-# 使用配置文件
-config = read_config("config.txt")
+# 配置信息在 main() 中通过 load_settings() 读取，导入模块时不读文件
+config = {}
+hostname = None
+port = 22
+username = None
+password = None
+local_port = 8888
+remote_host = None
+remote_port = 11434
+model = None
 
-# 获取配置信息
-hostname = config.get("hostname")
-port = int(config.get("port", 22))
-username = config.get("username")
-password = config.get("password")
-local_port = int(config.get("local_port", 8888))
-remote_host = config.get("remote_host")
-remote_port = int(config.get("remote_port", 11434))
+
+def load_settings(file_path="config.txt"):
+    """读取配置文件并设置模块中的配置信息"""
+    global config, hostname, port, username, password
+    global local_port, remote_host, remote_port, model
+    config = read_config(file_path)
+
+    # 获取配置信息
+    hostname = config.get("hostname")
+    port = int(config.get("port", 22))
+    username = config.get("username")
+    password = config.get("password")
+    local_port = int(config.get("local_port", 8888))
+    remote_host = config.get("remote_host")
+    remote_port = int(config.get("remote_port", 11434))
+    model = config.get("model")
 
 
 def custom_converter(o):
@@ -58,15 +77,226 @@ def pretty_print(title, data):
     print(f"{'='*30}\n")
 
 
-class DeepSeekChat(QMainWindow):
-    update_signal = pyqtSignal(str)  # 定义一个信号传递字符串
+class RenderBuffer:
+    """工作线程写入、界面线程定时取出的文本缓冲区，两次刷新之间到达的 delta 合并成一次插入"""
 
     def __init__(self):
+        self._parts = []
+        self._lock = threading.Lock()
+
+    def push(self, text):
+        with self._lock:
+            self._parts.append(text)
+
+    def drain(self):
+        """取出并清空缓冲区中的全部文本"""
+        with self._lock:
+            parts, self._parts = self._parts, []
+        return "".join(parts)
+
+
+class ChatJob(QRunnable):
+    """线程池中执行的一次对话请求"""
+
+    def __init__(self, tab):
         super().__init__()
+        self.tab = tab
+
+    def run(self):
+        self.tab.run_chat()
+
+
+class ConversationTab(QWidget):
+    """一个标签页中的对话：有自己的历史消息、显示缓冲区和待发送的问题队列
+
+    同一个标签页中的问题按顺序一个一个发送，前一个回复结束后才发送下一个，
+    输出不会交错；不同标签页的请求在共享的线程池中并行执行。
+    """
+
+    finished_signal = pyqtSignal()  # 工作线程完成一次回复后通知界面线程
+
+    def __init__(self, tunnel, pool, parent=None, store=None):
+        super().__init__(parent)
+        self.tunnel = tunnel
+        self.pool = pool
+        self.pending = deque()  # 还没轮到发送的问题
+        self.closed = False
+        # 每个标签页是会话存储中的一个会话，第一轮问答成功后才创建
+        self.store = store
+        self.session = None
+
+        # 按 token 预算管理多轮对话的历史消息
+        summarizer = None
+        if config.get("history_policy") == "summarize":
+            summarizer = summarize_history
+        self.history = ConversationHistory.from_config(config, summarizer)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+        # 回复按 Markdown 增量渲染，推理过程可以折叠
+        self.text_widget = MarkdownView(
+            self, collapse_think=config.get("gui_collapse_think", "true").lower() == "true"
+        )
+        self.text_widget.setFont(QFont("Arial", 14))
+        layout.addWidget(self.text_widget)
+
+        # 定义不同角色的颜色
+        self.user_char_format = QTextCharFormat()
+        self.user_char_format.setForeground(QColor("blue"))
+        self.deepseek_char_format = QTextCharFormat()
+        self.deepseek_char_format.setForeground(QColor("green"))
+        self.default_char_format = QTextCharFormat()
+        self.default_char_format.setForeground(QColor("black"))
+
+        # 工作线程把 delta 写进缓冲区，界面线程按固定帧率一次性插入到文档末尾，
+        # 不再每个 delta 都触发一次信号和整个文档的重新排版
+        self.render_buffer = RenderBuffer()
+        self.streaming = False
+        self.render_timer = QTimer(self)
+        self.render_timer.setInterval(int(1000 / float(config.get("gui_fps", 30))))
+        self.render_timer.timeout.connect(self.flush_render)
+        self.finished_signal.connect(self.on_finished)
+
+    @property
+    def busy(self):
+        return self.streaming or bool(self.pending)
+
+    def submit(self, user_input):
+        """提交一个问题，正在回复时先排队，等当前回复结束后再发送"""
+        self.pending.append(user_input)
+        self.start_next()
+
+    def start_next(self):
+        # streaming 只在界面线程中设置和清除，正在回复时不会启动第二个请求
+        if self.streaming or self.closed or not self.pending:
+            return
+        user_input = self.pending.popleft()
+        self.history.add_user(user_input)
+        self.flush_render()  # 先把上一次回复中还没显示的内容显示出来
+
+        # 显示用户输入的消息，并加上“我：”前缀
+        self.text_widget.setCurrentCharFormat(self.user_char_format)
+        self.text_widget.append(f"我: {user_input}\n")
+
+        # 立即显示 Deepseek 提示
+        self.text_widget.setCurrentCharFormat(self.deepseek_char_format)
+        self.text_widget.append("Deepseek:")
+        self.text_widget.setCurrentCharFormat(self.default_char_format)
+        self.text_widget.begin_reply()
+
+        # 发送聊天补全请求
+        print(f"Thinking...\n{'='*10} DeepSeek 回复 {'='*10}\n")
+        self.streaming = True
+        self.render_timer.start()
+        self.pool.start(ChatJob(self))
+
+    def on_finished(self):
+        # 工作线程在发出信号之前已经写完缓冲区，这里清除 streaming 后显示剩下的内容并结束这次回复
+        self.streaming = False
+        self.flush_render()
+        self.start_next()
+
+    def close_tab(self):
+        """标签页被关闭：丢弃排队的问题，正在进行的回复在下一个 delta 到达时停止"""
+        self.closed = True
+        self.pending.clear()
+        self.render_timer.stop()
+
+    def run_chat(self):
+        """工作线程：等待隧道建立完成后再发送请求，裁剪历史消息也在这里完成"""
+        try:
+            self.tunnel.wait()
+            from http_client import get_shared_client
+
+            http = get_shared_client(config, local_port)
+            self.stream_chat_completion(http, self.history.messages())
+        except Exception as e:
+            self.history.rollback()
+            self.render_buffer.push(f"\nAPI 请求失败: {e}\n")
+        finally:
+            if not self.closed:
+                self.finished_signal.emit()
+
+    def stream_chat_completion(self, http, messages):
+        """流式获取聊天补全的回复，每个 delta 原样写入缓冲区，由界面线程定时显示"""
+        reply_parts = []  # 完整的回复，结束后加入历史消息
+        timer = TurnTimer()
+        for delta_content in timer.wrap(http.stream_chat(messages, model)):
+            if self.closed:
+                return
+            reply_parts.append(delta_content)
+            self.render_buffer.push(delta_content)
+        reply = "".join(reply_parts)
+        self.history.add_assistant(reply)
+        if self.store is not None:
+            if self.session is None:
+                self.session = self.store.create(model)
+            # 发送的消息以这次的提问结尾
+            self.session.add_exchange(messages[-1]["content"], reply, messages, timer, model)
+            self.session.checkpoint(self.history)
+
+    def flush_render(self):
+        """把缓冲区中积累的文本插入到文档末尾，在界面线程中由 render_timer 定时调用"""
+        # streaming 由 on_finished 在界面线程中清除，那时工作线程已经写完缓冲区，不会漏掉最后一段
+        finished = not self.streaming
+        text = self.render_buffer.drain()
+        if text:
+            # 只有原本就在最底部时才自动滚动，用户往上翻看时不打扰
+            scrollbar = self.text_widget.verticalScrollBar()
+            at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+            self.text_widget.feed(text)
+            if at_bottom:
+                scrollbar.setValue(scrollbar.maximum())
+        if finished:
+            # 回复结束并且都显示完了，停止定时器，空闲时不占用 CPU
+            self.render_timer.stop()
+            self.text_widget.end_reply()
+
+
+def summarize_history(previous, dropped):
+    """用模型压缩被裁掉的历史消息，在工作线程中调用"""
+    from http_client import get_shared_client
+
+    http = get_shared_client(config, local_port)
+    return make_model_summarizer(http, model)(previous, dropped)
+
+
+class DeepSeekChat(QMainWindow):
+    status_signal = pyqtSignal(str)  # 隧道连接状态变化时更新窗口标题
+
+    def __init__(self, tunnel, store=None):
+        super().__init__()
+        self.tunnel = tunnel
+        self.store = store
+        # 所有标签页共用一个有上限的线程池，不再每条消息新建一个线程
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(int(config.get("gui_max_workers", 4)))
+        self.tab_count = 0
         self.initUI()
-        self.messages = []
-        self.update_signal.connect(self.append_to_text_widget)  # 连接信号到槽
-        self.content_accumulator = ""  # 初始化一个空字符串用于累积内容
+        self.status_signal.connect(self.setWindowTitle)
+        tunnel.listeners.append(self.on_tunnel_state)
+
+        # 窗口先显示出来，隧道在后台建立，建立完成后更新标题
+        if not tunnel.ready:
+            self.setWindowTitle("DeepSeek Chat (正在连接...)")
+            threading.Thread(target=self.watch_tunnel, daemon=True).start()
+
+    def watch_tunnel(self):
+        try:
+            self.tunnel.wait()
+            print("SSH connection established!")
+            self.status_signal.emit("DeepSeek Chat")
+        except Exception as e:
+            print(f"Error accessing DeepSeek API via port forwarding: {e}")
+            self.status_signal.emit(f"DeepSeek Chat (连接失败: {e})")
+
+    def on_tunnel_state(self, state):
+        """隧道断开和重连成功时更新标题，在隧道的后台线程中调用"""
+        if state == "reconnecting":
+            self.status_signal.emit("DeepSeek Chat (连接断开，正在重连...)")
+        elif self.tunnel.reconnects:
+            self.status_signal.emit("DeepSeek Chat")
 
     def initUI(self):
         self.setWindowTitle("DeepSeek Chat")
@@ -80,19 +310,12 @@ class DeepSeekChat(QMainWindow):
         self.layout = QVBoxLayout()
         self.central_widget.setLayout(self.layout)
 
-        # 创建输出区域
-        self.text_widget = QTextEdit(self)
-        self.text_widget.setReadOnly(True)
-        self.text_widget.setFont(QFont("Arial", 14))
-        self.layout.addWidget(self.text_widget)
-
-        # 定义不同角色的颜色
-        self.user_char_format = QTextCharFormat()
-        self.user_char_format.setForeground(QColor("blue"))
-        self.deepseek_char_format = QTextCharFormat()
-        self.deepseek_char_format.setForeground(QColor("green"))
-        self.default_char_format = QTextCharFormat()
-        self.default_char_format.setForeground(QColor("black"))
+        # 每个标签页是一个独立的对话
+        self.tabs = QTabWidget(self)
+        self.tabs.setTabsClosable(True)
+        self.tabs.tabCloseRequested.connect(self.close_tab)
+        self.layout.addWidget(self.tabs)
+        self.new_tab()
 
         # 创建输入区域
         self.input_frame = QWidget(self)
@@ -109,6 +332,11 @@ class DeepSeekChat(QMainWindow):
         self.send_button.clicked.connect(self.on_send)
         self.input_layout.addWidget(self.send_button)
 
+        self.new_tab_button = QPushButton("新对话", self)
+        self.new_tab_button.setFont(QFont("Arial", 14))
+        self.new_tab_button.clicked.connect(self.new_tab)
+        self.input_layout.addWidget(self.new_tab_button)
+
         self.exit_button = QPushButton("退出", self)
         self.exit_button.setFont(QFont("Arial", 14))
         self.exit_button.clicked.connect(self.on_exit)
@@ -116,151 +344,70 @@ class DeepSeekChat(QMainWindow):
 
         self.layout.addWidget(self.input_frame)
 
+    def new_tab(self):
+        self.tab_count += 1
+        tab = ConversationTab(self.tunnel, self.pool, self, self.store)
+        index = self.tabs.addTab(tab, f"对话 {self.tab_count}")
+        self.tabs.setCurrentIndex(index)
+        return tab
+
+    def current_tab(self):
+        return self.tabs.currentWidget()
+
+    def close_tab(self, index):
+        tab = self.tabs.widget(index)
+        tab.close_tab()
+        self.tabs.removeTab(index)
+        tab.deleteLater()
+        if self.tabs.count() == 0:
+            self.new_tab()
+
     def on_send(self):
         user_input = self.entry.text().strip()
         if not user_input:
             return
 
-        self.messages.append({"role": "user", "content": user_input})
-
-        # 显示用户输入的消息，并加上“我：”前缀
-        self.text_widget.setCurrentCharFormat(self.user_char_format)
-        self.text_widget.append(f"我: {user_input}\n")
-
         # 清空输入框
         self.entry.clear()
-
-        # 立即显示 Deepseek 提示
-        self.text_widget.setCurrentCharFormat(self.deepseek_char_format)
-        self.text_widget.append("Deepseek:\n")
-        self.text_widget.setCurrentCharFormat(self.default_char_format)
-
-        # 发送聊天补全请求
-        print(f"Thinking...\n{'='*10} DeepSeek 回复 {'='*10}\n")
-        threading.Thread(
-            target=self.stream_chat_completion,
-            args=(client, self.messages),
-        ).start()
+        self.current_tab().submit(user_input)
 
     def on_exit(self):
         self.close()
 
-    def stream_chat_completion(self, client, messages):
-        """流式获取聊天补全的回复"""
-        response = requests.post(
-            f"http://localhost:{local_port}/v1/chat/completions",
-            json={"messages": messages, "model": "deepseek-r1:70b", "stream": True},
-            stream=True,
-        )
-        think_part = ""  # 用于存储 think 部分的内容
-        normal_part = ""  # 用于存储正常回复内容
-        is_think = True
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode("utf-8")
-                if decoded_line.startswith("data: "):
-                    decoded_line = decoded_line[6:]
-                    if decoded_line == "[DONE]":
-                        self.update_signal.emit(f"{normal_part}")  # 输出正常部分
-                    try:
-                        data = json.loads(decoded_line)
-                        delta_content = data["choices"][0]["delta"].get("content", "")
-
-                        # 如果是think部分，累积think内容
-
-                        if "<think>" in delta_content:
-                            is_think = True
-                            # self.update_signal.emit(f"<think>")
-                        if is_think:
-                            if "\n" in delta_content:
-                                None
-                            else:
-                                think_part += delta_content  # 累积 think 部分
-                        else:
-                            if "\n" in delta_content:
-                                None
-                            else:
-                                normal_part += delta_content  # 累积正常回复部分
-                        if "</think>" in delta_content:
-                            is_think = False
-                            self.update_signal.emit(
-                                f"{think_part}"
-                            )  # 输出带think标签的内容
-                            # self.update_signal.emit(f"</think>")  # 输出think标签
-                            think_part = ""  # 清空think部分
-
-                        # 如果正常回复部分包含换行符，或者think部分结束了，就输出正常回复
-                        if "\n" in delta_content and is_think:
-                            self.update_signal.emit(
-                                f"{think_part}"
-                            )  # 输出带think标签的内容
-                            think_part = ""  # 清空think部分
-                        if "\n" in delta_content and not is_think:
-                            self.update_signal.emit(f"{normal_part}")  # 输出正常部分
-                            normal_part = ""  # 清空正常部分
-
-                    except json.JSONDecodeError:
-                        continue
-        # print("\n")  # 打印换行符以确保格式正确
-
-    def append_to_text_widget(self, content):
-        """更新 QTextEdit 内容的方法，在主线程中执行"""
-        self.text_widget.setCurrentCharFormat(self.default_char_format)
-
-        # 将新的内容追加到已有内容后
-        self.text_widget.append(content)
-        self.text_widget.ensureCursorVisible()
+    def closeEvent(self, event):
+        # 关闭窗口时让所有标签页停止接收，线程池中的任务在下一个 delta 到达时结束
+        for index in range(self.tabs.count()):
+            self.tabs.widget(index).close_tab()
+        super().closeEvent(event)
 
 
 def main():
-    # 设置SSH隧道转发
-    server = SSHTunnelForwarder(
-        (hostname, port),
-        ssh_username=username,
-        ssh_password=password,
-        remote_bind_address=(remote_host, remote_port),
-        local_bind_address=("localhost", local_port),
-    )
+    load_settings()
 
-    try:
-        # 连接到SSH服务器并启动隧道
-        server.start()
-        print("SSH connection established!")
-
-        # 检查端口转发是否正常工作
-        try:
-            print(
-                f"Checking port forwarding by accessing localhost:{local_port}/v1/models"
-            )
-            response = requests.get(f"http://localhost:{local_port}/v1/models")
-            if response.status_code == 200:
-                print("Port forwarding is working, and DeepSeek API is accessible.")
-            else:
-                print(
-                    f"Failed to access DeepSeek API via port forwarding, Status code: {response.status_code}"
-                )
-                return
-        except Exception as e:
-            print(f"Error accessing DeepSeek API via port forwarding: {e}")
-            return
-
-        # 连接到OpenAI客户端实例
-        global client
-        client = OpenAI(
-            base_url=f"http://localhost:{local_port}/v1/",  # 使用本地端口作为代理
-            api_key="ollama",  # 必传参数
-        )
+    # SSH隧道在后台线程中建立，窗口不用等连接完成就能显示
+    tunnel = LazyTunnel.from_config(config).start()
+    # 配置了 metrics_port 时提供 /metrics 端点
+    metrics.start_from_config(config)
+    store = SessionStore.from_config(config)
 
+    try:
         app = QApplication([])
-        chat = DeepSeekChat()
+        chat = DeepSeekChat(tunnel, store)
         chat.show()
         app.exec_()
+        # 按配置写出请求的延迟和吞吐量统计
+        metrics.write_files(config)
 
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
-        # 关闭SSH连接
-        server.stop()
+        # 关闭连接池和SSH连接
+        from http_client import close_shared_client
+
+        close_shared_client()
+        if store is not None:
+            store.close()
+        tunnel.stop()
         print("SSH connection closed.")
 
 
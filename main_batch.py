@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from tunnel import LazyTunnel
+from async_client import RoutedChatClient
+import metrics
+
+
+# 读取配置文件并解析
+def read_config(file_path):
+    config = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+    return config
+
+
+def read_prompts(file):
+    """逐行读取 JSONL，每行可以是 {"prompt": ...} 或 {"messages": [...]}
+
+    格式不对的行产出 {"id", "error"}（没有 messages），由 run_batch 直接写成一条失败记录，
+    不会中断整个批次。
+    """
+    for index, line in enumerate(file):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield index, {"id": index, "error": f"无效的 JSON: {e}"}
+            continue
+        if not isinstance(item, dict) or ("messages" not in item and "prompt" not in item):
+            item_id = item.get("id", index) if isinstance(item, dict) else index
+            yield index, {"id": item_id, "error": "缺少 prompt 或 messages 字段"}
+            continue
+        if "messages" not in item:
+            item["messages"] = [{"role": "user", "content": item.pop("prompt")}]
+        item.setdefault("id", index)
+        yield index, item
+
+
+class ResultWriter:
+    """把结果写入输出 JSONL，order 为 input 时按输入顺序输出，completion 时谁先完成先输出"""
+
+    def __init__(self, file, order="completion"):
+        self.file = file
+        self.order = order
+        self.pending = {}  # 按输入顺序输出时，暂存还不能输出的结果
+        self.next_index = 0
+        self.done = 0
+        self.failed = 0
+
+    def write(self, index, record):
+        self.done += 1
+        if record.get("error"):
+            self.failed += 1
+        if self.order == "completion":
+            self._emit(record)
+            return
+        self._push(index, record)
+
+    def skip(self, index):
+        """空行没有结果，按输入顺序输出时需要跳过它的序号"""
+        if self.order == "input":
+            self._push(index, None)
+
+    def _push(self, index, record):
+        self.pending[index] = record
+        while self.next_index in self.pending:
+            record = self.pending.pop(self.next_index)
+            if record is not None:
+                self._emit(record)
+            self.next_index += 1
+
+    def _emit(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+
+async def run_batch(client, prompts, writer, model, concurrency):
+    """用 concurrency 个 worker 并发处理 prompts，每完成一个就写出一个"""
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, prompt = item
+            params = prompt.get("params", {})
+            start = time.perf_counter()
+            record = {"id": prompt["id"], "index": index}
+            try:
+                record["answer"] = await client.chat(
+                    prompt["messages"], prompt.get("model", model), **params
+                )
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["elapsed"] = round(time.perf_counter() - start, 3)
+            writer.write(index, record)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    expected = 0
+    while True:
+        # 在线程里读取输入，从标准输入读时不会卡住正在进行的请求
+        item = await asyncio.to_thread(next, prompts, None)
+        if item is None:
+            break
+        index, prompt = item
+        # 空行会让序号出现空缺，按输入顺序输出时要补上
+        while expected < index:
+            writer.skip(expected)
+            expected += 1
+        expected = index + 1
+        if "messages" not in prompt:
+            # read_prompts 没能解析的行，直接写出错误
+            writer.write(index, {"id": prompt["id"], "index": index, "error": prompt["error"]})
+            continue
+        await queue.put((index, prompt))
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量运行 JSONL 中的问题")
+    parser.add_argument("input", help="输入 JSONL 文件，- 表示从标准输入读取")
+    parser.add_argument("-o", "--output", default="-", help="输出 JSONL 文件，默认标准输出")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="同时进行的请求数")
+    parser.add_argument(
+        "--order", choices=["input", "completion"], default="completion"
+    )
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument(
+        "--no-tunnel", action="store_true", help="不建立 SSH 隧道，直接访问 local_port（配置了 api_base 时同样不建立）"
+    )
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    local_port = int(config.get("local_port", 8888))
+    model = config.get("model")
+
+    tunnel = None
+    if not args.no_tunnel and not config.get("api_base"):
+        # 整个批次共用一条 SSH 隧道，断开时自动重连，重连期间请求排队等待
+        tunnel = LazyTunnel.from_config(config, probe=False).start()
+        tunnel.wait()
+        print("SSH connection established!", file=sys.stderr)
+
+    infile = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    outfile = (
+        sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    )
+    writer = ResultWriter(outfile, args.order)
+    # 批量任务默认算作 batch 流量，开启 limiter 时给交互请求让出保留名额
+    config.setdefault("traffic_class", "batch")
+    client = RoutedChatClient.from_config(config, local_port)
+    if tunnel is not None:
+        client.attach_tunnel(tunnel)
+
+    async def run():
+        try:
+            await run_batch(
+                client, read_prompts(infile), writer, model, args.concurrency
+            )
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(run())
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+        # 按配置写出请求的延迟和吞吐量统计
+        metrics.write_files(config)
+        if isinstance(client, RoutedChatClient):
+            print(json.dumps(client.pool.stats(), indent=4), file=sys.stderr)
+        if client.limiter is not None:
+            print(json.dumps(client.limiter.stats(), indent=4), file=sys.stderr)
+        if tunnel is not None:
+            print(json.dumps(tunnel.stats(), indent=4), file=sys.stderr)
+            tunnel.stop()
+            print("SSH connection closed.", file=sys.stderr)
+    print(
+        f"完成 {writer.done} 条，失败 {writer.failed} 条，耗时 {time.perf_counter() - start:.1f}s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
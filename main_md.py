@@ -1,10 +1,13 @@
+import argparse
 import json
-import requests
-from sshtunnel import SSHTunnelForwarder
-from openai import OpenAI
-from datetime import datetime
 import os
-import sys
+from transcript_writer import TranscriptWriter
+from history import ConversationHistory, make_model_summarizer
+from tunnel import LazyTunnel
+from session_store import SessionStore, TurnTimer
+from think_parser import ThinkParser
+import metrics
+from datetime import datetime
 
 
 # 读取配置文件并解析
@@ -20,22 +23,38 @@ def read_config(file_path):
     return config
 
 
-# 使用配置文件
-config = read_config("config.txt")
+# 配置信息在 main() 中通过 load_settings() 读取，导入模块时不读文件
+config = {}
+hostname = None
+port = 22
+username = None
+password = None
+local_port = 8888
+remote_host = None
+remote_port = 11434
+model = None
+
+
+def load_settings(file_path="config.txt"):
+    """读取配置文件并设置模块中的配置信息"""
+    global config, hostname, port, username, password
+    global local_port, remote_host, remote_port, model
+    config = read_config(file_path)
+
+    # 获取配置信息
+    hostname = config.get("hostname")
+    port = int(config.get("port", 22))  # 默认端口为22
+    username = config.get("username")
+    password = config.get("password")
+    local_port = int(config.get("local_port", 8888))
+    remote_host = config.get("remote_host")
+    remote_port = int(config.get("remote_port", 11434))
+    model = config.get("model")
 
-# 获取配置信息
-hostname = config.get("hostname")
-port = int(config.get("port", 22))  # 默认端口为22
-username = config.get("username")
-password = config.get("password")
-local_port = int(config.get("local_port", 8888))
-remote_host = config.get("remote_host")
-remote_port = int(config.get("remote_port", 11434))
-model = config.get("model")
 
 # 获取当前时间并生成文件名
 current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-file_name = f".\\answers\chat_{current_time}.md"
+file_name = os.path.join("answers", f"chat_{current_time}.md")
 
 
 def custom_converter(o):
@@ -63,139 +82,163 @@ def get_user_input():
     return user_input if user_input != "" else None
 
 
-import time  # 引入time模块
+def stream_chat_completion(http, messages, user_input, writer, timer=None):
+    """流式获取聊天补全的回复，并将内容写入md文件，返回完整的回复文本，请求失败时返回 None"""
+    from requests.exceptions import RequestException
 
+    writer.start_turn(user_input)
+    parts = []
 
-def stream_chat_completion(client, messages, user_input):
-    """流式获取聊天补全的回复，并将内容写入md文件"""
-    response = requests.post(
-        f"http://localhost:{local_port}/v1/chat/completions",
-        json={"messages": messages, "model": model, "stream": True},
-        stream=True,
-    )
-    # 打开文件进行写入（追加内容）
-    with open(file_name, "a", encoding="utf-8") as file:  # 使用 'a' 模式追加内容
-        file.write(f"## **DeliXi:** \n")
-        file.write(f"{user_input}\n")
-        file.write("## **DeepSeek:** \n")
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode("utf-8")
-                if decoded_line.startswith("data: "):
-                    decoded_line = decoded_line[6:]
-                    if decoded_line == "[DONE]":
-                        print(f"\n")
-                        file.write(f"\n\n")  # 结束对话，插入一个空行
-                        sys.stdout.flush()  # 强制刷新标准输出缓冲区
-                        file.flush()  # 刷新文件缓冲区，确保写入到磁盘
-                        file.seek(0, os.SEEK_END)  # 确保将文件指针移动到末尾
-                        os.fsync(file.fileno())  # 确保文件系统也同步
-                        break
-                    try:
-                        data = json.loads(decoded_line)
-                        content = data["choices"][0]["delta"].get("content", "")
-
-                        # 处理 <think> 和 </think> 的部分
-                        if "<think>" in content:
-                            content = content.replace(
-                                "<think>", "**Thinking...**\n"
-                            )  # 开始积累 think 部分内容
-                            print(f"{content}", end="")  # 打印积累的 think 部分内容
-                            file.write(f"{content}")  # 写入文件
-                            sys.stdout.flush()  # 强制刷新标准输出缓冲区
-                            file.flush()  # 刷新文件缓冲区，确保写入到磁盘
-                            file.seek(0, os.SEEK_END)  # 确保将文件指针移动到末尾
-                            os.fsync(file.fileno())  # 确保文件系统也同步
-                        elif "</think>" in content:
-                            content = content.replace(
-                                "</think>", "\n**End of thinking**\n\n---\n"
-                            )
-                            print(f"{content}", end="")  # 打印积累的 think 部分内容
-                            file.write(f"{content}")  # 写入文件
-                            sys.stdout.flush()  # 强制刷新标准输出缓冲区
-                            file.flush()  # 刷新文件缓冲区，确保写入到磁盘
-                            file.seek(0, os.SEEK_END)  # 确保将文件指针移动到末尾
-                            os.fsync(file.fileno())  # 确保文件系统也同步
-                        else:
-                            print(f"{content}", end="")  # 打印正常回复部分的内容
-                            file.write(f"{content}")  # 写入文件
-                            sys.stdout.flush()  # 强制刷新标准输出缓冲区
-                            file.flush()  # 刷新文件缓冲区，确保写入到磁盘
-                            file.seek(0, os.SEEK_END)  # 确保将文件指针移动到末尾
-                            os.fsync(file.fileno())  # 确保文件系统也同步
-
-                    except json.JSONDecodeError:
-                        continue
-        file.write("\n\n")  # 在每次聊天后插入一个空行
+    def output(text):
+        print(text, end="", flush=True)
+        # 写入缓冲区，由 writer 按时间或字节阈值批量写入文件
+        writer.write(text)
 
+    def on_state(in_think):
+        # 进入和离开推理部分时写入标记，标签被拆到两个 delta 中也能正确识别
+        output("**Thinking...**\n" if in_think else "\n**End of thinking**\n\n---\n")
+
+    parser = ThinkParser(on_think=output, on_answer=output, on_state=on_state)
+    deltas = http.stream_chat(messages, model)
+    if timer is not None:
+        deltas = timer.wrap(deltas)
+    try:
+        for content in deltas:
+            parts.append(content)
+            parser.feed(content)
+        parser.close()
+    except RequestException as e:
+        print(f"\nAPI 请求失败: {e}")
+        # 预览文件中标出这一轮没有完成，问题已从历史中撤销
+        writer.write(f"\n\n*API 请求失败: {e}*")
+        writer.end_turn()
+        return None
+
+    # 一轮对话结束，插入空行并刷新文件
+    writer.end_turn()
     print("\n")  # 确保换行清晰
+    return "".join(parts)
 
 
-def main():
-    with open(file_name, "w", encoding="utf-8") as file:  # 使用 'w' 模式覆盖文件
-        file.write(f"# DeepSeek Qustion-Answering System\n")  # 写入文件
-
-    # 设置SSH隧道转发
-    server = SSHTunnelForwarder(
-        (hostname, port),
-        ssh_username=username,
-        ssh_password=password,
-        remote_bind_address=(remote_host, remote_port),
-        local_bind_address=("localhost", local_port),
+def wait_for_tunnel(tunnel):
+    """等待后台的SSH隧道建立完成，打印端口转发的检查结果，成功时返回共享的 HTTP 客户端"""
+    print(f"Checking port forwarding by accessing localhost:{local_port}/v1/models")
+    try:
+        tunnel.wait()
+    except Exception as e:
+        print(f"Error accessing DeepSeek API via port forwarding: {e}")
+        return None
+    print("SSH connection established!")
+    print("Port forwarding is working, and DeepSeek API is accessible.")
+
+    # 所有请求共享同一个 keep-alive 连接池
+    from http_client import get_shared_client
+
+    return get_shared_client(config, local_port)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="和 DeepSeek 对话，并把问答实时写入 Markdown 文件")
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="latest",
+        help="继续之前保存的会话，不指定 id 时继续最近的会话（python session_store.py list 查看）",
     )
+    return parser.parse_args()
 
-    try:
-        # 连接到SSH服务器并启动隧道
-        server.start()
-        print("SSH connection established!")
-
-        # 检查端口转发是否正常工作
-        try:
-            print(
-                f"Checking port forwarding by accessing localhost:{local_port}/v1/models"
-            )
-            response = requests.get(f"http://localhost:{local_port}/v1/models")
-            if response.status_code == 200:
-                print("Port forwarding is working, and DeepSeek API is accessible.")
-            else:
-                print(
-                    f"Failed to access DeepSeek API via port forwarding, Status code: {response.status_code}"
-                )
-                return  # 如果无法访问，提前退出程序
-        except Exception as e:
-            print(f"Error accessing DeepSeek API via port forwarding: {e}")
-            return  # 如果发生连接错误，提前退出程序
-
-        # 连接到OpenAI客户端实例
-        client = OpenAI(
-            base_url=f"http://localhost:{local_port}/v1/",  # 使用本地端口作为代理
-            api_key="ollama",  # 必传参数
-        )
-
-        messages = []
 
+def main():
+    args = parse_args()
+    load_settings()
+    # 每轮问答都记录到会话存储中，Markdown 文件只是实时预览用的视图
+    store = SessionStore.from_config(config)
+    session = None
+
+    # 在后台线程中建立SSH隧道，不用等连接建立就可以先输入问题
+    tunnel = LazyTunnel.from_config(config).start()
+    # 配置了 metrics_port 时提供 /metrics 端点
+    metrics.start_from_config(config)
+    print("Connecting to SSH server in the background...")
+    http = None
+
+    # 整个会话只打开一次记录文件，使用 'w' 模式覆盖文件
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    writer = TranscriptWriter.from_config(config, file_name, mode="w")
+    writer.write(f"# DeepSeek Qustion-Answering System\n")
+    writer.flush()
+
+    try:
         while True:
             # 获取用户输入的问题
             user_input = get_user_input()
             if user_input is None:
                 break
 
-            # 添加用户输入到消息列表中
-            messages.append({"role": "user", "content": user_input})
+            if http is None:
+                # 第一次提问时才等待隧道建立完成
+                http = wait_for_tunnel(tunnel)
+                if http is None:
+                    return  # 如果无法访问，提前退出程序
+
+                # 按 token 预算管理多轮对话的历史消息
+                summarizer = None
+                if config.get("history_policy") == "summarize":
+                    summarizer = make_model_summarizer(http, model)
+                history = ConversationHistory.from_config(config, summarizer)
+                if store is not None:
+                    session = store.open(args.resume, model)
+                    if session.messages:
+                        session.restore(history)
+                        # 之前的问答从会话存储导出，接着写在预览文件里
+                        writer.write(store.export_markdown(session.id, header=False))
+                        print(f"继续会话 {session.id}: {session.title}（加载了 {len(session.messages)} 条消息）")
+
+            # 添加用户输入到历史消息中
+            history.add_user(user_input)
 
             # 发送聊天补全请求
             print(f"Thinking...\n{'='*10} DeepSeek 回复 {'='*10}\n")
-            stream_chat_completion(client, messages, user_input)
+            messages = history.messages()
+            timer = TurnTimer()
+            assistant_reply = stream_chat_completion(
+                http, messages, user_input, writer, timer
+            )
             print(f"{'='*30}\n")
 
-            # 添加DeepSeek的回复到消息列表中（已经在stream_chat_completion中处理）
-            # messages.append({"role": "assistant", "content": assistant_reply})
+            # 添加DeepSeek的回复到历史消息中，请求失败时撤销这次提问
+            if assistant_reply:
+                history.add_assistant(assistant_reply)
+                if session is not None:
+                    session.add_exchange(user_input, assistant_reply, messages, timer, model)
+                    session.checkpoint(history)
+            else:
+                history.rollback()
+
+        # 打印回复缓存的命中统计
+        if http is not None and http.cache is not None:
+            pretty_print("Response Cache", http.cache.stats())
+        # 打印隧道的在线时间和重连次数
+        if http is not None:
+            pretty_print("SSH Tunnel", tunnel.stats())
+        # 配置了多个后端节点时打印各节点的负载和健康状态
+        if http is not None and http.pool is not None:
+            pretty_print("Backends", http.pool.stats())
+        # 打印请求的延迟和吞吐量统计，并按配置写出 JSON / Prometheus 文件
+        if http is not None:
+            pretty_print("Request Metrics", metrics.write_files(config))
 
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
-        # 关闭SSH连接
-        server.stop()
+        # 关闭连接池和SSH连接
+        from http_client import close_shared_client
+
+        close_shared_client()
+        writer.close()
+        if store is not None:
+            store.close()
+        tunnel.stop()
         print("SSH connection closed.")
 
 
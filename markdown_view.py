@@ -0,0 +1,324 @@
+import html
+import re
+from PyQt5.QtWidgets import QTextBrowser
+from PyQt5.QtGui import QTextCursor, QTextCharFormat, QTextBlockFormat, QColor
+from think_parser import ThinkParser
+
+
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+HR_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+UL_RE = re.compile(r"^\s*[-*+]\s+(.*)$")
+OL_RE = re.compile(r"^\s*(\d+)[.)]\s+(.*)$")
+QUOTE_RE = re.compile(r"^\s*>\s?(.*)$")
+BOLD_RE = re.compile(r"\*\*(.+?)\*\*|__(.+?)__")
+ITALIC_RE = re.compile(r"(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?!\*)|(?<!\w)_(?!\s)(.+?)(?<!\s)_(?!\w)")
+LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)\s]+)\)")
+
+CODE_STYLE = "background-color:#f4f4f4; font-family:Consolas,monospace;"
+
+
+def render_inline(text):
+    """行内格式：`代码`、**粗体**、*斜体* 和 [链接](url)，代码里的内容不再处理"""
+    parts = text.split("`")
+    out = []
+    for i, part in enumerate(parts):
+        escaped = html.escape(part, quote=False)
+        # 反引号成对出现时奇数段是代码；最后一个反引号没有配对时按原样显示
+        if i % 2 == 1 and i < len(parts) - 1:
+            out.append(f'<code style="{CODE_STYLE}">{escaped}</code>')
+            continue
+        if i % 2 == 1:
+            escaped = "`" + escaped
+        escaped = LINK_RE.sub(r'<a href="\2">\1</a>', escaped)
+        escaped = BOLD_RE.sub(lambda m: f"<b>{m.group(1) or m.group(2)}</b>", escaped)
+        escaped = ITALIC_RE.sub(lambda m: f"<i>{m.group(1) or m.group(2)}</i>", escaped)
+        out.append(escaped)
+    return "".join(out)
+
+
+def markdown_to_html(source):
+    """把 Markdown 转换成 QTextDocument 支持的 HTML 子集
+
+    只支持模型回复中常见的格式：标题、代码块、列表、引用、分隔线和行内格式。
+    没有闭合的代码块按已经收到的内容显示，流式输出时代码块可以边生成边显示。
+    """
+    out = []
+    paragraph = []
+    list_tag = None
+    lines = source.split("\n")
+
+    def close_paragraph():
+        if paragraph:
+            out.append(f"<p>{'<br>'.join(render_inline(l) for l in paragraph)}</p>")
+            paragraph.clear()
+
+    def close_list():
+        nonlocal list_tag
+        if list_tag:
+            out.append(f"</{list_tag}>")
+            list_tag = None
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        fence = FENCE_RE.match(line)
+        if fence:
+            close_paragraph()
+            close_list()
+            code = []
+            while i < len(lines) and not lines[i].strip().startswith(fence.group(1)):
+                code.append(lines[i])
+                i += 1
+            i += 1  # 跳过结尾的 ```
+            out.append(
+                f'<pre style="{CODE_STYLE}">{html.escape(chr(10).join(code), quote=False)}</pre>'
+            )
+            continue
+        if not line.strip():
+            close_paragraph()
+            close_list()
+            continue
+        heading = HEADING_RE.match(line)
+        if heading:
+            close_paragraph()
+            close_list()
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{render_inline(heading.group(2))}</h{level}>")
+            continue
+        if HR_RE.match(line):
+            close_paragraph()
+            close_list()
+            out.append("<hr>")
+            continue
+        item = UL_RE.match(line)
+        ordered = OL_RE.match(line)
+        if item or ordered:
+            close_paragraph()
+            tag = "ul" if item else "ol"
+            if list_tag != tag:
+                close_list()
+                start = f' start="{ordered.group(1)}"' if ordered else ""
+                out.append(f"<{tag}{start}>")
+                list_tag = tag
+            text = item.group(1) if item else ordered.group(2)
+            out.append(f"<li>{render_inline(text)}</li>")
+            continue
+        quote = QUOTE_RE.match(line)
+        if quote:
+            close_paragraph()
+            close_list()
+            out.append(
+                f'<blockquote style="color:#555555;">{render_inline(quote.group(1))}</blockquote>'
+            )
+            continue
+        close_list()
+        paragraph.append(line)
+    close_paragraph()
+    close_list()
+    return "".join(out)
+
+
+def stable_prefix_length(text, start=0):
+    """返回 text 中已经写完、之后不会再变化的块的结尾位置
+
+    块以空行分隔，代码块内部的空行不算；代码块结束的那一行之后也是一个边界。
+    start 必须是之前返回过的边界（边界一定在代码块之外），这样只需要扫描新增的部分。
+    """
+    boundary = start
+    in_fence = None
+    pos = start
+    while True:
+        newline = text.find("\n", pos)
+        if newline < 0:
+            return boundary
+        line = text[pos:newline]
+        pos = newline + 1
+        fence = FENCE_RE.match(line)
+        if in_fence:
+            if line.strip().startswith(in_fence):
+                in_fence = None
+                boundary = pos
+        elif fence:
+            in_fence = fence.group(1)
+        elif not line.strip():
+            boundary = pos
+
+
+class Reply:
+    """一条正在显示或已经显示完的回复，记录它在文档中的位置和原始文本"""
+
+    def __init__(self, index, start, collapsed):
+        self.index = index
+        self.start = start  # 回复在文档中的起始位置（QTextCursor，会随前面的编辑自动调整）
+        self.stable = None  # 尾部（还在增长的最后一个块）的起始位置
+        self.end = None  # 回复结束后的结尾位置，回复还在进行时为 None（即文档末尾）
+        self.splitter = ThinkParser()
+        self.think = []
+        self.answer = ""
+        self.rendered = 0  # answer 中已经渲染成稳定块的长度
+        self.think_open = False
+        self.collapsed = collapsed
+        self.source = []  # 收到的原始 delta，用于核对和导出
+
+    @property
+    def text(self):
+        return "".join(self.source)
+
+
+class MarkdownView(QTextBrowser):
+    """增量渲染 Markdown 的聊天显示区域
+
+    已经写完的块只渲染一次，之后每次刷新只重新解析和替换最后一个还在增长的块，
+    回复越来越长时每个 token 的渲染开销保持不变。<think> 中的推理过程显示为
+    可以点击折叠和展开的灰色区域。
+    """
+
+    def __init__(self, parent=None, collapse_think=True):
+        super().__init__(parent)
+        self.setOpenLinks(False)
+        self.anchorClicked.connect(self.on_anchor)
+        self.collapse_think = collapse_think
+        self.replies = []
+        self.reply = None  # 正在接收的回复
+        self.think_format = QTextCharFormat()
+        self.think_format.setForeground(QColor("gray"))
+
+    def _cursor(self, position=None):
+        cursor = QTextCursor(self.document())
+        if position is None:
+            cursor.movePosition(QTextCursor.End)
+        else:
+            cursor.setPosition(position)
+        return cursor
+
+    def _anchor(self, position):
+        """在 position 处创建一个标记，在它后面插入内容时它保持不动"""
+        cursor = self._cursor(position)
+        cursor.setKeepPositionOnInsert(True)
+        return cursor
+
+    def _new_block(self, cursor):
+        # 在空块里插入，避免新内容和上一段的格式合并
+        if cursor.block().length() > 1:
+            cursor.insertBlock(QTextBlockFormat(), QTextCharFormat())
+
+    def begin_reply(self):
+        """在文档末尾开始一条新的回复"""
+        self.end_reply()
+        cursor = self._cursor()
+        self._new_block(cursor)
+        self.reply = Reply(len(self.replies), self._anchor(cursor.position()), self.collapse_think)
+        self.reply.stable = self._anchor(cursor.position())
+        self.replies.append(self.reply)
+        return self.reply
+
+    def feed(self, text):
+        """追加一段流式文本，只渲染新增的部分"""
+        reply = self.reply or self.begin_reply()
+        reply.source.append(text)
+        self._consume(reply, reply.splitter.feed(text))
+
+    def _consume(self, reply, pieces):
+        answer_changed = False
+        for is_think, piece in pieces:
+            if is_think:
+                self._append_think(reply, piece)
+            else:
+                if reply.think_open:
+                    self._finish_think(reply)
+                reply.answer += piece
+                answer_changed = True
+        if not reply.splitter.in_think and reply.think_open and reply.splitter.seen_think:
+            self._finish_think(reply)
+        if answer_changed:
+            self._render_answer(reply)
+
+    def _append_think(self, reply, text):
+        cursor = self._cursor()
+        if not reply.think_open:
+            reply.think_open = True
+            self._new_block(cursor)
+            cursor.insertHtml('<p style="color:gray;">▼ 思考中...</p>')
+            cursor.insertBlock(QTextBlockFormat(), self.think_format)
+        reply.think.append(text)
+        cursor.insertText(text, self.think_format)
+
+    def _finish_think(self, reply):
+        """推理结束：按设置折叠推理内容，之后的正式回答从这里开始渲染"""
+        reply.think_open = False
+        self._rebuild(reply)
+
+    def _render_answer(self, reply):
+        end = stable_prefix_length(reply.answer, reply.rendered)
+        # 删掉上一次渲染的尾部
+        cursor = self._cursor(reply.stable.position())
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        if end > reply.rendered:
+            # 新写完的块只渲染这一次
+            self._insert_markdown(cursor, reply.answer[reply.rendered : end])
+            reply.rendered = end
+            reply.stable = self._anchor(cursor.position())
+        tail = reply.answer[reply.rendered :]
+        if tail.strip():
+            self._insert_markdown(cursor, tail)
+
+    def _insert_markdown(self, cursor, source):
+        self._new_block(cursor)
+        cursor.insertHtml(markdown_to_html(source))
+
+    def _think_header(self, reply):
+        length = sum(len(t) for t in reply.think)
+        arrow, action = ("▶", "展开") if reply.collapsed else ("▼", "折叠")
+        return (
+            f'<p><a href="think:{reply.index}" style="color:gray; text-decoration:none;">'
+            f"{arrow} 思考过程（{length} 字，点击{action}）</a></p>"
+        )
+
+    def _rebuild(self, reply):
+        """重新渲染整条回复，只在推理结束和点击折叠/展开时调用"""
+        end = reply.end.position() if reply.end is not None else None
+        cursor = self._cursor(reply.start.position())
+        if end is None:
+            cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        else:
+            cursor.setPosition(end, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+
+        if reply.think:
+            cursor.insertHtml(self._think_header(reply))
+            if not reply.collapsed:
+                cursor.insertBlock(QTextBlockFormat(), self.think_format)
+                cursor.insertText("".join(reply.think).strip("\n"), self.think_format)
+        if reply.rendered:
+            self._insert_markdown(cursor, reply.answer[: reply.rendered])
+        reply.stable = self._anchor(cursor.position())
+        tail = reply.answer[reply.rendered :]
+        if tail.strip():
+            self._insert_markdown(cursor, tail)
+        if reply.end is not None:
+            reply.end = self._anchor(cursor.position())
+
+    def end_reply(self):
+        """回复结束：把剩下的内容作为完整的块渲染，之后在文档末尾追加的内容不属于这条回复"""
+        reply = self.reply
+        if reply is None:
+            return
+        self.reply = None
+        self._consume(reply, reply.splitter.close())
+        if reply.think_open:
+            self._finish_think(reply)
+        reply.rendered = len(reply.answer)
+        reply.end = self._anchor(self._cursor().position())
+
+    def on_anchor(self, url):
+        if url.scheme() != "think":
+            return
+        reply = self.replies[int(url.path())]
+        reply.collapsed = not reply.collapsed
+        scrollbar = self.verticalScrollBar()
+        value = scrollbar.value()
+        self._rebuild(reply)
+        scrollbar.setValue(value)
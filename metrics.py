@@ -0,0 +1,247 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+PREFIX = "deepseek_client_"
+
+# 各个指标的桶边界（秒 / 个 / 每秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+INTER_TOKEN_BUCKETS = (0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+
+
+class Histogram:
+    """累积直方图，和 Prometheus 的 histogram 类型一致，另外记录最小值和最大值"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个是 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """按桶估计分位数，返回所在桶的上边界（落在 +Inf 桶时返回最大值）"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 4),
+            "min": round(self.min, 4),
+            "p50": round(self.quantile(0.5), 4),
+            "p90": round(self.quantile(0.9), 4),
+            "p99": round(self.quantile(0.99), 4),
+            "max": round(self.max, 4),
+        }
+
+    def prometheus(self):
+        name = PREFIX + self.name
+        lines = [f"# HELP {name} {self.help}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """进程内的请求指标，所有前端共用一份"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {
+            h.name: h
+            for h in (
+                Histogram("ttft_seconds", "Time from sending the request to the first content token", LATENCY_BUCKETS),
+                Histogram("inter_token_seconds", "Time between consecutive content tokens", INTER_TOKEN_BUCKETS),
+                Histogram("request_seconds", "Total duration of a streaming request", LATENCY_BUCKETS),
+                Histogram("completion_tokens", "Completion tokens per request", TOKEN_BUCKETS),
+                Histogram("prompt_tokens", "Prompt tokens per request", TOKEN_BUCKETS),
+                Histogram("tokens_per_second", "Decode rate after the first token", RATE_BUCKETS),
+                Histogram("tunnel_connect_seconds", "Time to establish the SSH tunnel", LATENCY_BUCKETS),
+            )
+        }
+        self.counters = {"requests_total": 0, "errors_total": 0, "tokens_total": 0}
+        self.gauges = {}
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def track(self, prompt_tokens=None):
+        """开始记录一次流式请求，返回 RequestTimer"""
+        return RequestTimer(self, prompt_tokens)
+
+    def summary(self):
+        """所有指标的 JSON 摘要"""
+        with self._lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 1),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {n: h.summary() for n, h in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        """Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            for name, value in self.counters.items():
+                lines += [f"# TYPE {PREFIX}{name} counter", f"{PREFIX}{name} {value}"]
+            for name, value in self.gauges.items():
+                lines += [f"# TYPE {PREFIX}{name} gauge", f"{PREFIX}{name} {value}"]
+            for histogram in self.histograms.values():
+                lines += histogram.prometheus()
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    """一次流式请求的计时，每收到一个 delta 调用 token()，结束时调用 finish()"""
+
+    def __init__(self, metrics, prompt_tokens=None):
+        self.metrics = metrics
+        self.prompt_tokens = prompt_tokens
+        self.start = time.perf_counter()
+        self.first = None
+        self.last = None
+        self.tokens = 0
+        self.gaps = []
+
+    def token(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        else:
+            self.gaps.append(now - self.last)
+        self.last = now
+        self.tokens += 1
+
+    def finish(self, usage=None):
+        """请求正常结束；usage 是最后一个事件中的统计信息，有的话优先使用"""
+        end = time.perf_counter()
+        usage = usage or {}
+        completion = usage.get("completion_tokens") or self.tokens
+        prompt = usage.get("prompt_tokens") or self.prompt_tokens
+        m = self.metrics
+        with m._lock:
+            m.counters["requests_total"] += 1
+            m.counters["tokens_total"] += completion
+            h = m.histograms
+            h["request_seconds"].observe(end - self.start)
+            h["completion_tokens"].observe(completion)
+            if prompt:
+                h["prompt_tokens"].observe(prompt)
+            if self.first is not None:
+                h["ttft_seconds"].observe(self.first - self.start)
+                for gap in self.gaps:
+                    h["inter_token_seconds"].observe(gap)
+                if self.last > self.first:
+                    h["tokens_per_second"].observe(completion / (self.last - self.first))
+
+    def fail(self):
+        self.metrics.inc("errors_total")
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def serve(port, host="localhost"):
+    """在后台线程中提供 /metrics（Prometheus 格式）和 /metrics.json"""
+    # 只有配置了端口才用到 http.server，放在这里导入，不影响启动时间
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = _metrics.prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(_metrics.summary(), indent=4).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_from_config(config):
+    """配置了 metrics_port 时启动 /metrics 端点，返回 HTTP 服务器（没有配置时返回 None）"""
+    port = config.get("metrics_port")
+    if not port:
+        return None
+    return serve(int(port))
+
+
+def write_files(config):
+    """程序退出时按配置写出 JSON 摘要和 Prometheus 文本文件，返回 JSON 摘要"""
+    summary = _metrics.summary()
+    json_path = config.get("metrics_json")
+    if json_path:
+        if os.path.dirname(json_path):
+            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=4)
+    prom_path = config.get("metrics_prom_file")
+    if prom_path:
+        if os.path.dirname(prom_path):
+            os.makedirs(os.path.dirname(prom_path), exist_ok=True)
+        # 先写临时文件再替换，node_exporter 的 textfile collector 不会读到写了一半的文件
+        tmp_path = prom_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(_metrics.prometheus())
+        os.replace(tmp_path, prom_path)
+    return summary
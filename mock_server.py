@@ -0,0 +1,305 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = ["模型", "推理", "token", "的", "结果", "，", "然后", "我们", "需要", "。", " the", " answer"]
+
+
+class MockOptions:
+    """模拟服务器的行为参数，所有请求共享，可以在运行中修改"""
+
+    def __init__(
+        self,
+        models=("deepseek-r1:70b",),
+        rate=0.0,
+        ttft=0.0,
+        chunk_tokens=1,
+        tokens=200,
+        think_tokens=50,
+        error_rate=0.0,
+        disconnect_rate=0.0,
+        seed=None,
+        dimensions=64,
+    ):
+        self.models = list(models)
+        self.rate = rate  # 每秒生成多少个 token，0 为不限速
+        self.ttft = ttft  # 首个 token 之前的等待时间（秒）
+        self.chunk_tokens = chunk_tokens  # 每个 SSE 事件包含几个 token
+        self.tokens = tokens  # 默认的回复长度，请求中的 max_tokens 优先
+        self.think_tokens = think_tokens  # <think> 中推理内容的长度，0 为不输出推理
+        self.error_rate = error_rate  # 直接返回 500 的概率
+        self.disconnect_rate = disconnect_rate  # 输出到一半时断开连接的概率
+        self.dimensions = dimensions  # /v1/embeddings 返回的向量维数
+        self.random = random.Random(seed)
+
+
+def generate_tokens(count, think_tokens):
+    """生成确定的回复 token，推理部分放在 <think> 中"""
+    tokens = []
+    if think_tokens:
+        tokens.append("<think>")
+        tokens.append("\n")
+        tokens += [WORDS[i % len(WORDS)] for i in range(think_tokens)]
+        tokens.append("\n")
+        tokens.append("</think>")
+        tokens.append("\n\n")
+    for i in range(count):
+        tokens.append(WORDS[i % len(WORDS)])
+        if i % 40 == 39:
+            tokens.append("\n\n")
+    return tokens
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 每个 SSE 事件都要马上发出去，关掉 Nagle 算法，否则小包会被攒到 40ms 才发送
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def options(self):
+        return self.server.options
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/v1/models", "/models"):
+            models = [{"id": m, "object": "model", "owned_by": "mock"} for m in self.options.models]
+            self.send_json(200, {"object": "list", "data": models})
+        elif self.path.startswith(("/v1/models/", "/models/")):
+            model = self.path.split("/models/", 1)[1]
+            if model in self.options.models:
+                self.send_json(200, {"id": model, "object": "model", "owned_by": "mock"})
+            else:
+                self.send_json(404, {"error": {"message": f"model {model} not found"}})
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "invalid JSON"}})
+            return
+        path = self.path.rstrip("/")
+        try:
+            if path.endswith("/embeddings"):
+                self.embeddings(request)
+            elif path.endswith("/chat/completions"):
+                self.complete(request, chat=True)
+            elif path.endswith("/completions"):
+                self.complete(request, chat=False)
+            else:
+                self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端主动断开（输掉的对冲请求、取消的请求等），停止发送，不打印异常
+            self.close_connection = True
+
+    def embeddings(self, request):
+        """确定的伪向量：按字符的二元组哈希到 dimensions 维，文字相近的输入向量也相近"""
+        inputs = request.get("input", "")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dimensions = int(request.get("dimensions") or self.options.dimensions)
+        if self.options.ttft:
+            time.sleep(self.options.ttft)
+        data = []
+        for index, text in enumerate(inputs):
+            vector = [0.0] * dimensions
+            text = str(text).lower()
+            for i in range(max(1, len(text) - 1)):
+                vector[zlib.crc32(text[i : i + 2].encode("utf-8")) % dimensions] += 1.0
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(str(text)) for text in inputs)
+        self.send_json(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": request.get("model") or self.options.models[0],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+        )
+
+    def complete(self, request, chat):
+        options = self.options
+        if options.error_rate and options.random.random() < options.error_rate:
+            self.send_json(500, {"error": {"message": "injected error"}})
+            return
+
+        model = request.get("model") or options.models[0]
+        count = int(request.get("max_tokens") or options.tokens)
+        tokens = generate_tokens(count, options.think_tokens if chat else 0)
+        if "messages" in request:
+            prompt = "".join(str(m.get("content", "")) for m in request["messages"])
+        else:
+            prompt = str(request.get("prompt", ""))
+        usage = {
+            "prompt_tokens": len(prompt),
+            "completion_tokens": len(tokens),
+            "total_tokens": len(prompt) + len(tokens),
+        }
+        created = int(time.time())
+        object_name = "chat.completion" if chat else "text_completion"
+
+        if options.ttft:
+            time.sleep(options.ttft)
+        if not request.get("stream"):
+            if options.rate:
+                time.sleep(len(tokens) / options.rate)
+            text = "".join(tokens)
+            choice = (
+                {"index": 0, "message": {"role": "assistant", "content": text}}
+                if chat
+                else {"index": 0, "text": text}
+            )
+            choice["finish_reason"] = "stop"
+            self.send_json(
+                200,
+                {
+                    "id": "mock",
+                    "object": object_name,
+                    "created": created,
+                    "model": model,
+                    "choices": [choice],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        disconnect_at = None
+        if options.disconnect_rate and options.random.random() < options.disconnect_rate:
+            disconnect_at = len(tokens) // 2
+
+        start = time.perf_counter()
+        step = max(1, options.chunk_tokens)
+        for pos in range(0, len(tokens), step):
+            if disconnect_at is not None and pos >= disconnect_at:
+                # 不发送结尾的空块就关闭连接，模拟服务器或隧道中途断开
+                self.close_connection = True
+                return
+            if options.rate:
+                delay = start + pos / options.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            text = "".join(tokens[pos : pos + step])
+            choice = (
+                {"index": 0, "delta": {"content": text}, "finish_reason": None}
+                if chat
+                else {"index": 0, "text": text, "finish_reason": None}
+            )
+            event = {
+                "id": "mock",
+                "object": object_name + ".chunk" if chat else object_name,
+                "created": created,
+                "model": model,
+                "choices": [choice],
+            }
+            self.send_chunk(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+        final = {
+            "id": "mock",
+            "object": object_name + ".chunk" if chat else object_name,
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+        self.send_chunk(b"data: " + json.dumps(final).encode("utf-8") + b"\n\n")
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    """本地的 OpenAI / Ollama 兼容模拟服务器，port=0 时自动选择空闲端口"""
+
+    daemon_threads = True
+    # 压测时会同时建立很多连接，默认的 backlog（5）会导致连接被拒绝或重传
+    request_queue_size = 256
+
+    def __init__(self, host="localhost", port=0, options=None):
+        super().__init__((host, port), MockHandler)
+        self.options = options or MockOptions()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def base_url(self):
+        return f"http://localhost:{self.port}/v1"
+
+    def start(self):
+        """在后台线程中运行，返回 self"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地的 OpenAI / Ollama 兼容模拟服务器")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--model", action="append", help="可以重复指定多个模型名")
+    parser.add_argument("--rate", type=float, default=0, help="每秒生成多少个 token，0 为不限速")
+    parser.add_argument("--ttft", type=float, default=0, help="首个 token 之前的等待时间（秒）")
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="每个 SSE 事件包含几个 token")
+    parser.add_argument("--tokens", type=int, default=200, help="默认的回复长度")
+    parser.add_argument("--think-tokens", type=int, default=50, help="推理内容的长度，0 为不输出")
+    parser.add_argument("--error-rate", type=float, default=0, help="直接返回 500 的概率")
+    parser.add_argument("--disconnect-rate", type=float, default=0, help="输出到一半断开连接的概率")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--dimensions", type=int, default=64, help="/v1/embeddings 返回的向量维数")
+    args = parser.parse_args()
+
+    options = MockOptions(
+        models=args.model or ["deepseek-r1:70b"],
+        rate=args.rate,
+        ttft=args.ttft,
+        chunk_tokens=args.chunk_tokens,
+        tokens=args.tokens,
+        think_tokens=args.think_tokens,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+        dimensions=args.dimensions,
+    )
+    server = MockServer(args.host, args.port, options)
+    print(f"Mock server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
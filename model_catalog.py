@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+DEFAULT_PATH = os.path.join("cache", "models.json")
+
+
+def endpoint_id(config):
+    """目录对应的服务端：api_base，或者 SSH 服务器和远程端口；换了服务端时缓存失效"""
+    if config.get("api_base"):
+        return config["api_base"]
+    return "{}:{}/{}:{}/{}".format(
+        config.get("hostname"),
+        config.get("port", 22),
+        config.get("remote_host"),
+        config.get("remote_port", 11434),
+        config.get("backends", ""),
+    )
+
+
+def configured_models(config):
+    """配置中用到的所有模型：model、embedding_model 和 diagnostic_models（逗号分隔）"""
+    models = [config.get("model"), config.get("embedding_model")]
+    models += config.get("diagnostic_models", "").split(",")
+    result = []
+    for name in models:
+        name = (name or "").strip()
+        if name and name not in result:
+            result.append(name)
+    return result
+
+
+class ModelCatalog:
+    """缓存在本地 JSON 文件中的模型目录，包括 /v1/models 的结果和最近一次诊断的结果
+
+    启动时在 ttl 秒内直接读取本地的模型列表，不再经过隧道请求 /v1/models；
+    过期或者服务端变了（见 endpoint_id）时返回 None，由调用方重新获取后 save()。
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=24 * 3600, endpoint=None):
+        self.path = path
+        self.ttl = ttl
+        self.endpoint = endpoint
+
+    @classmethod
+    def from_config(cls, config):
+        """根据 model_catalog_* 配置项创建，model_catalog_ttl_hours 为 0 时返回 None（每次都请求）"""
+        ttl = float(config.get("model_catalog_ttl_hours", 24)) * 3600
+        if ttl <= 0:
+            return None
+        return cls(
+            config.get("model_catalog_path", DEFAULT_PATH),
+            ttl=ttl,
+            endpoint=endpoint_id(config),
+        )
+
+    def read(self):
+        """读取整个目录文件，不存在或者格式不对时返回空字典"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def load(self):
+        """返回没有过期的 /v1/models 结果，否则返回 None"""
+        data = self.read()
+        if data.get("endpoint") != self.endpoint or "models" not in data:
+            return None
+        if time.time() - data.get("updated", 0) > self.ttl:
+            return None
+        return data["models"]
+
+    def age(self):
+        """目录的更新时间距今多少秒，没有目录时返回 None"""
+        updated = self.read().get("updated")
+        return time.time() - updated if updated else None
+
+    def save(self, models, diagnostics=None):
+        """写入新的模型列表；diagnostics 为 None 时保留上一次的诊断结果"""
+        data = self.read() if diagnostics is None else {}
+        if data.get("endpoint") != self.endpoint:
+            data = {}
+        data.update({"endpoint": self.endpoint, "updated": time.time(), "models": models})
+        if diagnostics is not None:
+            data["diagnostics"] = diagnostics
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 先写临时文件再替换，并发启动的进程不会读到写了一半的文件
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def normalize_messages(messages):
+    """只保留 role 和 content，并去掉首尾空白；中间的换行和缩进会改变含义（比如代码），原样保留"""
+    return [
+        {"role": m["role"], "content": m["content"].strip()}
+        for m in messages
+    ]
+
+
+def cache_key(model, messages, params=None):
+    """由模型、规范化后的消息和采样参数计算缓存键"""
+    data = {
+        "model": model,
+        "messages": normalize_messages(messages),
+        "params": params or {},
+    }
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """保存在 SQLite 中的回复缓存，支持 LRU、TTL 和总大小限制"""
+
+    def __init__(
+        self,
+        path=os.path.join("cache", "responses.sqlite3"),
+        max_entries=2000,
+        max_bytes=64 * 1024 * 1024,
+        ttl=7 * 24 * 3600,
+    ):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # GUI 会在工作线程里访问缓存，所以允许跨线程使用同一个连接
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                content TEXT,
+                size INTEGER,
+                created REAL,
+                last_access REAL,
+                hit_count INTEGER DEFAULT 0
+            )"""
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)"
+        )
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """根据 config.txt 中的 cache_* 配置项创建，cache_enabled 不为 true 时返回 None"""
+        if config.get("cache_enabled", "false").lower() != "true":
+            return None
+        return cls(
+            path=config.get("cache_path", os.path.join("cache", "responses.sqlite3")),
+            max_entries=int(config.get("cache_max_entries", 2000)),
+            max_bytes=int(config.get("cache_max_mb", 64)) * 1024 * 1024,
+            ttl=float(config.get("cache_ttl_hours", 168)) * 3600,
+        )
+
+    def get(self, key):
+        """查找缓存，过期的条目视为未命中"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_access = ?, hit_count = hit_count + 1 WHERE key = ?",
+                (now, key),
+            )
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, content):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, len(content.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        # 调用方需持有 self._lock
+        if self.ttl:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        # 按最近访问时间从旧到新删除，直到满足条数和大小限制
+        for key, entry_size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ).fetchall():
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            size -= entry_size
+
+    def stats(self):
+        """返回命中统计和当前缓存的条数、大小"""
+        with self._lock:
+            count, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": count,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def replay(content, chunk_chars=4, delay=0.0):
+    """把缓存的回复切成小块逐个产出，模拟流式输出，各个前端的显示逻辑不需要改动"""
+    for pos in range(0, len(content), chunk_chars):
+        if delay:
+            time.sleep(delay)
+        yield content[pos : pos + chunk_chars]
+
+
+def cached_stream(cache, stream, model, messages, params, replay_delay=0.0):
+    """带缓存的流式生成器：命中时回放缓存，未命中时转发 stream 并在完整结束后写入缓存"""
+    key = cache_key(model, messages, params)
+    content = cache.get(key)
+    if content is not None:
+        yield from replay(content, delay=replay_delay)
+        return
+    parts = []
+    for delta in stream:
+        parts.append(delta)
+        yield delta
+    # 只有完整读完的回复才写入缓存，中途出错或被取消的不会走到这里
+    if parts:
+        cache.put(key, model, "".join(parts))
@@ -0,0 +1,333 @@
+import argparse
+import glob
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+DEFAULT_PATH = os.path.join("search", "index.sqlite3")
+
+# 连续的中日韩文字切成二元组（bigram），其他文字按单词切分
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[0-9a-z_]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+_TURN_RE = re.compile(r"^## \*\*DeliXi:\*\* *\n", re.M)
+_REPLY_RE = re.compile(r"^## \*\*DeepSeek:\*\* *\n", re.M)
+
+
+def tokenize(text):
+    """把文本切成检索用的词：英文和数字按单词，中文按相邻两个字（单独一个字时就是这个字）"""
+    terms = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        word = match.group()
+        if len(word) == 1 or not _CJK_RE.match(word):
+            terms.append(word)
+        else:
+            terms += [word[i : i + 2] for i in range(len(word) - 1)]
+    return terms
+
+
+def split_transcript(text):
+    """把 main_md.py 写出的 Markdown 记录切成 (问题, 回答) 列表"""
+    turns = []
+    for block in _TURN_RE.split(text)[1:]:
+        parts = _REPLY_RE.split(block, 1)
+        question = parts[0].strip()
+        answer = parts[1].strip() if len(parts) > 1 else ""
+        turns.append((question, answer))
+    return turns
+
+
+class SearchIndex:
+    """保存在 SQLite 中的倒排索引，按 BM25 对历史问答排序
+
+    每个文档是一轮问答（问题 + 回答），来自 answers/ 中的 Markdown 记录或者会话存储。
+    update() 是增量的：Markdown 文件按修改时间和大小判断是否需要重新索引，
+    会话存储的轮次只追加不修改，只索引上次之后新增的轮次。
+    """
+
+    def __init__(self, path=DEFAULT_PATH, k1=1.2, b=0.75):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                source TEXT,
+                ref TEXT,
+                position INTEGER,
+                question TEXT,
+                answer TEXT,
+                length INTEGER,
+                created REAL
+            );
+            CREATE INDEX IF NOT EXISTS docs_ref ON docs (source, ref);
+            -- 计算文档数和平均长度时只扫描这个索引，不用读回答的全文
+            CREATE INDEX IF NOT EXISTS docs_length ON docs (length);
+            CREATE TABLE IF NOT EXISTS terms (
+                id INTEGER PRIMARY KEY,
+                term TEXT UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER,
+                doc_id INTEGER,
+                tf INTEGER,
+                PRIMARY KEY (term_id, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS indexed_sessions (
+                session_id TEXT PRIMARY KEY,
+                turns INTEGER
+            );
+            """
+        )
+        self._db.commit()
+        self._term_ids = None
+
+    def _term_id(self, term):
+        # 调用方需持有 self._lock；词表第一次用到时整个读进内存
+        if self._term_ids is None:
+            self._term_ids = dict(self._db.execute("SELECT term, id FROM terms"))
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self._db.execute("INSERT INTO terms (term) VALUES (?)", (term,)).lastrowid
+            self._term_ids[term] = term_id
+        return term_id
+
+    def _add(self, source, ref, position, question, answer, created):
+        # 调用方需持有 self._lock
+        terms = Counter(tokenize(question) + tokenize(answer))
+        cursor = self._db.execute(
+            "INSERT INTO docs (source, ref, position, question, answer, length, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (source, ref, position, question, answer, sum(terms.values()), created),
+        )
+        doc_id = cursor.lastrowid
+        self._db.executemany(
+            "INSERT INTO postings (term_id, doc_id, tf) VALUES (?, ?, ?)",
+            [(self._term_id(term), doc_id, tf) for term, tf in terms.items()],
+        )
+
+    def _remove(self, source, ref):
+        # 调用方需持有 self._lock
+        self._db.execute(
+            "DELETE FROM postings WHERE doc_id IN (SELECT id FROM docs WHERE source = ? AND ref = ?)",
+            (source, ref),
+        )
+        self._db.execute("DELETE FROM docs WHERE source = ? AND ref = ?", (source, ref))
+
+    def update_transcripts(self, directory="answers"):
+        """索引新增或修改过的 chat_*.md，删除已经不存在的文件，返回变化的文件数"""
+        paths = set(glob.glob(os.path.join(directory, "*.md")))
+        changed = 0
+        with self._lock:
+            known = dict(
+                (path, (mtime, size))
+                for path, mtime, size in self._db.execute("SELECT path, mtime, size FROM files")
+            )
+            for path in set(known) - paths:
+                # 只删除这个目录中的文件，目录写成 ./answers 或绝对路径时也要能对上
+                if os.path.abspath(os.path.dirname(path)) == os.path.abspath(directory):
+                    self._remove("md", path)
+                    self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+                    changed += 1
+            for path in sorted(paths):
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+                with open(path, "r", encoding="utf-8", errors="replace") as file:
+                    text = file.read()
+                self._remove("md", path)
+                for position, (question, answer) in enumerate(split_transcript(text)):
+                    self._add("md", path, position, question, answer, stat.st_mtime)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                    (path, stat.st_mtime, stat.st_size),
+                )
+                changed += 1
+            self._db.commit()
+        return changed
+
+    def update_sessions(self, store):
+        """索引会话存储中新增的问答轮次，返回新增的文档数"""
+        added = 0
+        with self._lock:
+            known = dict(self._db.execute("SELECT session_id, turns FROM indexed_sessions"))
+        for session in store.recent(limit=-1):
+            indexed = known.get(session["id"], 0)
+            if session["turns"] <= indexed:
+                continue
+            turns = store.turns(session["id"])
+            with self._lock:
+                question = None
+                for seq in range(indexed, len(turns)):
+                    turn = turns[seq]
+                    if turn["role"] == "user":
+                        question = turn["content"]
+                    elif turn["role"] == "assistant":
+                        if question is None and seq > 0:
+                            question = turns[seq - 1]["content"]
+                        self._add("session", session["id"], seq, question or "", turn["content"], turn["created"])
+                        added += 1
+                        question = None
+                self._db.execute(
+                    "INSERT OR REPLACE INTO indexed_sessions (session_id, turns) VALUES (?, ?)",
+                    (session["id"], len(turns)),
+                )
+                self._db.commit()
+        return added
+
+    def _postings(self, term):
+        """返回 [(doc_id, tf, length)]；只有一个汉字的查询词匹配所有包含它的二元组。调用方需持有 self._lock"""
+        if len(term) == 1 and _CJK_RE.match(term):
+            # 汉字只以二元组的形式建索引，以它开头和以它结尾的二元组都要算上；
+            # 一处出现会被前后两个二元组各算一次，所以取两边中较大的词频
+            prefix = self._query_postings("term >= ? AND term < ?", (term, term + "\uffff"))
+            suffix = self._query_postings("length(term) = 2 AND substr(term, 2) = ?", (term,))
+            merged = {}
+            for doc_id, tf, length in prefix + suffix:
+                if doc_id in merged:
+                    tf = max(tf, merged[doc_id][1])
+                merged[doc_id] = (doc_id, tf, length)
+            return list(merged.values())
+        return self._query_postings("term = ?", (term,))
+
+    def _query_postings(self, condition, args):
+        # 调用方需持有 self._lock
+        return self._db.execute(
+            "SELECT p.doc_id, SUM(p.tf), d.length FROM postings p JOIN docs d ON d.id = p.doc_id "
+            f"WHERE p.term_id IN (SELECT id FROM terms WHERE {condition}) GROUP BY p.doc_id",
+            args,
+        ).fetchall()
+
+    def search(self, query, limit=10):
+        """按 BM25 返回最相关的问答，每个结果包含来源、问题、回答和得分"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            count, avg_length = self._db.execute(
+                "SELECT COUNT(*), AVG(length) FROM docs"
+            ).fetchone()
+            if not count:
+                return []
+            scores = Counter()
+            for term in terms:
+                postings = self._postings(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                k1, b = self.k1, self.b
+                for doc_id, tf, length in postings:
+                    norm = k1 * (1 - b + b * length / avg_length)
+                    scores[doc_id] += idf * tf * (k1 + 1) / (tf + norm)
+            results = []
+            for doc_id, score in scores.most_common(limit):
+                source, ref, position, question, answer, created = self._db.execute(
+                    "SELECT source, ref, position, question, answer, created FROM docs WHERE id = ?",
+                    (doc_id,),
+                ).fetchone()
+                results.append(
+                    {
+                        "score": round(score, 3),
+                        "source": source,
+                        "ref": ref,
+                        "position": position,
+                        "question": question,
+                        "answer": answer,
+                        "created": created,
+                    }
+                )
+        return results
+
+    def stats(self):
+        with self._lock:
+            docs, terms = self._db.execute(
+                "SELECT (SELECT COUNT(*) FROM docs), (SELECT COUNT(*) FROM postings)"
+            ).fetchone()
+        return {"docs": docs, "postings": terms}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def snippet(text, query, width=80):
+    """回答中第一次出现查询词的位置附近的一段文字"""
+    text = " ".join(text.split())
+    lower = text.lower()
+    positions = [lower.find(term) for term in tokenize(query)]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    prefix = "..." if start else ""
+    suffix = "..." if start + width < len(text) else ""
+    return prefix + text[start : start + width] + suffix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在以前的问答记录中全文检索")
+    parser.add_argument("query", nargs="*", help="检索的内容，中英文都可以")
+    parser.add_argument("-n", type=int, default=10, help="返回的结果数")
+    parser.add_argument("--index", default=DEFAULT_PATH, help="索引文件")
+    parser.add_argument("--answers", default="answers", help="Markdown 记录所在的目录")
+    parser.add_argument("--sessions", default=os.path.join("sessions", "sessions.sqlite3"))
+    parser.add_argument("--no-update", action="store_true", help="不检查新的记录，直接检索")
+    parser.add_argument("--show", type=int, metavar="N", help="打印第 N 个结果的完整回答")
+    args = parser.parse_args()
+
+    index = SearchIndex(args.index)
+    try:
+        if not args.no_update:
+            start = time.perf_counter()
+            changed = index.update_transcripts(args.answers) if os.path.isdir(args.answers) else 0
+            added = 0
+            if os.path.exists(args.sessions):
+                from session_store import SessionStore
+
+                store = SessionStore(args.sessions)
+                try:
+                    added = index.update_sessions(store)
+                finally:
+                    store.close()
+            if changed or added:
+                print(
+                    f"更新索引：{changed} 个文件，{added} 轮会话，"
+                    f"耗时 {time.perf_counter() - start:.2f}s，共 {index.stats()['docs']} 轮问答\n"
+                )
+        if not args.query:
+            return
+        query = " ".join(args.query)
+        start = time.perf_counter()
+        results = index.search(query, args.n)
+        elapsed = (time.perf_counter() - start) * 1000
+        if args.show:
+            if not 1 <= args.show <= len(results):
+                print(f"只有 {len(results)} 个结果")
+                return
+            result = results[args.show - 1]
+            print(f"## {result['question']}\n\n{result['answer']}")
+            return
+        for i, result in enumerate(results, 1):
+            print(f"{i:>2}. [{result['score']:.2f}] {result['ref']}#{result['position']}")
+            print(f"    问: {snippet(result['question'], query, 60)}")
+            print(f"    答: {snippet(result['answer'], query)}")
+        print(f"\n{len(results)} 个结果，检索耗时 {elapsed:.1f}ms")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import argparse
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from history import estimate_tokens, message_tokens
+
+DEFAULT_PATH = os.path.join("sessions", "sessions.sqlite3")
+
+
+class TurnTimer:
+    """记录一次回复的首 token 时间和总耗时，wrap() 原样转发 delta"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.ttft = None
+        self.duration = None
+
+    def wrap(self, deltas):
+        for delta in deltas:
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self.start
+            yield delta
+        self.duration = time.perf_counter() - self.start
+
+
+class Session:
+    """一个对话会话，按顺序追加轮次；resume 时只加载当前历史窗口中的轮次"""
+
+    def __init__(self, store, session_id, model=None, title=None, base=0, next_seq=0):
+        self.store = store
+        self.id = session_id
+        self.model = model
+        self.title = title
+        self.base = base  # 加载到内存中的第一条消息的序号
+        self.next_seq = next_seq
+        self.messages = []  # resume 时加载的窗口中的消息
+        self.summary = None
+
+    def add_exchange(self, user_input, reply, messages=None, timer=None, model=None):
+        """一轮问答成功后调用，追加用户消息和回复；messages 是这轮实际发送的消息，用来统计 prompt 大小"""
+        model = model or self.model
+        if self.title is None:
+            self.title = " ".join(user_input.split())[:40]
+        self.store.append(self, "user", user_input)
+        self.store.append(
+            self,
+            "assistant",
+            reply,
+            model=model,
+            ttft=timer.ttft if timer else None,
+            duration=timer.duration if timer else None,
+            prompt_tokens=sum(message_tokens(m) for m in messages) if messages else None,
+            completion_tokens=estimate_tokens(reply),
+        )
+
+    def checkpoint(self, history):
+        """记录历史窗口的起始位置和摘要，resume 时从这里开始加载"""
+        self.store.update_window(self, self.base + history.start, history.summary)
+
+    def restore(self, history):
+        """把 resume 时加载的消息和摘要放回 ConversationHistory"""
+        history.restore(self.messages, self.summary)
+
+
+class SessionStore:
+    """保存在 SQLite 中的对话记录
+
+    turns 表只追加不修改，每轮记录模型、首 token 时间、耗时和 token 数；sessions 表是索引，
+    记录每个会话的标题、轮数、更新时间和当前历史窗口的起始位置。列出会话只读索引，
+    恢复会话只按 (session_id, seq) 主键读取窗口中的轮次，和会话的总长度无关。
+    Markdown 记录由 export_markdown() 按需生成。
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # GUI 会在工作线程里写入，所以允许跨线程使用同一个连接
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                created REAL,
+                updated REAL,
+                model TEXT,
+                title TEXT,
+                turns INTEGER DEFAULT 0,
+                window_start INTEGER DEFAULT 0,
+                summary TEXT
+            )"""
+        )
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT,
+                seq INTEGER,
+                role TEXT,
+                content TEXT,
+                model TEXT,
+                created REAL,
+                ttft REAL,
+                duration REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                PRIMARY KEY (session_id, seq)
+            )"""
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)"
+        )
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """根据 config.txt 中的 session_* 配置项创建，session_enabled 为 false 时返回 None"""
+        if config.get("session_enabled", "true").lower() != "true":
+            return None
+        return cls(config.get("session_path", DEFAULT_PATH))
+
+    def create(self, model=None):
+        """新建一个会话，标题在第一轮问答后设置"""
+        now = time.time()
+        session_id = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{secrets.token_hex(2)}"
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions (id, created, updated, model) VALUES (?, ?, ?, ?)",
+                (session_id, now, now, model),
+            )
+            self._db.commit()
+        return Session(self, session_id, model)
+
+    def open(self, resume=None, model=None):
+        """resume 为 None 时新建会话，为 "latest" 时继续最近的会话（没有时新建），否则按 id 恢复"""
+        if resume == "latest":
+            resume = self.latest()
+        if resume is None:
+            return self.create(model)
+        return self.resume(resume)
+
+    def append(self, session, role, content, model=None, **stats):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO turns (session_id, seq, role, content, model, created, ttft, duration, "
+                "prompt_tokens, completion_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session.id,
+                    session.next_seq,
+                    role,
+                    content,
+                    model,
+                    now,
+                    stats.get("ttft"),
+                    stats.get("duration"),
+                    stats.get("prompt_tokens"),
+                    stats.get("completion_tokens"),
+                ),
+            )
+            session.next_seq += 1
+            self._db.execute(
+                "UPDATE sessions SET updated = ?, turns = ?, title = ?, model = COALESCE(?, model) "
+                "WHERE id = ?",
+                (now, session.next_seq, session.title, model, session.id),
+            )
+            self._db.commit()
+
+    def update_window(self, session, window_start, summary):
+        with self._lock:
+            self._db.execute(
+                "UPDATE sessions SET window_start = ?, summary = ? WHERE id = ?",
+                (window_start, summary, session.id),
+            )
+            self._db.commit()
+
+    def recent(self, limit=20):
+        """最近更新的会话，只读索引"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, created, updated, model, title, turns FROM sessions "
+                "WHERE turns > 0 ORDER BY updated DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {
+                "id": row[0],
+                "created": time.strftime("%Y-%m-%d %H:%M", time.localtime(row[1])),
+                "updated": time.strftime("%Y-%m-%d %H:%M", time.localtime(row[2])),
+                "model": row[3],
+                "title": row[4],
+                "turns": row[5],
+            }
+            for row in rows
+        ]
+
+    def latest(self):
+        """最近更新的会话 id，没有时返回 None"""
+        sessions = self.recent(1)
+        return sessions[0]["id"] if sessions else None
+
+    def resume(self, session_id):
+        """恢复一个会话，只加载当前历史窗口中的轮次；会话不存在时抛出 KeyError"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT model, title, turns, window_start, summary FROM sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"没有找到会话 {session_id}")
+            model, title, turns, window_start, summary = row
+            messages = self._db.execute(
+                "SELECT role, content FROM turns WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (session_id, window_start),
+            ).fetchall()
+        session = Session(self, session_id, model, title, base=window_start, next_seq=turns)
+        session.messages = [{"role": role, "content": content} for role, content in messages]
+        session.summary = summary
+        return session
+
+    def turns(self, session_id):
+        """一个会话的全部轮次，导出时使用"""
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT role, content, model, created, ttft, duration, prompt_tokens, "
+                "completion_tokens FROM turns WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            )
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def export_markdown(self, session_id, header=True):
+        """把会话渲染成 Markdown，格式和 main_md.py 实时写入的记录一致；header=False 时不写标题"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT title FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"没有找到会话 {session_id}")
+        parts = [f"# {row[0] or session_id}\n"] if header else []
+        for turn in self.turns(session_id):
+            if turn["role"] == "user":
+                parts.append(f"## **DeliXi:** \n{turn['content']}\n## **DeepSeek:** \n")
+                continue
+            content = turn["content"].replace("<think>", "**Thinking...**\n")
+            content = content.replace("</think>", "\n**End of thinking**\n\n---\n")
+            parts.append(content)
+            if turn["duration"] is not None:
+                parts.append(
+                    f"\n\n> {turn['model']}，首 token {turn['ttft'] or 0:.2f}s，"
+                    f"耗时 {turn['duration']:.1f}s，约 {turn['completion_tokens']} token"
+                )
+            parts.append("\n\n")
+        return "".join(parts)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列出保存的对话，或者把对话导出为 Markdown")
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="列出最近的会话")
+    list_parser.add_argument("-n", type=int, default=20)
+    export_parser = commands.add_parser("export", help="导出为 Markdown")
+    export_parser.add_argument("session", nargs="?", help="会话 id，默认最近的会话")
+    export_parser.add_argument("-o", "--output", help="输出文件，默认打印到终端")
+    args = parser.parse_args()
+
+    store = SessionStore(args.path)
+    try:
+        if args.command == "list":
+            for s in store.recent(args.n):
+                print(f"{s['id']}  {s['updated']}  {s['turns']:>3} 条  {s['model'] or ''}  {s['title'] or ''}")
+            return
+        session_id = args.session or store.latest()
+        if session_id is None:
+            print("还没有保存的会话")
+            return
+        text = store.export_markdown(session_id)
+        if args.output:
+            if os.path.dirname(args.output):
+                os.makedirs(os.path.dirname(args.output), exist_ok=True)
+            with open(args.output, "w", encoding="utf-8") as file:
+                file.write(text)
+        else:
+            print(text)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import threading
+from metrics import get_metrics
+
+
+class FlightAbandoned(Exception):
+    """所有订阅者都离开后提前停止的生成，回复不完整，不能当作正常结束"""
+
+
+class Flight:
+    """一次正在进行的上游生成，保存已经产出的所有块，每个订阅者按自己的进度读取
+
+    中途加入的订阅者先从头回放已经产出的块，再和其他订阅者一起等待新的块。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def subscribe(self):
+        """产出这次生成的所有块；上游出错时在读完已有的块之后抛出同样的异常"""
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                done = self.done
+                error = self.error
+            index += len(chunks)
+            yield from chunks
+            if done and index == len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """相同的请求同时进行时只向上游发送一次，结果分发给所有订阅者
+
+    第一个请求在后台线程中读取上游的流，之后到达的相同请求直接订阅这次生成；
+    所有订阅者都离开后停止读取上游。生成结束后不再保留结果，之后的相同请求会重新生成
+    （需要复用已经完成的回复请用 ResponseCache）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0  # 实际发往上游的请求数
+        self.joined = 0  # 加入已有生成的请求数，即省下的生成次数
+        self.replayed = 0  # 加入时回放的块数
+        self.abandoned = 0  # 所有订阅者都离开、提前停止的生成
+
+    def stream(self, key, produce):
+        """produce() 返回上游的迭代器，相同 key 的请求共用同一次生成，产出同样的块"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = Flight(key)
+                self._flights[key] = flight
+                self.leaders += 1
+                flight.subscribers += 1
+                threading.Thread(target=self._pump, args=(flight, produce), daemon=True).start()
+            else:
+                self.joined += 1
+                self.replayed += len(flight.chunks)
+                flight.subscribers += 1
+                get_metrics().inc("single_flight_deduplicated")
+        try:
+            yield from flight.subscribe()
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+
+    def _pump(self, flight, produce):
+        error = None
+        chunks = None
+        try:
+            chunks = produce()
+            for chunk in chunks:
+                with self._lock:
+                    # 判断和移除在同一次加锁中完成，之后到达的相同请求不会再加入这次生成
+                    if not flight.subscribers:
+                        self.abandoned += 1
+                        self._remove(flight)
+                        error = FlightAbandoned("所有订阅者都已离开，生成提前停止")
+                        break
+                flight.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            # 先从表中移除再结束，结束之后到达的请求会重新生成，不会读到已经结束的 Flight
+            with self._lock:
+                self._remove(flight)
+            flight.finish(error)
+
+    def _remove(self, flight):
+        # 调用方需持有 self._lock
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self):
+        with self._lock:
+            total = self.leaders + self.joined
+            return {
+                "in_flight": len(self._flights),
+                "upstream_requests": self.leaders,
+                "deduplicated": self.joined,
+                "saved_ratio": round(self.joined / total, 3) if total else 0.0,
+                "replayed_chunks": self.replayed,
+                "abandoned": self.abandoned,
+            }
@@ -0,0 +1,119 @@
+import json
+
+# 安装了 orjson 时用它解析 JSON，速度比标准库快好几倍
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+
+    def loads(payload):
+        # 先解码成 str 再交给 json，省掉 json.loads 对 bytes 的编码探测
+        return json.loads(payload.decode("utf-8"))
+
+
+class SSEParser:
+    """增量式 SSE 解析器，直接处理网络读到的原始字节
+
+    事件可以被拆散在多次读取中，也可以一次读到多个事件；每个事件以空行结束，
+    多行 data 按规范用换行拼接。解析出的 JSON 对象由 feed() 以列表形式返回，
+    收到 [DONE] 后 done 为 True。
+    """
+
+    def __init__(self):
+        self._pending = []  # 还没凑成完整事件的字节块
+        self._ends_with_newline = False
+        self._held_cr = False
+        self.done = False
+        self.usage = None  # 最后一个带 usage 字段的事件中的统计信息
+
+    def feed(self, chunk):
+        """喂入一段字节，返回其中所有完整事件解析出的 JSON 对象"""
+        if self._held_cr or b"\r" in chunk:
+            chunk = self._normalize(chunk)
+        if not chunk:
+            return []
+
+        # 这一块里没有事件分隔符时只需暂存，不做任何拼接和切分
+        if b"\n\n" not in chunk and not (self._ends_with_newline and chunk[0] == 10):
+            self._pending.append(chunk)
+            self._ends_with_newline = chunk[-1] == 10
+            return []
+
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = b"".join(self._pending)
+        *events, rest = chunk.split(b"\n\n")
+        self._pending = [rest] if rest else []
+        self._ends_with_newline = rest[-1:] == b"\n"
+        return self._parse(events)
+
+    def _normalize(self, chunk):
+        """把 \r\n 和单独的 \r 统一成 \n"""
+        if self._held_cr:
+            chunk = b"\r" + chunk
+            self._held_cr = False
+        # 结尾单独的 \r 可能是被拆开的 \r\n，留到下一次再处理
+        if chunk.endswith(b"\r"):
+            chunk = chunk[:-1]
+            self._held_cr = True
+        return chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    def close(self):
+        """流结束时处理缓冲区里最后一个没有以空行结尾的事件"""
+        rest = b"".join(self._pending).strip()
+        self._pending = []
+        self._ends_with_newline = False
+        self._held_cr = False
+        return self._parse([rest]) if rest else []
+
+    def _parse(self, events):
+        results = []
+        for event in events:
+            if event.startswith(b"data: ") and b"\n" not in event:
+                # 绝大多数事件只有一行 data，走快速路径
+                payload = event[6:]
+            else:
+                lines = [
+                    line[5:].lstrip(b" ")
+                    for line in event.split(b"\n")
+                    if line.startswith(b"data:")
+                ]
+                if not lines:
+                    continue
+                payload = b"\n".join(lines)
+            if payload == b"[DONE]":
+                self.done = True
+                continue
+            try:
+                obj = loads(payload)
+            except ValueError:
+                continue
+            if isinstance(obj, dict) and obj.get("usage"):
+                self.usage = obj["usage"]
+            results.append(obj)
+        return results
+
+
+def delta_content(obj):
+    """从一个流式事件中取出 delta 文本，没有时返回空字符串"""
+    try:
+        return obj["choices"][0]["delta"].get("content") or ""
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def iter_events(chunks, parser=None):
+    """把一串原始字节块转换为 JSON 事件"""
+    parser = parser or SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def iter_deltas(chunks, parser=None):
+    """把一串原始字节块转换为非空的 delta 文本"""
+    for obj in iter_events(chunks, parser):
+        content = delta_content(obj)
+        if content:
+            yield content
@@ -1,5 +1,20 @@
+import argparse
 import json
-import requests  # 使用 requests 库来进行 HTTP 请求
+import time
+from concurrent.futures import ThreadPoolExecutor
+from model_catalog import ModelCatalog, configured_models
+
+
+# 读取配置文件并解析
+def read_config(file_path):
+    config = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+    return config
 
 
 def custom_converter(o):
@@ -20,55 +35,143 @@ def pretty_print(title, data):
     print(f"{'='*30}\n")
 
 
-def main():
-    # 本地转发的地址和端口
-    base_url = "http://localhost:8888/v1/"  # 通过本地转发访问模型
-    api_key = "ollama"  # 必传参数，但实际可能被忽略
+def build_probes(config, max_tokens, pool=None):
+    """要检查的接口：模型列表、每个后端节点的模型列表，以及每个配置的模型的信息和补全接口
 
-    # 创建请求头
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-    }
+    只有 HTTP 客户端有节点池（pool 不为 None，即配置了两个以上的节点）时才单独检查每个节点。
+    """
+    probes = [{"name": "list models", "method": "GET", "path": "models"}]
+    if pool is not None:
+        # 每个后端节点单独检查一次，找出有问题的节点
+        for i, backend in enumerate(pool.backends):
+            probes.append(
+                {"name": "list models", "method": "GET", "path": "models", "backend": i, "label": backend.name}
+            )
+    embedding_model = config.get("embedding_model")
+    prompt = "Say this is a test"
+    for model in configured_models(config):
+        probes.append({"name": "model info", "method": "GET", "path": f"models/{model}", "model": model})
+        if model == embedding_model:
+            probes.append(
+                {"name": "embeddings", "method": "POST", "path": "embeddings", "model": model,
+                 "json": {"model": model, "input": [prompt]}}
+            )
+            continue
+        probes.append(
+            {"name": "chat", "method": "POST", "path": "chat/completions", "model": model,
+             "json": {"model": model, "messages": [{"role": "user", "content": prompt}],
+                      "stream": False, "max_tokens": max_tokens}}
+        )
+        probes.append(
+            {"name": "completion", "method": "POST", "path": "completions", "model": model,
+             "json": {"model": model, "prompt": prompt, "stream": False, "max_tokens": max_tokens}}
+        )
+    return probes
 
-    # 1. 第一个问题：简单的聊天补全
-    # 问题：Say this is a test
-    chat_payload = {
-        "messages": [{"role": "user", "content": "Say this is a test"}],
-        "model": "deepseek-r1:70b",
-    }
-    chat_response = requests.post(
-        f"{base_url}chat/completions", json=chat_payload, headers=headers
-    )
-    chat_completion = chat_response.json()
-    pretty_print("Chat Completion 输出 (问题1)", chat_completion)
-    print("回答：第一个问题已完成。")
-
-    # 3. 第三个问题：普通文本补全
-    # 问题：Say this is a test
-    text_payload = {
-        "prompt": "Say this is a test",
-        "model": "deepseek-r1:70b",
+
+def run_probe(http, probe):
+    """发送一个检查请求，返回状态码、耗时和响应内容；连接错误等记录在 error 中"""
+    result = {
+        "endpoint": f"{probe['method']} /{probe['path']}",
+        "name": probe["name"],
+        "model": probe.get("model"),
+        "backend": probe.get("label"),
+        "status": None,
+        "latency": None,
+        "error": None,
     }
-    text_response = requests.post(
-        f"{base_url}completions", json=text_payload, headers=headers
-    )
-    completion = text_response.json()
-    pretty_print("Text Completion 输出 (问题3)", completion)
-    print("回答：第三个问题已完成。")
-
-    # 4. 第四个问题：列出所有模型
-    models_response = requests.get(f"{base_url}models", headers=headers)
-    list_models = models_response.json()
-    pretty_print("List Models 输出 (问题4)", list_models)
-    print("回答：第四个问题已完成。")
-
-    # 5. 第五个问题：检索指定模型的信息
-    model_info_response = requests.get(
-        f"{base_url}models/deepseek-r1:70b", headers=headers
+    start = time.perf_counter()
+    try:
+        if "backend" in probe:
+            # 直接访问指定节点的转发端口，不经过节点池的选择
+            backend = http.pool.backends[probe["backend"]]
+            response = http.session.request(
+                probe["method"], http.url(probe["path"], backend.base_url), timeout=http.timeout
+            )
+        else:
+            response = http.request(probe["method"], probe["path"], json=probe.get("json"))
+        result["status"] = response.status_code
+        try:
+            result["body"] = response.json()
+        except ValueError:
+            result["body"] = response.text[:200]
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["latency"] = round(time.perf_counter() - start, 3)
+    result["ok"] = result["status"] == 200
+    return result
+
+
+def print_report(results, elapsed):
+    print(f"\n{'接口':<24} {'模型 / 节点':<28} {'状态':>6} {'耗时':>9}")
+    for r in results:
+        target = r["model"] or r["backend"] or "-"
+        status = r["status"] if r["status"] is not None else "ERR"
+        print(f"{r['endpoint']:<24} {target:<28} {status:>6} {r['latency']:>8.3f}s")
+        if r["error"]:
+            print(f"    {r['error']}")
+        elif not r["ok"]:
+            print(f"    {str(r['body'])[:200]}")
+    serial = sum(r["latency"] for r in results)
+    failed = sum(not r["ok"] for r in results)
+    print(
+        f"\n{len(results)} 个检查，{failed} 个失败；并发检查耗时 {elapsed:.2f}s"
+        f"（逐个检查约 {serial:.2f}s）"
     )
-    model_info = model_info_response.json()
-    pretty_print("Retrieve Model 输出 (问题5)", model_info)
-    print("回答：第五个问题已完成。")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发检查各个接口和配置的模型，结果写入本地的模型目录")
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument("--max-tokens", type=int, default=16, help="补全接口的回复长度上限")
+    parser.add_argument("--verbose", action="store_true", help="打印每个接口的完整响应")
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    # 所有检查同时进行，连接池要能容纳所有请求（每个后端节点最多多一个检查）
+    backends = [item for item in config.get("backends", "").split(",") if item.strip()]
+    size = len(build_probes(config, args.max_tokens)) + len(backends)
+    config["http_pool_size"] = str(max(size, int(config.get("http_pool_size", 4))))
+
+    from http_client import get_shared_client, close_shared_client
+    from tunnel import LazyTunnel
+
+    local_port = int(config.get("local_port", 8888))
+    http = get_shared_client(config, local_port)
+    probes = build_probes(config, args.max_tokens, http.pool)
+    tunnel = LazyTunnel.from_config(config, probe=False).start()
+    try:
+        start = time.perf_counter()
+        tunnel.wait()
+        connected = time.perf_counter() - start
+        if not config.get("api_base"):
+            print(f"SSH 隧道建立耗时 {connected:.2f}s")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(len(probes)) as executor:
+            results = list(executor.map(lambda probe: run_probe(http, probe), probes))
+        elapsed = time.perf_counter() - start
+
+        if args.verbose:
+            for r in results:
+                pretty_print(f"{r['endpoint']} {r['model'] or r['backend'] or ''}", r.get("body"))
+        print_report(results, elapsed)
+
+        listing = results[0]
+        catalog = ModelCatalog.from_config(config)
+        if catalog is not None and listing["ok"]:
+            model_info = {r["model"]: r["body"] for r in results if r["name"] == "model info" and r["ok"]}
+            diagnostics = {
+                "time": time.time(),
+                "elapsed": round(elapsed, 3),
+                "model_info": model_info,
+                "results": [{k: v for k, v in r.items() if k != "body"} for r in results],
+            }
+            catalog.save(listing["body"], diagnostics)
+            print(f"模型目录已写入 {catalog.path}")
+    finally:
+        close_shared_client()
+        tunnel.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+import re
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# 没有闭合的 <think>（回复被中断）一直算到结尾
+_THINK_RE = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+
+
+class ThinkParser:
+    """增量识别流式回复中的 <think> 标签，把推理内容和正式回答分开
+
+    标签被拆到几个 delta 中也能识别：可能是标签开头的结尾部分先留着，等下一个 delta 再判断。
+    feed() 返回 [(is_think, text), ...]；也可以传入回调，推理内容交给 on_think，
+    正式回答交给 on_answer，进入和离开推理部分时调用 on_state(in_think)。
+    """
+
+    def __init__(self, on_think=None, on_answer=None, on_state=None):
+        self.on_think = on_think
+        self.on_answer = on_answer
+        self.on_state = on_state
+        self.in_think = False
+        self.seen_think = False
+        self._held = ""
+
+    def feed(self, text):
+        text = self._held + text
+        self._held = ""
+        out = []
+        while text:
+            tag = THINK_CLOSE if self.in_think else THINK_OPEN
+            pos = text.find(tag)
+            if pos >= 0:
+                if pos:
+                    self._emit(out, text[:pos])
+                text = text[pos + len(tag) :]
+                self.in_think = not self.in_think
+                self.seen_think = True
+                if self.on_state is not None:
+                    self.on_state(self.in_think)
+                continue
+            keep = _partial_tag_length(text, tag)
+            if keep:
+                self._held = text[-keep:]
+                text = text[:-keep]
+            if text:
+                self._emit(out, text)
+            break
+        return out
+
+    def close(self):
+        """流结束时调用，交出留着的半个标签（它最终不是标签）"""
+        held, self._held = self._held, ""
+        out = []
+        if held:
+            self._emit(out, held)
+        return out
+
+    def _emit(self, out, text):
+        out.append((self.in_think, text))
+        sink = self.on_think if self.in_think else self.on_answer
+        if sink is not None:
+            sink(text)
+
+
+def _partial_tag_length(text, tag):
+    """text 的结尾和 tag 的开头重合的最大长度"""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+def strip_think(text):
+    """去掉回复中的 <think> 推理部分"""
+    return _THINK_RE.sub("", text).strip()
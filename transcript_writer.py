@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+
+
+class TranscriptWriter:
+    """带缓冲的 Markdown 记录写入器
+
+    整个会话只打开一次文件，流式的 delta 先攒在内存里，超过 flush_interval 秒或
+    flush_bytes 字节才真正写一次文件，VSCode 预览依旧能看到实时更新。
+    background=True 时由后台线程定时写入，生成回复的线程完全不碰磁盘；
+    fsync_on_turn=True 时只在每轮对话结束时 fsync 一次。
+    """
+
+    def __init__(
+        self,
+        file_name,
+        mode="a",
+        flush_interval=0.2,
+        flush_bytes=4096,
+        background=False,
+        fsync_on_turn=False,
+    ):
+        self.file = open(file_name, mode, encoding="utf-8")
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync_on_turn = fsync_on_turn
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()  # 保护缓冲区
+        self._io_lock = threading.Lock()  # 保证写文件的顺序
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    @classmethod
+    def from_config(cls, config, file_name, mode="a"):
+        """根据 config.txt 中的 md_* 配置项创建写入器"""
+        return cls(
+            file_name,
+            mode=mode,
+            flush_interval=float(config.get("md_flush_interval", 0.2)),
+            flush_bytes=int(config.get("md_flush_bytes", 4096)),
+            background=config.get("md_background_writer", "false").lower() == "true",
+            fsync_on_turn=config.get("md_fsync_on_turn", "false").lower() == "true",
+        )
+
+    def write(self, text):
+        """追加一段文本，是否立即落盘由时间和字节阈值决定"""
+        if not text:
+            return
+        with self._lock:
+            self._buffer.append(text)
+            self._buffered_bytes += len(text.encode("utf-8"))
+            if self._thread is not None:
+                if self._buffered_bytes >= self.flush_bytes:
+                    self._wakeup.notify()
+                return
+            due = (
+                self._buffered_bytes >= self.flush_bytes
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self._write_out()
+
+    def start_turn(self, user_input):
+        """写入一轮对话的标题和用户问题，并立即刷新让预览尽快显示"""
+        self.write(f"## **DeliXi:** \n{user_input}\n## **DeepSeek:** \n")
+        self.flush()
+
+    def end_turn(self):
+        """一轮对话结束：写入空行、刷新，需要时 fsync 保证落盘"""
+        self.write("\n\n")
+        self.flush(sync=self.fsync_on_turn)
+
+    def flush(self, sync=False):
+        self._write_out(sync=sync)
+
+    def close(self):
+        if self._closed:
+            return
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush(sync=self.fsync_on_turn)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _take(self):
+        # 调用方需持有 self._lock
+        data = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        return data
+
+    def _write_out(self, sync=False):
+        # 先拿到 _io_lock 再取缓冲区，取出和写入之间不会有别的线程插进来，
+        # 后台线程和 flush() 写入的顺序与 write() 的顺序一致
+        with self._io_lock:
+            with self._lock:
+                data = self._take()
+            if data:
+                self.file.write(data)
+                self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def _run(self):
+        """后台线程：每 flush_interval 秒（或缓冲区满时）写一次文件"""
+        while True:
+            with self._lock:
+                if not self._closed:
+                    self._wakeup.wait(self.flush_interval)
+                closed = self._closed
+            self._write_out()
+            if closed:
+                return
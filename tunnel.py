@@ -0,0 +1,295 @@
+import threading
+import time
+from backend_pool import backend_addresses
+from metrics import get_metrics
+from model_catalog import ModelCatalog
+
+
+def create_forwarder(config):
+    """根据配置创建 SSHTunnelForwarder，sshtunnel（以及 paramiko、cryptography）到这里才导入
+
+    配置了多个 backends 时，第 i 个节点转发到 local_port + i。tunnel_transports 大于 1
+    或者指定了 ssh_ciphers 时改用 tunnel_pool.TunnelPool，新连接分散到多条 SSH 连接上；
+    否则所有节点和所有流共用一条 SSH 连接。
+    """
+    local_port = int(config.get("local_port", 8888))
+    addresses = backend_addresses(config)
+    local_addresses = [("localhost", local_port + i) for i in range(len(addresses))]
+    if int(config.get("tunnel_transports", 1)) > 1 or config.get("ssh_ciphers"):
+        from tunnel_pool import TunnelPool
+
+        return TunnelPool.from_config(config, addresses, local_addresses)
+
+    from sshtunnel import SSHTunnelForwarder
+
+    return SSHTunnelForwarder(
+        (config.get("hostname"), int(config.get("port", 22))),
+        ssh_username=config.get("username"),
+        ssh_password=config.get("password"),
+        remote_bind_addresses=addresses,
+        local_bind_addresses=local_addresses,
+        set_keepalive=float(config.get("tunnel_keepalive_interval", 15)),
+        compression=config.get("ssh_compression", "false").lower() == "true",
+    )
+
+
+class LazyTunnel:
+    """在后台线程中建立 SSH 隧道并检查端口转发，不阻塞界面或输入提示的显示
+
+    第一次真正发送请求前调用 wait()，隧道还没建好时会在这里等待；
+    连接或检查失败时 wait() 抛出对应的异常。
+
+    隧道建立后同一个线程继续做健康检查：每 check_interval 秒向 SSH 服务器发一次
+    keepalive 请求，keepalive_timeout 秒内没有回应就认为连接已断开并自动重连。
+    重连期间 HTTP 客户端通过 wait_connected() 排队等待，重连成功后再发送请求。
+    """
+
+    def __init__(
+        self,
+        config,
+        probe=True,
+        check_interval=5.0,
+        keepalive_timeout=10.0,
+        max_backoff=30.0,
+    ):
+        self.config = config
+        self.probe = probe
+        self.check_interval = check_interval
+        self.keepalive_timeout = keepalive_timeout
+        self.max_backoff = max_backoff
+        self.server = None
+        self.models = None  # /v1/models 的返回结果
+        self.models_cached = False  # 模型列表是否来自本地的模型目录
+        self.error = None
+        self.reconnects = 0
+        self.generation = 0  # 每次连接成功加一，用来判断请求期间是否发生过重连
+        self.started_at = None
+        self.connected_since = None
+        self.downtime = 0.0
+        self.listeners = []  # 状态变化时调用 listener(state)，state 为 connected/reconnecting
+        self._ready = threading.Event()
+        self._connected = threading.Event()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @classmethod
+    def from_config(cls, config, probe=True):
+        """根据 config.txt 中的 tunnel_* 配置项创建"""
+        return cls(
+            config,
+            probe=probe,
+            check_interval=float(config.get("tunnel_check_interval", 5)),
+            keepalive_timeout=float(config.get("tunnel_keepalive_timeout", 10)),
+            max_backoff=float(config.get("tunnel_max_backoff", 30)),
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        if self.config.get("api_base"):
+            self._run_direct()
+            return
+        try:
+            server = create_forwarder(self.config)
+            with self._lock:
+                if self._stopped:
+                    return
+                self.server = server
+            connect_start = time.perf_counter()
+            server.start()
+            get_metrics().observe("tunnel_connect_seconds", time.perf_counter() - connect_start)
+            self.started_at = time.monotonic()
+            self._set_connected()
+            self._attach_client()
+            if self.probe:
+                self.models = self._probe()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self._ready.set()
+        self._monitor()
+
+    def _run_direct(self):
+        """配置了 api_base（比如本地网关）时不建立 SSH 隧道，只检查接口是否可用"""
+        try:
+            self.started_at = time.monotonic()
+            self._set_connected()
+            if self.probe:
+                self.models = self._probe()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._ready.set()
+
+    def _attach_client(self):
+        """让共享的 HTTP 客户端在发送请求前经过隧道的连接状态检查"""
+        from http_client import get_shared_client
+
+        local_port = int(self.config.get("local_port", 8888))
+        get_shared_client(self.config, local_port).tunnel = self
+
+    def _probe(self):
+        """检查端口转发是否正常工作，返回模型列表
+
+        本地的模型目录没有过期时直接返回其中的列表，不再经过隧道请求一次 /v1/models；
+        这时端口转发的问题要到第一次请求时才会发现。
+        """
+        catalog = ModelCatalog.from_config(self.config)
+        if catalog is not None:
+            models = catalog.load()
+            if models is not None:
+                self.models_cached = True
+                return models
+
+        from http_client import get_shared_client
+
+        local_port = int(self.config.get("local_port", 8888))
+        response = get_shared_client(self.config, local_port).list_models()
+        if response.status_code != 200:
+            raise ConnectionError(
+                f"Failed to access DeepSeek API via port forwarding, Status code: {response.status_code}"
+            )
+        models = response.json()
+        if catalog is not None:
+            catalog.save(models)
+        return models
+
+    def _monitor(self):
+        while not self._stopped:
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            if not self._connected.is_set() or not self.is_healthy():
+                self._reconnect()
+
+    def is_healthy(self):
+        """向 SSH 服务器发送 keepalive 请求并等待回应，用来发现已经断开但还没报错的连接"""
+        server = self.server
+        # TunnelPool 有多条 SSH 连接，只要有一条正常就可以转发，断开的那条在用到时重连
+        if hasattr(server, "transports"):
+            transports = [t for t in server.transports if t is not None and t.is_active()]
+        else:
+            transport = getattr(server, "_transport", None)
+            transports = [transport] if transport is not None and transport.is_active() else []
+        if not transports:
+            return False
+        # paramiko 的 global_request 没有超时参数，放到单独的线程里等待
+        checkers = [
+            threading.Thread(
+                target=transport.global_request,
+                args=("keepalive@openssh.com",),
+                kwargs={"wait": True},
+                daemon=True,
+            )
+            for transport in transports
+        ]
+        for checker in checkers:
+            checker.start()
+        deadline = time.monotonic() + self.keepalive_timeout
+        for checker in checkers:
+            checker.join(max(0.0, deadline - time.monotonic()))
+        # 服务器不认识这个请求时回复失败（返回 None），同样说明连接是通的
+        return any(
+            not checker.is_alive() and transport.is_active()
+            for checker, transport in zip(checkers, transports)
+        )
+
+    def _reconnect(self):
+        self._set_disconnected()
+        lost_at = time.monotonic()
+        delay = 1.0
+        while not self._stopped:
+            try:
+                self.server.stop(force=True)
+                connect_start = time.perf_counter()
+                self.server.start()
+                get_metrics().observe(
+                    "tunnel_connect_seconds", time.perf_counter() - connect_start
+                )
+            except Exception as e:
+                print(f"SSH 隧道重连失败，{delay:.0f} 秒后重试: {e}")
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            self.downtime += time.monotonic() - lost_at
+            self.reconnects += 1
+            get_metrics().set_gauge("tunnel_reconnects", self.reconnects)
+            get_metrics().set_gauge("tunnel_downtime_seconds", round(self.downtime, 3))
+            self._set_connected()
+            return
+
+    def _set_connected(self):
+        self.connected_since = time.monotonic()
+        self.generation += 1
+        self._connected.set()
+        self._notify("connected")
+
+    def _set_disconnected(self):
+        if not self._connected.is_set():
+            return
+        self._connected.clear()
+        self._notify("reconnecting")
+
+    def _notify(self, state):
+        for listener in list(self.listeners):
+            try:
+                listener(state)
+            except Exception:
+                pass
+
+    def report_failure(self):
+        """请求遇到连接错误时调用：立即检查隧道，断开时唤醒后台线程重连"""
+        if self._connected.is_set() and not self.is_healthy():
+            self._set_disconnected()
+            self._wakeup.set()
+
+    def wait_connected(self, timeout=None):
+        """等待隧道处于连接状态，返回当前的连接序号；重连期间新的请求在这里排队"""
+        if not self._connected.wait(timeout):
+            if self.error is not None:
+                raise self.error
+            raise TimeoutError("等待 SSH 隧道重连超时")
+        return self.generation
+
+    @property
+    def ready(self):
+        return self._ready.is_set() and self.error is None
+
+    def wait(self, timeout=None):
+        """等待隧道建立完成，返回 SSHTunnelForwarder"""
+        if not self._ready.wait(timeout):
+            raise TimeoutError("SSH 隧道建立超时")
+        if self.error is not None:
+            raise self.error
+        return self.server
+
+    def stats(self):
+        """返回隧道的在线时间（秒）、重连次数和累计断线时间"""
+        now = time.monotonic()
+        connected = self._connected.is_set()
+        stats = {
+            "connected": connected,
+            "uptime": round(now - self.connected_since, 1) if connected else 0.0,
+            "total_time": round(now - self.started_at, 1) if self.started_at else 0.0,
+            "downtime": round(self.downtime, 1),
+            "reconnects": self.reconnects,
+        }
+        # 使用 TunnelPool 时附带每条 SSH 连接的通道数和吞吐量
+        if hasattr(self.server, "stats"):
+            stats["transports"] = self.server.stats()
+        return stats
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            server = self.server
+        self._wakeup.set()
+        if server is not None:
+            server.stop()
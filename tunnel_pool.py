@@ -0,0 +1,494 @@
+import argparse
+import itertools
+import json
+import logging
+import random
+import select
+import socket
+import threading
+import time
+from metrics import get_metrics
+
+# 本地监听端口上的连接数据按块转发，块太小时加解密线程的开销占比太大
+BUFFER_SIZE = 64 * 1024
+
+
+class PooledTransport:
+    """池中的一条 SSH 连接（paramiko.Transport），统计经过它的通道数和字节数"""
+
+    def __init__(self, index):
+        self.index = index
+        self.transport = None
+        self.active = 0  # 正在转发的通道数
+        self.channels = 0  # 累计打开的通道数
+        self.bytes_in = 0  # 从服务器收到的字节数
+        self.bytes_out = 0
+        self.connects = 0
+        self.lock = threading.Lock()  # 重连时持有，避免同一条连接被几个线程同时重建
+        self._last = (time.monotonic(), 0)  # 上次 stats() 时的时间和字节数，用来计算吞吐量
+
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    def stats(self):
+        now = time.monotonic()
+        total = self.bytes_in + self.bytes_out
+        last_time, last_total = self._last
+        self._last = (now, total)
+        cipher = self.transport.remote_cipher if self.transport is not None else None
+        return {
+            "active": self.is_active(),
+            "channels": self.active,
+            "total_channels": self.channels,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            # 两次 stats() 之间的平均吞吐量
+            "throughput_mb_s": round((total - last_total) / max(now - last_time, 1e-6) / 1e6, 3),
+            "cipher": cipher,
+            "connects": self.connects,
+        }
+
+
+class TunnelPool:
+    """建立 N 条 SSH 连接，把本地端口上的新连接分散到这些连接上转发
+
+    只用一条 SSH 连接时，所有并发的流都复用同一个 paramiko Transport：加解密都在它唯一的
+    后台线程里做，每个通道还受窗口大小限制，几个生成同时进行时就成了瓶颈。这里每个新的
+    本地连接选择当前通道数最少的 SSH 连接打开一个 direct-tcpip 通道；断开的 SSH 连接
+    在下次被选中时重新建立。接口和 SSHTunnelForwarder 用到的部分一致（start / stop），
+    LazyTunnel 可以直接替换。
+    """
+
+    def __init__(
+        self,
+        ssh_address,
+        username,
+        password,
+        remote_bind_addresses,
+        local_bind_addresses,
+        transports=2,
+        compression=False,
+        ciphers=None,
+        keepalive=15.0,
+        connect_timeout=10.0,
+    ):
+        self.ssh_address = ssh_address
+        self.username = username
+        self.password = password
+        self.remote_bind_addresses = list(remote_bind_addresses)
+        self.local_bind_addresses = list(local_bind_addresses)
+        self.compression = compression
+        self.ciphers = list(ciphers) if ciphers else None
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.pool = [PooledTransport(i) for i in range(transports)]
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, config, remote_bind_addresses, local_bind_addresses):
+        """根据 config.txt 中的 tunnel_transports / ssh_compression / ssh_ciphers 创建"""
+        ciphers = [c.strip() for c in config.get("ssh_ciphers", "").split(",") if c.strip()]
+        return cls(
+            (config.get("hostname"), int(config.get("port", 22))),
+            config.get("username"),
+            config.get("password"),
+            remote_bind_addresses,
+            local_bind_addresses,
+            transports=int(config.get("tunnel_transports", 2)),
+            compression=config.get("ssh_compression", "false").lower() == "true",
+            ciphers=ciphers or None,
+            keepalive=float(config.get("tunnel_keepalive_interval", 15)),
+        )
+
+    @property
+    def transports(self):
+        """当前所有的 paramiko Transport，LazyTunnel 用它们做 keepalive 检查"""
+        return [t.transport for t in self.pool]
+
+    def _connect(self, pooled):
+        import paramiko
+
+        sock = socket.create_connection(self.ssh_address, timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        transport.use_compression(self.compression)
+        if self.ciphers:
+            options = transport.get_security_options()
+            supported = [c for c in self.ciphers if c in options.ciphers]
+            if not supported:
+                raise ValueError(f"paramiko 不支持 ssh_ciphers 中的任何算法，可用的有 {options.ciphers}")
+            options.ciphers = supported
+        try:
+            transport.start_client(timeout=self.connect_timeout)
+            transport.auth_password(self.username, self.password)
+        except Exception:
+            transport.close()
+            raise
+        if self.keepalive:
+            transport.set_keepalive(int(self.keepalive))
+        old = pooled.transport
+        pooled.transport = transport
+        pooled.connects += 1
+        if old is not None:
+            old.close()
+
+    def start(self):
+        """并行建立所有 SSH 连接，然后开始监听本地端口；已经启动过时先停止再重新建立"""
+        self.stop()
+        self._stopped.clear()
+        errors = []
+
+        def connect(pooled):
+            try:
+                self._connect(pooled)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=connect, args=(t,), daemon=True) for t in self.pool]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 只要有一条连接成功就可以工作，其余的在用到时重试
+        if len(errors) == len(self.pool):
+            raise errors[0]
+        for local, remote in zip(self.local_bind_addresses, self.remote_bind_addresses):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(local)
+            listener.listen(64)
+            self._listeners.append(listener)
+            threading.Thread(target=self._accept, args=(listener, remote), daemon=True).start()
+
+    @property
+    def local_bind_ports(self):
+        return [listener.getsockname()[1] for listener in self._listeners]
+
+    def _accept(self, listener, remote):
+        while not self._stopped.is_set():
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._forward, args=(client, remote), daemon=True).start()
+
+    def _pick(self):
+        """选择通道最少的 SSH 连接，数量相同时轮流选择
+
+        断开的连接跳过，并在后台重连；全部断开时由调用方同步重连选中的那条。
+        """
+        with self._lock:
+            start = next(self._round_robin)
+            candidates = [self.pool[(start + i) % len(self.pool)] for i in range(len(self.pool))]
+            live = [t for t in candidates if t.is_active()]
+            pooled = min(live, key=lambda t: t.active) if live else candidates[0]
+            pooled.active += 1
+            pooled.channels += 1
+        if live:
+            for dead in candidates:
+                if not dead.is_active() and not dead.lock.locked():
+                    threading.Thread(target=self._revive, args=(dead,), daemon=True).start()
+        return pooled
+
+    def _revive(self, pooled):
+        try:
+            self._reconnect(pooled)
+        except Exception:
+            pass
+
+    def _forward(self, client, remote):
+        pooled = self._pick()
+        channel = None
+        try:
+            if not pooled.is_active():
+                self._reconnect(pooled)
+            channel = pooled.transport.open_channel(
+                "direct-tcpip", remote, client.getpeername(), timeout=self.connect_timeout
+            )
+            self._pump(client, channel, pooled)
+        except Exception as e:
+            get_metrics().inc("tunnel_channel_errors")
+            if not self._stopped.is_set():
+                print(f"SSH 通道 {pooled.index} 转发失败: {e}")
+        finally:
+            with self._lock:
+                pooled.active -= 1
+            if channel is not None:
+                channel.close()
+            client.close()
+
+    def _reconnect(self, pooled):
+        with pooled.lock:
+            if pooled.is_active():
+                return
+            self._connect(pooled)
+
+    def _pump(self, client, channel, pooled):
+        sockets = [client, channel]
+        while not self._stopped.is_set():
+            readable, _, _ = select.select(sockets, [], [], 1.0)
+            if client in readable:
+                data = client.recv(BUFFER_SIZE)
+                if not data:
+                    return
+                channel.sendall(data)
+                pooled.bytes_out += len(data)
+            if channel in readable:
+                data = channel.recv(BUFFER_SIZE)
+                if not data:
+                    return
+                client.sendall(data)
+                pooled.bytes_in += len(data)
+
+    def stop(self, force=False):
+        """关闭本地监听端口和所有 SSH 连接；force 参数只为和 SSHTunnelForwarder 兼容"""
+        self._stopped.set()
+        for listener in self._listeners:
+            listener.close()
+        self._listeners = []
+        for pooled in self.pool:
+            if pooled.transport is not None:
+                pooled.transport.close()
+
+    def stats(self):
+        with self._lock:
+            transports = [t.stats() for t in self.pool]
+        metrics = get_metrics()
+        for i, t in enumerate(transports):
+            metrics.set_gauge(f"tunnel_transport_{i}_channels", t["channels"])
+            metrics.set_gauge(f"tunnel_transport_{i}_throughput_mb_s", t["throughput_mb_s"])
+        return transports
+
+
+class _BenchServer:
+    """吞吐量测试用的进程内 SSH 服务器，接受任意密码，允许 direct-tcpip 转发"""
+
+    def __init__(self):
+        import paramiko
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        import paramiko
+
+        class Interface(paramiko.ServerInterface):
+            def __init__(self):
+                self.destinations = {}
+
+            def get_allowed_auths(self, username):
+                return "password"
+
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+                self.destinations[chanid] = destination
+                return paramiko.OPEN_SUCCEEDED
+
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            interface = Interface()
+            transport.start_server(server=interface)
+            threading.Thread(target=self._serve, args=(transport, interface), daemon=True).start()
+
+    def _serve(self, transport, interface):
+        while transport.is_active():
+            channel = transport.accept(1.0)
+            if channel is None:
+                continue
+            destination = interface.destinations.pop(channel.get_id())
+            target = socket.create_connection(destination)
+            threading.Thread(target=self._bridge, args=(channel, target), daemon=True).start()
+
+    @staticmethod
+    def _bridge(channel, target):
+        try:
+            while True:
+                readable, _, _ = select.select([channel, target], [], [])
+                if channel in readable:
+                    data = channel.recv(BUFFER_SIZE)
+                    if not data:
+                        return
+                    target.sendall(data)
+                if target in readable:
+                    data = target.recv(BUFFER_SIZE)
+                    if not data:
+                        return
+                    channel.sendall(data)
+        except OSError:
+            pass
+        finally:
+            channel.close()
+            target.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def _sse_block(size):
+    """和流式回复差不多的 SSE 数据，压缩率也接近真实的回复"""
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(2000)]
+    parts = []
+    length = 0
+    while length < size:
+        event = {"choices": [{"index": 0, "delta": {"content": " " + rng.choice(words)}}]}
+        line = b"data: " + json.dumps(event).encode() + b"\n\n"
+        parts.append(line)
+        length += len(line)
+    return b"".join(parts)[:size]
+
+
+def _start_source(size):
+    """每个连接收到一个字节的请求后发送 size 字节，模拟流式回复的下行数据"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+    block = _sse_block(BUFFER_SIZE)
+
+    def serve(conn):
+        with conn:
+            conn.recv(1)
+            remaining = size
+            while remaining > 0:
+                conn.sendall(block[: min(remaining, BUFFER_SIZE)])
+                remaining -= BUFFER_SIZE
+
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def _measure(port, streams, size):
+    """同时打开 streams 个连接，每个读 size 字节，返回总吞吐量（MB/s）"""
+
+    def read():
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            conn.sendall(b"x")
+            received = 0
+            while received < size:
+                data = conn.recv(BUFFER_SIZE)
+                if not data:
+                    raise ConnectionError(f"只收到 {received} 字节")
+                received += len(data)
+
+    threads = [threading.Thread(target=read) for _ in range(streams)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return streams * size / (time.perf_counter() - start) / 1e6
+
+
+def bench(ssh_address, username, password, transports, ciphers, compressions, streams, size):
+    """在本地测量不同的连接数、加密算法和压缩设置下的转发吞吐量，返回结果列表（按吞吐量排序）"""
+    source = _start_source(size)
+    remote = source.getsockname()
+    results = []
+    try:
+        for count, cipher, compression in itertools.product(transports, ciphers, compressions):
+            pool = TunnelPool(
+                ssh_address,
+                username,
+                password,
+                [remote],
+                [("127.0.0.1", 0)],
+                transports=count,
+                compression=compression,
+                ciphers=[cipher],
+                keepalive=0,
+            )
+            try:
+                pool.start()
+                throughput = _measure(pool.local_bind_ports[0], streams, size)
+            except Exception as e:
+                print(f"{count} 条连接 {cipher} 压缩={compression}: 失败 {e}")
+                continue
+            finally:
+                pool.stop()
+            results.append(
+                {"transports": count, "cipher": cipher, "compression": compression, "mb_s": round(throughput, 1)}
+            )
+            print(f"{count} 条连接  {cipher:<24} 压缩={'是' if compression else '否'}  {throughput:8.1f} MB/s")
+    finally:
+        source.close()
+    return sorted(results, key=lambda r: -r["mb_s"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="测量 SSH 转发的吞吐量，比较连接数、加密算法和压缩设置，默认使用进程内的 SSH 服务器"
+    )
+    parser.add_argument("--ssh", help="使用本机的 SSH 服务器（host:port），默认启动进程内的测试服务器")
+    parser.add_argument("--username", default="bench")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--transports", default="1,2,4", help="要比较的 SSH 连接数")
+    parser.add_argument(
+        "--ciphers",
+        default="aes128-ctr,aes256-ctr,aes128-gcm@openssh.com",
+        help="要比较的加密算法",
+    )
+    parser.add_argument("--compression", choices=["off", "on", "both"], default="off")
+    parser.add_argument("--streams", type=int, default=4, help="同时进行的流数")
+    parser.add_argument("--mb", type=float, default=16, help="每个流传输的数据量（MB）")
+    args = parser.parse_args()
+    # 每轮测试结束时关闭连接，paramiko 会把对端重置连接记为错误日志
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    server = None
+    if args.ssh:
+        host, _, port = args.ssh.partition(":")
+        ssh_address = (host, int(port or 22))
+    else:
+        server = _BenchServer()
+        ssh_address = ("127.0.0.1", server.port)
+    compressions = {"off": [False], "on": [True], "both": [False, True]}[args.compression]
+    try:
+        results = bench(
+            ssh_address,
+            args.username,
+            args.password,
+            [int(n) for n in args.transports.split(",")],
+            [c.strip() for c in args.ciphers.split(",")],
+            compressions,
+            args.streams,
+            int(args.mb * 1e6),
+        )
+    finally:
+        if server is not None:
+            server.close()
+    if results:
+        best = results[0]
+        print("\n推荐的配置：")
+        print(f"tunnel_transports={best['transports']}")
+        print(f"ssh_ciphers={best['cipher']}")
+        print(f"ssh_compression={'true' if best['compression'] else 'false'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+import argparse
+import glob
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+DEFAULT_DIR = "vectors"
+DOC_PATTERNS = ("*.md", "*.txt", "*.py")
+
+
+# 读取配置文件并解析
+def read_config(file_path):
+    config = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                config[key.strip()] = value.strip()
+    return config
+
+
+def chunk_text(text, max_chars=800):
+    """按段落把文本拼成不超过 max_chars 的块，单个段落太长时直接切开"""
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class VectorIndex:
+    """保存在本地的向量索引，向量用 NumPy 内存映射，元数据保存在 SQLite 中
+
+    vectors.f32 是按行追加的 float32 矩阵（已经归一化，检索时直接做点积），第 i 行对应
+    chunks 表中 id 为 i 的块。文件修改后旧的块只标记为删除，不改动向量文件，
+    删除的行超过一半时 compact() 重写一次。检索时只把文件映射到内存，不整个读进来。
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, dimensions=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                source TEXT,
+                ref TEXT,
+                position INTEGER,
+                text TEXT,
+                deleted INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS chunks_ref ON chunks (source, ref);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS indexed_sessions (
+                session_id TEXT PRIMARY KEY,
+                turns INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self._db.commit()
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dimensions'").fetchone()
+        self.dimensions = int(row[0]) if row else dimensions
+        self._matrix = None  # 内存映射的向量矩阵，向量文件变化后重新映射
+        self._deleted = None
+
+    def __len__(self):
+        if not os.path.exists(self.vectors_path) or not self.dimensions:
+            return 0
+        return os.path.getsize(self.vectors_path) // (4 * self.dimensions)
+
+    def add(self, source, ref, texts, vectors):
+        """追加一组块和它们的向量，返回新增的块数"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(texts):
+            return 0
+        with self._lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('dimensions', ?)",
+                    (str(self.dimensions),),
+                )
+            if vectors.shape[1] != self.dimensions:
+                raise ValueError(
+                    f"向量维数 {vectors.shape[1]} 和索引中的 {self.dimensions} 不一致，换了模型时请删除 {self.directory}"
+                )
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+            start = len(self)
+            first_position = self._db.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM chunks WHERE source = ? AND ref = ? AND deleted = 0",
+                (source, ref),
+            ).fetchone()[0]
+            self._db.executemany(
+                "INSERT INTO chunks (id, source, ref, position, text) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (start + i, source, ref, first_position + i, text)
+                    for i, text in enumerate(texts)
+                ],
+            )
+            # 先写向量再提交元数据，中途退出时最多留下几行没有元数据的向量，compact() 会清理
+            with open(self.vectors_path, "ab") as file:
+                file.write(vectors.tobytes())
+            self._db.commit()
+            self._matrix = None
+        return len(texts)
+
+    def remove(self, source, ref):
+        with self._lock:
+            self._db.execute(
+                "UPDATE chunks SET deleted = 1 WHERE source = ? AND ref = ?", (source, ref)
+            )
+            self._db.commit()
+            self._deleted = None
+
+    def _load(self):
+        # 调用方需持有 self._lock
+        rows = len(self)
+        if self._matrix is None or self._matrix.shape[0] != rows:
+            self._matrix = (
+                np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimensions))
+                if rows
+                else np.zeros((0, self.dimensions or 1), dtype=np.float32)
+            )
+            self._deleted = None
+        if self._deleted is None:
+            mask = np.ones(rows, dtype=bool)
+            valid = [i for (i,) in self._db.execute("SELECT id FROM chunks WHERE deleted = 0") if i < rows]
+            mask[valid] = False
+            self._deleted = mask
+        return self._matrix, self._deleted
+
+    def search(self, vector, k=4, min_score=0.0):
+        """返回和 vector 最相似的 k 个块：[{"score", "source", "ref", "position", "text"}]"""
+        if not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            matrix, deleted = self._load()
+            scores = matrix @ query
+            scores[deleted] = -np.inf
+            k = min(k, int((~deleted).sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                if scores[i] < min_score:
+                    break
+                source, ref, position, text = self._db.execute(
+                    "SELECT source, ref, position, text FROM chunks WHERE id = ?", (int(i),)
+                ).fetchone()
+                results.append(
+                    {
+                        "score": round(float(scores[i]), 4),
+                        "source": source,
+                        "ref": ref,
+                        "position": position,
+                        "text": text,
+                    }
+                )
+        return results
+
+    def compact(self):
+        """删除的块超过一半时重写向量文件，去掉已经删除的行"""
+        with self._lock:
+            matrix, deleted = self._load()
+            if not deleted.any() or deleted.sum() * 2 < len(deleted):
+                return False
+            keep = np.flatnonzero(~deleted)
+            tmp_path = self.vectors_path + ".tmp"
+            np.asarray(matrix[keep]).tofile(tmp_path)
+            # Windows 上不能替换仍被映射的文件，os.replace 之前去掉所有对内存映射的引用
+            del matrix
+            self._matrix = None
+            rows = self._db.execute(
+                "SELECT id, source, ref, position, text FROM chunks WHERE deleted = 0 ORDER BY id"
+            ).fetchall()
+            self._db.execute("DELETE FROM chunks")
+            self._db.executemany(
+                "INSERT INTO chunks (id, source, ref, position, text) VALUES (?, ?, ?, ?, ?)",
+                [(new_id,) + tuple(row[1:]) for new_id, row in enumerate(rows)],
+            )
+            os.replace(tmp_path, self.vectors_path)
+            self._db.commit()
+            self._deleted = None
+        return True
+
+    def update_documents(self, embed, directory, max_chars=800):
+        """索引 directory 中新增或修改过的文档，删除已经不存在的文档；embed(texts) 返回向量列表"""
+        paths = set()
+        for pattern in DOC_PATTERNS:
+            paths.update(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+        with self._lock:
+            known = {
+                path: (mtime, size)
+                for path, mtime, size in self._db.execute("SELECT path, mtime, size FROM files")
+            }
+        changed = 0
+        for path in set(known) - paths:
+            self.remove("file", path)
+            with self._lock:
+                self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self._db.commit()
+            changed += 1
+        for path in sorted(paths):
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+            with open(path, "r", encoding="utf-8", errors="replace") as file:
+                chunks = chunk_text(file.read(), max_chars)
+            self.remove("file", path)
+            if chunks:
+                self.add("file", path, chunks, embed(chunks))
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                    (path, stat.st_mtime, stat.st_size),
+                )
+                self._db.commit()
+            changed += 1
+        return changed
+
+    def update_sessions(self, embed, store, max_chars=800):
+        """索引会话存储中新增的问答，每轮问答（去掉推理过程）切成块；返回新增的块数"""
+        from think_parser import strip_think
+
+        with self._lock:
+            known = dict(self._db.execute("SELECT session_id, turns FROM indexed_sessions"))
+        added = 0
+        for session in store.recent(limit=-1):
+            indexed = known.get(session["id"], 0)
+            if session["turns"] <= indexed:
+                continue
+            turns = store.turns(session["id"])
+            chunks = []
+            question = ""
+            for turn in turns[indexed:]:
+                if turn["role"] == "user":
+                    question = turn["content"]
+                elif turn["role"] == "assistant":
+                    text = f"问：{question}\n\n答：{strip_think(turn['content'])}"
+                    chunks += chunk_text(text, max_chars)
+            if chunks:
+                added += self.add("session", session["id"], chunks, embed(chunks))
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO indexed_sessions (session_id, turns) VALUES (?, ?)",
+                    (session["id"], len(turns)),
+                )
+                self._db.commit()
+        return added
+
+    def stats(self):
+        with self._lock:
+            live, deleted = self._db.execute(
+                "SELECT COALESCE(SUM(deleted = 0), 0), COALESCE(SUM(deleted), 0) FROM chunks"
+            ).fetchone()
+        return {
+            "chunks": live,
+            "deleted": deleted,
+            "dimensions": self.dimensions,
+            "bytes": os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Retriever:
+    """根据用户的问题检索相关的块，拼成一条 system 消息放在这轮提问之前"""
+
+    def __init__(self, http, index, model, k=4, min_score=0.3, max_chars=3000):
+        self.http = http
+        self.index = index
+        self.model = model
+        self.k = k
+        self.min_score = min_score
+        self.max_chars = max_chars
+
+    @classmethod
+    def from_config(cls, config, http):
+        """配置了 embedding_model 并且 rag_enabled 不为 false 时创建，否则返回 None"""
+        model = config.get("embedding_model")
+        if not model or config.get("rag_enabled", "true").lower() != "true":
+            return None
+        return cls(
+            http,
+            VectorIndex(config.get("vector_dir", DEFAULT_DIR)),
+            model,
+            k=int(config.get("rag_top_k", 4)),
+            min_score=float(config.get("rag_min_score", 0.3)),
+            max_chars=int(config.get("rag_max_chars", 3000)),
+        )
+
+    def retrieve(self, query):
+        if not len(self.index):
+            return []
+        vector = self.http.embeddings([query], self.model)[0]
+        return self.index.search(vector, self.k, self.min_score)
+
+    def augment(self, messages, query):
+        """返回在最后一条（本轮的）用户消息之前插入检索结果的新消息列表，没有结果时原样返回"""
+        results = self.retrieve(query)
+        if not results:
+            return messages
+        parts = []
+        used = 0
+        for result in results:
+            if used + len(result["text"]) > self.max_chars:
+                break
+            parts.append(f"[{result['ref']}]\n{result['text']}")
+            used += len(result["text"])
+        if not parts:
+            return messages
+        context = {
+            "role": "system",
+            "content": "以下是从本地资料和以前的对话中检索到的内容，回答时可以参考：\n\n"
+            + "\n\n---\n\n".join(parts),
+        }
+        return messages[:-1] + [context] + messages[-1:]
+
+    def close(self):
+        self.index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="更新本地向量索引，或者在索引中检索")
+    parser.add_argument("command", choices=["update", "search", "stats"])
+    parser.add_argument("query", nargs="*")
+    parser.add_argument("--config", default="config.txt")
+    parser.add_argument("--docs", help="要索引的文档目录，默认 rag_docs_dir")
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    index = VectorIndex(config.get("vector_dir", DEFAULT_DIR))
+    try:
+        if args.command == "stats":
+            print(index.stats())
+            return
+        model = config.get("embedding_model")
+        if not model:
+            print("请先在 config.txt 中设置 embedding_model")
+            return
+        from tunnel import LazyTunnel
+        from http_client import get_shared_client, close_shared_client
+
+        tunnel = LazyTunnel.from_config(config, probe=False).start()
+        try:
+            tunnel.wait()
+            http = get_shared_client(config, int(config.get("local_port", 8888)))
+            batch_size = int(config.get("embedding_batch_size", 32))
+            concurrency = int(config.get("embedding_concurrency", 4))
+
+            def embed(texts):
+                return http.embeddings(texts, model, batch_size, concurrency)
+
+            if args.command == "update":
+                start = time.perf_counter()
+                docs_dir = args.docs or config.get("rag_docs_dir", "docs")
+                files = index.update_documents(embed, docs_dir) if os.path.isdir(docs_dir) else 0
+                sessions = 0
+                session_path = config.get("session_path", os.path.join("sessions", "sessions.sqlite3"))
+                if os.path.exists(session_path):
+                    from session_store import SessionStore
+
+                    store = SessionStore(session_path)
+                    try:
+                        sessions = index.update_sessions(embed, store)
+                    finally:
+                        store.close()
+                index.compact()
+                print(
+                    f"更新了 {files} 个文档、{sessions} 个会话中的块，"
+                    f"耗时 {time.perf_counter() - start:.1f}s：{index.stats()}"
+                )
+            else:
+                vector = embed([" ".join(args.query)])[0]
+                for result in index.search(vector, args.k):
+                    text = " ".join(result["text"].split())
+                    print(f"[{result['score']:.3f}] {result['ref']}#{result['position']}  {text[:100]}")
+        finally:
+            close_shared_client()
+            tunnel.stop()
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()